@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""Benchmark an API server under many concurrent slow connections.
+
+Start a server, e.g. the WSGI one:
+
+    make backend-serve
+
+or the ASGI one:
+
+    make backend-serve-asgi
+
+and then point this at it:
+
+    backend/scripts/benchmark.py --port 8081 --slow_clients 200
+
+This opens `--slow_clients` connections that request `--path` and then read
+the response a few bytes at a time. While they're reading, it makes
+`--probes` ordinary requests, one at a time, and reports how long those
+took. A server that ties up a worker per slow client shows it here: the
+probes queue behind the slow clients.
+"""
+
+import argparse
+import asyncio
+import socket
+import statistics
+import time
+
+
+def _request(host, path):
+    return f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode()
+
+
+async def _connect(host, port):
+    # A tiny receive buffer keeps the kernel from soaking up the whole
+    # response on the client's behalf, so the server really does have to
+    # wait on us.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, (host, port))
+    return await asyncio.open_connection(sock=sock, limit=4096)
+
+
+async def slow_client(host, port, path, read_bytes, read_delay, stop):
+    reader, writer = await _connect(host, port)
+    writer.write(_request(host, path))
+    await writer.drain()
+    received = 0
+    while not stop.is_set():
+        data = await reader.read(read_bytes)
+        if not data:
+            break
+        received += len(data)
+        await asyncio.sleep(read_delay)
+    writer.close()
+    return received
+
+
+async def probe(host, port, path):
+    start = time.perf_counter()
+    reader, writer = await _connect(host, port)
+    writer.write(_request(host, path))
+    await writer.drain()
+    status = await reader.readline()
+    while await reader.read(64 * 1024):
+        pass
+    writer.close()
+    return time.perf_counter() - start, status.decode().strip()
+
+
+async def run(args):
+    stop = asyncio.Event()
+    slow = [
+        asyncio.create_task(
+            slow_client(
+                args.host,
+                args.port,
+                args.path,
+                args.read_bytes,
+                args.read_delay,
+                stop,
+            )
+        )
+        for _ in range(args.slow_clients)
+    ]
+    # Give the slow clients a moment to get their requests in.
+    await asyncio.sleep(1.0)
+
+    latencies = []
+    failures = 0
+    for _ in range(args.probes):
+        try:
+            latency, status = await asyncio.wait_for(
+                probe(args.host, args.port, args.probe_path), args.timeout
+            )
+        except (asyncio.TimeoutError, OSError):
+            failures += 1
+            continue
+        if " 200 " not in f"{status} ":
+            failures += 1
+            continue
+        latencies.append(latency)
+
+    stop.set()
+    received = await asyncio.gather(*slow, return_exceptions=True)
+    slow_failures = sum(1 for r in received if isinstance(r, BaseException))
+
+    print(f"   slow clients: {args.slow_clients:,} ({slow_failures:,} failed)")
+    print(f"         probes: {args.probes:,} ({failures:,} failed)")
+    if latencies:
+        latencies.sort()
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f" probe median s: {statistics.median(latencies):.4f}")
+        print(f"    probe p95 s: {p95:.4f}")
+        print(f"    probe max s: {latencies[-1]:.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "Benchmark an API server under many concurrent slow connections."
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument(
+        "--path",
+        type=str,
+        help="path that the slow clients request",
+        default="/api/locations_ex.json",
+    )
+    parser.add_argument(
+        "--probe_path",
+        type=str,
+        help="path that the probes request",
+        default="/api/images_ex.json",
+    )
+    parser.add_argument(
+        "--slow_clients",
+        type=int,
+        help="number of concurrent slow connections",
+        default=100,
+    )
+    parser.add_argument(
+        "--read_bytes",
+        type=int,
+        help="bytes each slow client reads at a time",
+        default=1024,
+    )
+    parser.add_argument(
+        "--read_delay",
+        type=float,
+        help="seconds each slow client waits between reads",
+        default=0.1,
+    )
+    parser.add_argument(
+        "--probes", type=int, help="number of probe requests", default=50
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="seconds before a probe counts as failed",
+        default=10.0,
+    )
+    asyncio.run(run(parser.parse_args()))
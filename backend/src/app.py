@@ -7,6 +7,8 @@ file with:
 
     IMAGES_GEOJSON_FILENAME=...
     IMAGES_JSON_FILENAME=...
+    LOCATION_TOLERANCE=...
+    HEATMAP_MAX_ZOOM=...
 
 or use environment variables (prefixed with "BACKEND"):
 
@@ -24,24 +26,66 @@ e.g.:
 (The `--extra-files images.geojson:images.json` bit will cause the server
 to reload if either file changes.)
 
+To serve the same endpoints from an ASGI server instead, see `asgi.py`.
+
 Supported endpoints:
 
 - /api/locations_ex.json
 - /api/locations/43.651501,-79.359842.json
 
+- /api/sources/toronto-archives/locations_ex.json
+- /api/decades/1920/locations_ex.json
+
 - /api/images_ex.json
 - /api/images/86514.json
 
+- /api/heatmap/3.json
+- /api/heatmap/3.bin
+- /api/decades/1920/heatmap/3.json
+- /api/decades/1920/heatmap/3.bin
+
 (The `_ex` suffixes are because those files aren't just lists, they're...
 bespoke.)
+
+The server starts answering as soon as the locations and images JSON are
+ready; the structures behind the other endpoints are built in the background.
+Until they are, those endpoints respond with a 503. For load balancers:
+
+- /healthz (always 200)
+- /readyz (200 once everything is built, 503 until then)
+
+Both report which structures are built and how many seconds each took.
+
+A location that isn't found exactly, but is within `LOCATION_TOLERANCE`
+micro-degrees (default: 1) of one that is, redirects to that one. (This
+papers over rounding differences between JavaScript and Python. It isn't
+baked, though, since a static server can't do it.)
+
+A heatmap at zoom `z` (from 0 to `HEATMAP_MAX_ZOOM`, default: 7) counts the
+images in each cell of a 2^z x 2^z grid over the bounds of all the locations.
+The JSON is like:
+
+    {
+        "bounds": [<west>, <south>, <east>, <north>],
+        "counts": [<count>, ...],
+        "size": <2^z>
+    }
+
+where `counts` goes row by row, from north to south, and west to east within
+each row. The `.bin` is just those counts, as little-endian unsigned 32-bit
+integers.
 """
 
+import array
 import hashlib
 import json
 import logging
 import pathlib
 import shutil
 import sys
+import threading
+import time
+import urllib.parse
 from collections import Counter, defaultdict
 
 import click
@@ -51,6 +95,23 @@ from flask import Flask, Response, abort, current_app, jsonify, request, url_for
 # but the structure has -- e.g., a new field was added.
 ETAG_VERSION = "2"
 
+# Structures that `create_app()` builds in the background, in order, after
+# the ones needed by the core endpoints.
+SECONDARY_STRUCTURES = [
+    "BY_GRID",
+    "LOCATIONS_BY_SOURCE",
+    "LOCATIONS_BY_DECADE",
+    "HEATMAP_BOUNDS",
+    "HEATMAPS",
+    "HEATMAPS_BY_DECADE",
+]
+
+# Sources of imagery, keyed by the domain that their URLs belong to.
+SOURCE_DOMAINS = {
+    "eloquent-systems.com": "toronto-archives",
+    "torontopubliclibrary.ca": "tpl",
+}
+
 
 def _check_can_load(filename):
     if not pathlib.Path(filename).is_file():
@@ -130,13 +191,53 @@ def _images_json(images):
     return json.dumps(images, sort_keys=True)
 
 
-def _etag(locations_json, images_json):
+def _etag(*contents):
     md5 = hashlib.md5(ETAG_VERSION.encode())
-    md5.update(locations_json.encode())
-    md5.update(images_json.encode())
+    for content in contents:
+        md5.update(content if isinstance(content, bytes) else content.encode())
     return md5.hexdigest()
 
 
+def _source(properties):
+    """Return the source of an image, judging by the hosts of its URLs."""
+    for url in (properties.get("url"), (properties.get("image") or {}).get("url")):
+        host = urllib.parse.urlparse(url or "").hostname or ""
+        for domain, source in SOURCE_DOMAINS.items():
+            if host == domain or host.endswith(f".{domain}"):
+                return source
+    return None
+
+
+def _decade(properties):
+    """Return the decade of an image, e.g. "1920", or None if it's undated."""
+    return _year_decade(properties["date"])
+
+
+def _year_decade(year):
+    if not (year or "").isdigit():
+        return None
+    return str(int(year) // 10 * 10)
+
+
+def _locations_indexes(images_geojson, key):
+    """{
+        "<key>": (<locations JSON>, <ETag>), ...
+    }
+
+    where each locations JSON is like `_locations_json`'s, but only for the
+    images with that key."""
+    by_key = defaultdict(list)
+    for f in images_geojson:
+        k = key(f["properties"])
+        if k:
+            by_key[k].append(f)
+    indexes = {}
+    for k, features in by_key.items():
+        locations_json = _locations_json(_locations(features))
+        indexes[k] = (locations_json, _etag(locations_json))
+    return indexes
+
+
 def _by_location(images_geojson):
     """{
         "<location>": {
@@ -151,6 +252,127 @@ def _by_location(images_geojson):
     return locations
 
 
+def _grid_point(location):
+    """Return a location's lat and lng as integer micro-degrees, or None if
+    it isn't a valid location."""
+    try:
+        lat, lng = (round(float(f) * 1_000_000) for f in location.split(","))
+    except (OverflowError, ValueError):
+        return None
+    return lat, lng
+
+
+def _by_grid(by_location, cell_size):
+    """{
+        (<row>, <col>): [
+            (<lat>, <lng>, "<location>"), ...
+        ], ...
+    }
+
+    where lat and lng are in integer micro-degrees and each grid cell is
+    `cell_size` micro-degrees on a side."""
+    grid = defaultdict(list)
+    for location in by_location:
+        lat, lng = _grid_point(location)
+        grid[(lat // cell_size, lng // cell_size)].append((lat, lng, location))
+    return grid
+
+
+def _nearest_location(by_grid, cell_size, location):
+    """Return the stored location nearest to `location` that is within
+    `cell_size` micro-degrees of it (in both lat and lng), or None.
+
+    Only the 3x3 block of grid cells around `location` can hold a match, so
+    this is a fixed number of lookups, no matter how many locations there are.
+    """
+    point = _grid_point(location)
+    if point is None:
+        return None
+    lat, lng = point
+    row, col = lat // cell_size, lng // cell_size
+    candidates = [
+        ((lat - c_lat) ** 2 + (lng - c_lng) ** 2, c_location)
+        for d_row in (-1, 0, 1)
+        for d_col in (-1, 0, 1)
+        for c_lat, c_lng, c_location in by_grid.get((row + d_row, col + d_col), ())
+        if abs(lat - c_lat) <= cell_size and abs(lng - c_lng) <= cell_size
+    ]
+    if not candidates:
+        return None
+    return min(candidates)[1]
+
+
+def _bounds(locations):
+    """[<west>, <south>, <east>, <north>]"""
+    points = [_grid_point(location) for location in locations]
+    lats = [lat for lat, _ in points] or [0]
+    lngs = [lng for _, lng in points] or [0]
+    return [min(lngs) / 1e6, min(lats) / 1e6, max(lngs) / 1e6, max(lats) / 1e6]
+
+
+def _heatmap_counts(locations, bounds, zoom, decade=None):
+    """Return a list of lists of counts for each zoom from 0 to `zoom`, in the
+    order described above.
+
+    Only the finest grid is counted from `locations`; each coarser one is
+    summed from the 2x2 blocks of the one below it.
+    """
+    west, south, east, north = (round(b * 1e6) for b in bounds)
+    width, height = max(east - west, 1), max(north - south, 1)
+    size = 2**zoom
+    counts = [0] * (size * size)
+    for location, years in locations.items():
+        count = sum(
+            n
+            for year, n in years.items()
+            if decade is None or _year_decade(year) == decade
+        )
+        if not count:
+            continue
+        lat, lng = _grid_point(location)
+        row = min(size - 1, (north - lat) * size // height)
+        col = min(size - 1, (lng - west) * size // width)
+        counts[row * size + col] += count
+
+    levels = [counts]
+    while size > 1:
+        fine, size = levels[0], size // 2
+        levels.insert(
+            0,
+            [
+                fine[2 * row * 2 * size + 2 * col]
+                + fine[2 * row * 2 * size + 2 * col + 1]
+                + fine[(2 * row + 1) * 2 * size + 2 * col]
+                + fine[(2 * row + 1) * 2 * size + 2 * col + 1]
+                for row in range(size)
+                for col in range(size)
+            ],
+        )
+    return levels
+
+
+def _heatmaps(locations, bounds, zoom, decade=None):
+    """{
+        <zoom>: (<JSON>, <ETag>, <binary>, <ETag>), ...
+    }"""
+    heatmaps = {}
+    for z, counts in enumerate(_heatmap_counts(locations, bounds, zoom, decade)):
+        heatmap_json = json.dumps(
+            {"bounds": bounds, "counts": counts, "size": 2**z}, sort_keys=True
+        )
+        heatmap_bin = array.array("I", counts)
+        if sys.byteorder != "little":
+            heatmap_bin.byteswap()
+        heatmap_bin = heatmap_bin.tobytes()
+        heatmaps[z] = (
+            heatmap_json,
+            _etag(heatmap_json),
+            heatmap_bin,
+            _etag(heatmap_json, heatmap_bin),
+        )
+    return heatmaps
+
+
 def _by_image(images_geojson):
     """{
         "<image>": {
@@ -170,6 +392,8 @@ def create_app():
     app.config.from_mapping(
         IMAGES_GEOJSON_FILENAME="images.geojson",
         IMAGES_JSON_FILENAME="images.json",
+        LOCATION_TOLERANCE=1,
+        HEATMAP_MAX_ZOOM=7,
     )
     # Then file...
     app.config.from_pyfile("config.py", silent=True)
@@ -185,30 +409,114 @@ def create_app():
 
     app.logger.info("Working...")
 
+    # Every structure is recorded in STRUCTURES, with how many seconds it took
+    # to build, or None if it hasn't been built yet.
+    structures = app.config["STRUCTURES"] = {}
+
+    def build(name, builder, *args):
+        start = time.perf_counter()
+        app.config[name] = builder(*args)
+        structures[name] = round(time.perf_counter() - start, 3)
+
     # Derive: location id -> image id -> image
-    app.config["BY_LOCATION"] = _by_location(images_geojson)
+    build("BY_LOCATION", _by_location, images_geojson)
 
     # Derive: image id -> image
-    app.config["BY_IMAGE"] = _by_image(images_geojson)
+    build("BY_IMAGE", _by_image, images_geojson)
 
     # Since the locations and images JSON are produced on *every* page load,
     # pre-compute them.
 
     # Derive: location ids -> year ids -> counts
-    app.config["LOCATIONS"] = _locations(images_geojson)
-    app.config["LOCATIONS_JSON"] = _locations_json(app.config["LOCATIONS"])
+    build("LOCATIONS", _locations, images_geojson)
+    build("LOCATIONS_JSON", _locations_json, app.config["LOCATIONS"])
 
     # Derive: [image, ...]
-    app.config["IMAGES"] = _images(images_json, app.config["BY_IMAGE"])
-    app.config["IMAGES_JSON"] = _images_json(app.config["IMAGES"])
+    build("IMAGES", _images, images_json, app.config["BY_IMAGE"])
+    build("IMAGES_JSON", _images_json, app.config["IMAGES"])
 
     # Derive: ETag
-    app.config["ETAG"] = _etag(app.config["LOCATIONS_JSON"], app.config["IMAGES_JSON"])
+    build("ETAG", _etag, app.config["LOCATIONS_JSON"], app.config["IMAGES_JSON"])
 
     app.logger.info(f"Loaded {len(app.config['LOCATIONS']):,} features.")
     app.logger.info(f"Loaded {len(app.config['IMAGES']):,} featured features.")
     app.logger.info(f"Current ETag is {app.config['ETAG']}.")
 
+    # That's enough to serve the core endpoints. Everything else is built on
+    # a background thread; until it is, the endpoints that need it respond
+    # with a 503, and /readyz says so.
+
+    def build_secondary():
+        # Derive: grid cell -> [location id, ...]
+        build(
+            "BY_GRID",
+            _by_grid,
+            app.config["BY_LOCATION"],
+            app.config["LOCATION_TOLERANCE"],
+        )
+
+        # Likewise, pre-compute the locations JSON (and ETag) for each source
+        # and each decade, so that filtering by them is just a lookup.
+
+        # Derive: source -> (locations JSON, ETag)
+        build("LOCATIONS_BY_SOURCE", _locations_indexes, images_geojson, _source)
+
+        # Derive: decade -> (locations JSON, ETag)
+        build("LOCATIONS_BY_DECADE", _locations_indexes, images_geojson, _decade)
+
+        # Derive: zoom -> (heatmap JSON, ETag, heatmap binary, ETag)
+        build("HEATMAP_BOUNDS", _bounds, app.config["LOCATIONS"])
+        build(
+            "HEATMAPS",
+            _heatmaps,
+            app.config["LOCATIONS"],
+            app.config["HEATMAP_BOUNDS"],
+            app.config["HEATMAP_MAX_ZOOM"],
+        )
+
+        # Derive: decade -> zoom -> (heatmap JSON, ETag, heatmap binary, ETag)
+        build(
+            "HEATMAPS_BY_DECADE",
+            lambda: {
+                decade: _heatmaps(
+                    app.config["LOCATIONS"],
+                    app.config["HEATMAP_BOUNDS"],
+                    app.config["HEATMAP_MAX_ZOOM"],
+                    decade,
+                )
+                for decade in app.config["LOCATIONS_BY_DECADE"]
+            },
+        )
+
+        app.logger.info(
+            f"Indexed {len(app.config['LOCATIONS_BY_SOURCE']):,} sources "
+            f"and {len(app.config['LOCATIONS_BY_DECADE']):,} decades."
+        )
+
+    for name in SECONDARY_STRUCTURES:
+        structures[name] = None
+    app.extensions["builder"] = threading.Thread(
+        target=build_secondary, name="build_secondary", daemon=True
+    )
+    app.extensions["builder"].start()
+
+    def require(*names):
+        """Respond with a 503 unless all of these structures have been built."""
+        if any(structures[name] is None for name in names):
+            response = jsonify(message="Not ready")
+            response.status_code = 503
+            response.headers["Retry-After"] = "1"
+            abort(response)
+
+    @app.route("/healthz")
+    def healthz():
+        return jsonify(structures=structures)
+
+    @app.route("/readyz")
+    def readyz():
+        ready = all(seconds is not None for seconds in structures.values())
+        return jsonify(ready=ready, structures=structures), 200 if ready else 503
+
     @app.route("/api/locations_ex.json")
     def locations_json():
         if request.if_none_match.contains(current_app.config["ETAG"]):
@@ -228,7 +536,19 @@ def create_app():
 
         location = app.config["BY_LOCATION"].get(location_id)
         if not location:
-            abort(404)
+            require("BY_GRID")
+            nearest = _nearest_location(
+                current_app.config["BY_GRID"],
+                current_app.config["LOCATION_TOLERANCE"],
+                location_id,
+            )
+            if not nearest:
+                abort(404)
+
+            response = jsonify(location=nearest)
+            response.status_code = 302
+            response.location = url_for("locations_location", location_id=nearest)
+            return response
 
         response = Response(
             json.dumps(location, sort_keys=True),
@@ -237,6 +557,74 @@ def create_app():
         response.set_etag(current_app.config["ETAG"])
         return response
 
+    def locations_index_response(indexes, key):
+        index = indexes.get(key)
+        if not index:
+            abort(404)
+
+        locations_json, etag = index
+        if request.if_none_match.contains(etag):
+            return jsonify(message="OK"), 304
+
+        response = Response(locations_json, mimetype="application/json")
+        response.set_etag(etag)
+        return response
+
+    @app.route("/api/sources/<source>/locations_ex.json")
+    def sources_locations_json(source):
+        require("LOCATIONS_BY_SOURCE")
+        return locations_index_response(
+            current_app.config["LOCATIONS_BY_SOURCE"], source
+        )
+
+    @app.route("/api/decades/<decade>/locations_ex.json")
+    def decades_locations_json(decade):
+        require("LOCATIONS_BY_DECADE")
+        return locations_index_response(
+            current_app.config["LOCATIONS_BY_DECADE"], decade
+        )
+
+    def heatmap_response(heatmaps, zoom, binary):
+        heatmap = heatmaps.get(zoom)
+        if not heatmap:
+            abort(404)
+
+        heatmap_json, json_etag, heatmap_bin, bin_etag = heatmap
+        etag = bin_etag if binary else json_etag
+        if request.if_none_match.contains(etag):
+            return jsonify(message="OK"), 304
+
+        if binary:
+            response = Response(heatmap_bin, mimetype="application/octet-stream")
+        else:
+            response = Response(heatmap_json, mimetype="application/json")
+        response.set_etag(etag)
+        return response
+
+    @app.route("/api/heatmap/<int:zoom>.json")
+    def heatmap_json(zoom):
+        require("HEATMAPS")
+        return heatmap_response(current_app.config["HEATMAPS"], zoom, False)
+
+    @app.route("/api/heatmap/<int:zoom>.bin")
+    def heatmap_bin(zoom):
+        require("HEATMAPS")
+        return heatmap_response(current_app.config["HEATMAPS"], zoom, True)
+
+    @app.route("/api/decades/<decade>/heatmap/<int:zoom>.json")
+    def decades_heatmap_json(decade, zoom):
+        require("HEATMAPS_BY_DECADE")
+        return heatmap_response(
+            current_app.config["HEATMAPS_BY_DECADE"].get(decade, {}), zoom, False
+        )
+
+    @app.route("/api/decades/<decade>/heatmap/<int:zoom>.bin")
+    def decades_heatmap_bin(decade, zoom):
+        require("HEATMAPS_BY_DECADE")
+        return heatmap_response(
+            current_app.config["HEATMAPS_BY_DECADE"].get(decade, {}), zoom, True
+        )
+
     @app.route("/api/images_ex.json")
     def images_json():
         if request.if_none_match.contains(current_app.config["ETAG"]):
@@ -270,6 +658,9 @@ def create_app():
     def bake(dir):
         app.config["SERVER_NAME"] = "localhost"
         with app.app_context():
+            current_app.logger.info("Waiting for the background build...")
+            current_app.extensions["builder"].join()
+
             current_app.logger.info(f"Baking to {dir}...")
 
             root = pathlib.Path(dir)
@@ -302,6 +693,35 @@ def create_app():
                 ) as f:
                     json.dump(location, f, indent=True, sort_keys=True)
 
+            for endpoint, indexes, key in (
+                ("sources_locations_json", "LOCATIONS_BY_SOURCE", "source"),
+                ("decades_locations_json", "LOCATIONS_BY_DECADE", "decade"),
+            ):
+                for id, (locations_json, _) in current_app.config[indexes].items():
+                    path = root / url_for(endpoint, **{key: id}, _external=False)[1:]
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    with open(path, "w") as f:
+                        f.write(locations_json)
+
+            heatmaps = [({}, current_app.config["HEATMAPS"])] + [
+                ({"decade": decade}, by_zoom)
+                for decade, by_zoom in current_app.config["HEATMAPS_BY_DECADE"].items()
+            ]
+            for args, by_zoom in heatmaps:
+                prefix = "decades_" if args else ""
+                for zoom, (heatmap_json, _, heatmap_bin, _) in by_zoom.items():
+                    for endpoint, content in (
+                        (f"{prefix}heatmap_json", heatmap_json.encode()),
+                        (f"{prefix}heatmap_bin", heatmap_bin),
+                    ):
+                        path = (
+                            root
+                            / url_for(endpoint, zoom=zoom, **args, _external=False)[1:]
+                        )
+                        path.parent.mkdir(parents=True, exist_ok=True)
+                        with open(path, "wb") as f:
+                            f.write(content)
+
             with open(root / url_for("images_json", _external=False)[1:], "w") as f:
                 f.write(current_app.config["IMAGES_JSON"])
 
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""Run an ASGI server for the API.
+
+This serves the same endpoints as `app.py`, with the same ETag semantics, from
+the same data. (In fact, it calls `create_app()` to load that data, so it's
+configured the same way; see `app.py`.) The difference is that a slow client
+doesn't tie up a worker thread: every response is a pre-computed, in-memory
+lookup, so the only thing left to wait on is the network.
+
+Like the WSGI server, this starts answering once the core structures are
+built, and reports on the rest at /healthz and /readyz.
+
+Run it through an ASGI server, e.g.:
+
+    uvicorn --app-dir backend/src --factory asgi:create_asgi_app --port 8081
+
+`/api/locations_ex.json`, which is large, is streamed in chunks so that the
+event loop can interleave it with other responses.
+
+To compare this with the WSGI server under many concurrent slow connections,
+see `backend/scripts/benchmark.py`.
+"""
+
+import json
+import re
+
+from app import _nearest_location, create_app
+from werkzeug.http import parse_etags
+
+# The size of each chunk when streaming a large response.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+BINARY = b"application/octet-stream"
+JSON = b"application/json"
+TEXT = b"text/plain"
+
+
+class _Abort(Exception):
+    """Raised by a view to respond with something other than its body."""
+
+    def __init__(self, status, body, headers=()):
+        super().__init__(status)
+        self.status = status
+        self.body = body
+        self.headers = list(headers)
+
+
+def _not_modified(scope, etag):
+    for name, value in scope["headers"]:
+        if name == b"if-none-match":
+            return parse_etags(value.decode("latin-1")).contains(etag)
+    return False
+
+
+def create_asgi_app():
+    config = create_app().config
+
+    # Since these are produced on *every* page load, pre-encode them too.
+    locations_json = config["LOCATIONS_JSON"].encode()
+    images_json = config["IMAGES_JSON"].encode()
+    structures = config["STRUCTURES"]
+
+    def require(*names):
+        """Respond with a 503 unless all of these structures have been built."""
+        if any(structures[name] is None for name in names):
+            raise _Abort(503, b'{"message": "Not ready"}', [(b"retry-after", b"1")])
+
+    # Each view returns the body and the ETag of its response. A body of
+    # None is a 404. A view can also raise `_Abort`. Like their counterparts
+    # in `app.py`, the views in `etag_first` are checked against the current
+    # ETag before they run, so that a 304 wins over anything else they'd say.
+
+    def healthz():
+        return json.dumps({"structures": structures}).encode(), None
+
+    def readyz():
+        ready = all(seconds is not None for seconds in structures.values())
+        body = json.dumps({"ready": ready, "structures": structures}).encode()
+        if not ready:
+            raise _Abort(503, body)
+        return body, None
+
+    def locations():
+        return locations_json, config["ETAG"]
+
+    def locations_location(location_id):
+        location = config["BY_LOCATION"].get(location_id)
+        if not location:
+            require("BY_GRID")
+            nearest = _nearest_location(
+                config["BY_GRID"], config["LOCATION_TOLERANCE"], location_id
+            )
+            if not nearest:
+                return None, config["ETAG"]
+            raise _Abort(
+                302,
+                json.dumps({"location": nearest}).encode(),
+                [(b"location", f"/api/locations/{nearest}.json".encode())],
+            )
+        return json.dumps(location, sort_keys=True).encode(), config["ETAG"]
+
+    def locations_index(indexes, key):
+        require(indexes)
+        locations_json, etag = config[indexes].get(key, (None, None))
+        if locations_json is None:
+            return None, None
+        return locations_json.encode(), etag
+
+    def sources_locations(source):
+        return locations_index("LOCATIONS_BY_SOURCE", source)
+
+    def decades_locations(decade):
+        return locations_index("LOCATIONS_BY_DECADE", decade)
+
+    def heatmap(zoom, decade=None, binary=False):
+        if decade is None:
+            require("HEATMAPS")
+            heatmaps = config["HEATMAPS"]
+        else:
+            require("HEATMAPS_BY_DECADE")
+            heatmaps = config["HEATMAPS_BY_DECADE"].get(decade, {})
+        heatmap = heatmaps.get(int(zoom))
+        if not heatmap:
+            return None, None
+        heatmap_json, json_etag, heatmap_bin, bin_etag = heatmap
+        if binary:
+            return heatmap_bin, bin_etag
+        return heatmap_json.encode(), json_etag
+
+    def heatmap_bin(**kwargs):
+        return heatmap(**kwargs, binary=True)
+
+    def images():
+        return images_json, config["ETAG"]
+
+    def images_image(image_id):
+        image = config["BY_IMAGE"].get(image_id)
+        if not image:
+            return None, config["ETAG"]
+        return json.dumps(image, sort_keys=True).encode(), config["ETAG"]
+
+    etag_first = {locations, locations_location, images, images_image}
+
+    # These mirror the routes in `app.py`.
+    routes = [
+        (re.compile(r"/healthz"), healthz, JSON),
+        (re.compile(r"/readyz"), readyz, JSON),
+        (re.compile(r"/api/locations_ex\.json"), locations, JSON),
+        (
+            re.compile(r"/api/locations/(?P<location_id>[^/]+)\.json"),
+            locations_location,
+            JSON,
+        ),
+        (
+            re.compile(r"/api/sources/(?P<source>[^/]+)/locations_ex\.json"),
+            sources_locations,
+            JSON,
+        ),
+        (
+            re.compile(r"/api/decades/(?P<decade>[^/]+)/locations_ex\.json"),
+            decades_locations,
+            JSON,
+        ),
+        (re.compile(r"/api/heatmap/(?P<zoom>\d+)\.json"), heatmap, JSON),
+        (re.compile(r"/api/heatmap/(?P<zoom>\d+)\.bin"), heatmap_bin, BINARY),
+        (
+            re.compile(r"/api/decades/(?P<decade>[^/]+)/heatmap/(?P<zoom>\d+)\.json"),
+            heatmap,
+            JSON,
+        ),
+        (
+            re.compile(r"/api/decades/(?P<decade>[^/]+)/heatmap/(?P<zoom>\d+)\.bin"),
+            heatmap_bin,
+            BINARY,
+        ),
+        (re.compile(r"/api/images_ex\.json"), images, JSON),
+        (re.compile(r"/api/images/(?P<image_id>[^/]+)\.json"), images_image, JSON),
+    ]
+
+    async def send_response(send, status, body, head, content_type, headers=()):
+        headers = [
+            (b"content-type", content_type),
+            (b"content-length", str(len(body)).encode()),
+            *headers,
+        ]
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        if head:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        # Stream anything large, a chunk at a time, so that a slow client
+        # only holds up its own response.
+        data = memoryview(body)
+        for start in range(0, len(data), STREAM_CHUNK_SIZE):
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": bytes(data[start : start + STREAM_CHUNK_SIZE]),
+                    "more_body": start + STREAM_CHUNK_SIZE < len(data),
+                }
+            )
+        if not data:
+            await send({"type": "http.response.body", "body": b""})
+
+    async def send_not_modified(send):
+        await send({"type": "http.response.start", "status": 304, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            await lifespan(receive, send)
+            return
+
+        head = scope["method"] == "HEAD"
+        for pattern, view, content_type in routes:
+            m = pattern.fullmatch(scope["path"])
+            if m:
+                break
+        else:
+            await send_response(send, 404, b"Not Found", head, TEXT)
+            return
+
+        if scope["method"] not in ("GET", "HEAD"):
+            await send_response(send, 405, b"Method Not Allowed", head, TEXT)
+            return
+
+        if view in etag_first and _not_modified(scope, config["ETAG"]):
+            await send_not_modified(send)
+            return
+
+        try:
+            body, etag = view(**m.groupdict())
+        except _Abort as abort:
+            await send_response(
+                send, abort.status, abort.body, head, JSON, abort.headers
+            )
+            return
+
+        if etag and _not_modified(scope, etag):
+            await send_not_modified(send)
+            return
+
+        if body is None:
+            await send_response(send, 404, b"Not Found", head, TEXT)
+            return
+
+        headers = [(b"etag", f'"{etag}"'.encode())] if etag else []
+        await send_response(send, 200, body, head, content_type, headers)
+
+    return app
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from nose.tools import eq_
+from parameterized import parameterized
+
+sys.path.append("backend/src")
+import app as flask_app  # noqa: E402
+import asgi  # noqa: E402
+
+features = [
+    {
+        "type": "Feature",
+        "id": "1",
+        "geometry": {"type": "Point", "coordinates": [-79.38, 43.65]},
+        "properties": {
+            "date": "1925",
+            "title": "Yonge Street",
+            "url": "https://gencat.eloquent-systems.com/1",
+        },
+    },
+    {
+        "type": "Feature",
+        "id": "2",
+        "geometry": {"type": "Point", "coordinates": [-79.4, 43.66]},
+        "properties": {
+            "date": "1950",
+            "title": "Queen Street",
+            "url": "https://www.torontopubliclibrary.ca/2",
+        },
+    },
+]
+
+
+def create_apps():
+    """Return a Flask test client and an ASGI app, with the same data."""
+    data_dir = tempfile.mkdtemp()
+    geojson_file = os.path.join(data_dir, "images.geojson")
+    with open(geojson_file, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+    json_file = os.path.join(data_dir, "images.json")
+    with open(json_file, "w") as f:
+        json.dump(["1", "2"], f)
+    os.environ["BACKEND_IMAGES_GEOJSON_FILENAME"] = geojson_file
+    os.environ["BACKEND_IMAGES_JSON_FILENAME"] = json_file
+    try:
+        app = flask_app.create_app()
+        asgi_app = asgi.create_asgi_app()
+    finally:
+        del os.environ["BACKEND_IMAGES_GEOJSON_FILENAME"]
+        del os.environ["BACKEND_IMAGES_JSON_FILENAME"]
+    app.extensions["builder"].join()
+    deadline = time.monotonic() + 10
+    while asgi_get(asgi_app, "/readyz")[0] != 200:
+        if time.monotonic() > deadline:
+            raise AssertionError("The ASGI app never got ready")
+        time.sleep(0.01)
+    return app.test_client(), asgi_app, app.config["ETAG"]
+
+
+def asgi_get(app, path, headers=()):
+    """Return (status, headers, body) for a GET from an ASGI app."""
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers],
+    }
+    asyncio.run(app(scope, receive, send))
+    start, *bodies = messages
+    response_headers = {k.decode(): v.decode() for k, v in start["headers"]}
+    return start["status"], response_headers, b"".join(m["body"] for m in bodies)
+
+
+client, asgi_app, etag = create_apps()
+
+
+def comparable(status, location, etag, content_type, body):
+    # The servers format JSON differently, and only Flask sends a body with a
+    # 304 or a 404.
+    if status in (304, 404):
+        body = None
+    elif content_type.startswith("application/json"):
+        body = json.loads(body)
+    return status, location, etag, body
+
+
+@parameterized(
+    [
+        ("/api/locations_ex.json",),
+        ("/api/locations/43.650000,-79.380000.json",),
+        # A near miss, which redirects to the location above.
+        ("/api/locations/43.650001,-79.380000.json",),
+        ("/api/locations/40.000000,-70.000000.json",),
+        ("/api/sources/tpl/locations_ex.json",),
+        ("/api/sources/nowhere/locations_ex.json",),
+        ("/api/decades/1920/locations_ex.json",),
+        ("/api/heatmap/1.json",),
+        ("/api/heatmap/1.bin",),
+        ("/api/heatmap/99.json",),
+        ("/api/decades/1950/heatmap/2.json",),
+        ("/api/images_ex.json",),
+        ("/api/images/2.json",),
+        ("/api/images/3.json",),
+    ]
+)
+def parity_test(path):
+    flask_response = client.get(path)
+    own_etag = flask_response.headers.get("ETag")
+    for if_none_match in (None, f'"{etag}"', own_etag):
+        headers = [("If-None-Match", if_none_match)] if if_none_match else []
+        flask_response = client.get(path, headers=headers)
+        status, asgi_headers, body = asgi_get(asgi_app, path, headers)
+        eq_(
+            comparable(
+                flask_response.status_code,
+                flask_response.headers.get("Location"),
+                flask_response.headers.get("ETag"),
+                flask_response.headers.get("Content-Type", ""),
+                flask_response.data,
+            ),
+            comparable(
+                status,
+                asgi_headers.get("location"),
+                asgi_headers.get("etag"),
+                asgi_headers.get("content-type", ""),
+                body,
+            ),
+            (path, if_none_match),
+        )
@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+"""Maintain the fetcher's on-disk cache.
+
+Usage:
+
+    ./cache_tool.py migrate --from_backend directory --to_backend sqlite
+
+This copies every response in the cache directory from one backend to the
+other, with its metadata and access time. The source is left alone, so once
+you're happy with the copy you can delete it (e.g. everything in cache/
+except cache.sqlite). Since the backend is picked by what's in the cache
+directory (see `fetcher.open_store`), the fetcher uses SQLite from then on.
+
+    ./cache_tool.py train --host www.example.com
+
+This trains a zlib dictionary on a sample of the responses from a host and
+uses it to compress new responses (see `fetcher.Codec`).
+
+    ./cache_tool.py compress
+
+This re-compresses every response in the cache, e.g. after training a
+dictionary, or to compress responses stored before compression.
+
+    ./cache_tool.py stats [--compression]
+
+This reports the entries, bytes and hit ratio for each host, and the hosts
+that are slowest to fetch from. With --compression, it also reports how well
+a sample of the responses compress, and how long they take to decompress.
+
+    ./cache_tool.py evict --ttl_days 90 --host_quota maps.googleapis.com=1G
+
+This evicts responses that haven't been read in --ttl_days, and then the
+least recently read responses from any host that's over its --host_quota, and
+then from all hosts, until the whole cache is under --max_bytes. Recorded
+failures count too, by when they were recorded. Use --dry_run to see what
+would go.
+"""
+
+import argparse
+import collections
+import itertools
+import logging
+import os
+import time
+
+import fetcher
+from logging_configuration import configure_logging
+
+LOG = logging.getLogger(__name__)
+
+
+def known_urls(cache_dir):
+    """Return {key: url} for every URL listed in cache_dir/urls.txt."""
+    urls = {}
+    urls_file = os.path.join(cache_dir, "urls.txt")
+    if os.path.exists(urls_file):
+        for line in open(urls_file):
+            _, url = line.rstrip("\n").split("\t", 1)
+            urls[fetcher.cache_key(url)] = url
+    return urls
+
+
+def migrate(source, destination, urls):
+    """Copy every response from the source store to the destination store,
+    along with its access time and metadata (validators, and failures for
+    URLs that have no response).
+
+    `urls` maps keys to URLs, for the stores that record them. Returns the
+    number of responses copied.
+    """
+    n = 0
+    for key, _, atime in source.entries():
+        contents = source.get(key, touch=False)
+        if contents is None:
+            continue
+        destination.put(key, urls.get(key, ""), contents)
+        destination.set_atime(key, atime)
+        n += 1
+        if n % 10000 == 0:
+            LOG.info(f"Copied {n:,} responses...")
+    for key in source.meta_keys():
+        meta = source.get_meta(key)
+        if meta is not None:
+            destination.put_meta(key, meta)
+    destination.flush()
+    return n
+
+
+def sample_keys(store, host=None, sample=None):
+    """Return the first `sample` keys in the store, only from `host` if given."""
+    keys = store.keys()
+    if host:
+        keys = (key for key in keys if key[0] == host)
+    return list(itertools.islice(keys, sample))
+
+
+def compress(store, codec):
+    """Re-encode every response in the store. Returns the number re-encoded.
+
+    Responses whose files are shared with a download (see
+    `fetcher.Cache.store_file_in_cache`) are left alone, since re-encoding
+    one would store it twice.
+    """
+    n = 0
+    for key in sample_keys(store):
+        path = store.file_path(key)
+        if path and os.stat(path).st_nlink > 1:
+            continue
+        data = store.get(key)
+        if data is None:
+            continue
+        encoded = codec.encode(codec.decode(data))
+        if encoded != data:
+            store.update(key, encoded)
+            n += 1
+    store.flush()
+    return n
+
+
+def stats(store, codec, keys):
+    """Return {format: (count, stored bytes, raw bytes, decode seconds)}."""
+    totals = collections.defaultdict(lambda: [0, 0, 0, 0.0])
+    for key in keys:
+        data = store.get(key)
+        if data is None:
+            continue
+        start = time.perf_counter()
+        contents = codec.decode(data)
+        elapsed = time.perf_counter() - start
+        if data.startswith(codec.MAGIC):
+            format_ = data[len(codec.MAGIC)]
+        else:
+            format_ = None
+        total = totals[format_]
+        total[0] += 1
+        total[1] += len(data)
+        total[2] += len(contents)
+        total[3] += elapsed
+    return {format_: tuple(total) for format_, total in totals.items()}
+
+
+def evict(entries, now, ttl_secs=None, host_quotas=None, max_bytes=None):
+    """Pick which of the (key, size, atime) entries to evict, least recently
+    used first. Returns a list of them."""
+    entries = sorted(entries, key=lambda entry: entry[2])
+    evicted = set()
+
+    if ttl_secs is not None:
+        evicted.update(entry for entry in entries if now - entry[2] > ttl_secs)
+
+    def evict_until(entries, limit):
+        total = sum(entry[1] for entry in entries if entry not in evicted)
+        for entry in entries:
+            if total <= limit:
+                break
+            if entry not in evicted:
+                evicted.add(entry)
+                total -= entry[1]
+
+    for host, quota in (host_quotas or {}).items():
+        evict_until([entry for entry in entries if entry[0][0] == host], quota)
+    if max_bytes is not None:
+        evict_until(entries, max_bytes)
+
+    return [entry for entry in entries if entry in evicted]
+
+
+def all_entries(store):
+    """Return (key, size, atime) for every response in the store, and for
+    every failure, by when it was recorded."""
+    return itertools.chain(store.entries(), store.meta_entries())
+
+
+def host_report(store, host_stats):
+    """Return {host: Counter(entries, bytes, hits, misses, fetches,
+    fetch_secs)}. Entries and bytes include failures."""
+    report = collections.defaultdict(collections.Counter)
+    for (host, _), size, _ in all_entries(store):
+        report[host]["entries"] += 1
+        report[host]["bytes"] += size
+    for host, counts in host_stats.load().items():
+        report[host].update(counts)
+    return report
+
+
+def main_migrate(args):
+    if args.from_backend == args.to_backend:
+        raise ValueError("--from_backend and --to_backend are the same")
+    source = fetcher.open_store(args.cache_dir, args.from_backend)
+    destination = fetcher.open_store(args.cache_dir, args.to_backend)
+    n = migrate(source, destination, known_urls(args.cache_dir))
+    source.close()
+    destination.close()
+    LOG.info(f"Copied {n:,} responses from {args.from_backend} to {args.to_backend}.")
+
+
+def main_train(args):
+    store = fetcher.open_store(args.cache_dir)
+    codec = fetcher.Codec(args.cache_dir)
+    samples = [
+        codec.decode(store.get(key))
+        for key in sample_keys(store, args.host, args.samples)
+    ]
+    if not samples:
+        raise ValueError(f"No responses from {args.host} in the cache")
+    zdict = fetcher.train_zdict(samples, args.size)
+    zdict_id = fetcher.save_zdict(args.cache_dir, zdict)
+    LOG.info(
+        f"Trained a {len(zdict):,} byte dictionary ({zdict_id.hex()}) "
+        f"on {len(samples):,} responses."
+    )
+
+
+def main_compress(args):
+    store = fetcher.open_store(args.cache_dir)
+    n = compress(store, fetcher.Codec(args.cache_dir))
+    store.close()
+    LOG.info(f"Re-compressed {n:,} responses.")
+
+
+FORMAT_NAMES = {
+    None: "uncompressed (old)",
+    fetcher.Codec.RAW: "raw",
+    fetcher.Codec.ZLIB: "zlib",
+    fetcher.Codec.ZLIB_DICT: "zlib+dictionary",
+}
+
+
+def main_stats(args):
+    store = fetcher.open_store(args.cache_dir)
+    report = host_report(store, fetcher.HostStats(args.cache_dir))
+    print(
+        f"{'host':40} {'entries':>10} {'bytes':>15} {'hit ratio':>10} "
+        f"{'fetches':>10} {'s/fetch':>8}"
+    )
+    for host, counts in sorted(report.items(), key=lambda item: -item[1]["bytes"]):
+        lookups = counts["hits"] + counts["misses"]
+        hit_ratio = f"{counts['hits'] / lookups:.1%}" if lookups else "-"
+        latency = (
+            f"{counts['fetch_secs'] / counts['fetches']:.3f}"
+            if counts["fetches"]
+            else "-"
+        )
+        print(
+            f"{host:40} {counts['entries']:>10,} {counts['bytes']:>15,} "
+            f"{hit_ratio:>10} {counts['fetches']:>10,} {latency:>8}"
+        )
+
+    slowest = sorted(
+        (
+            (counts["fetch_secs"] / counts["fetches"], host)
+            for host, counts in report.items()
+            if counts["fetches"]
+        ),
+        reverse=True,
+    )
+    if slowest:
+        print("\nSlowest hosts:")
+        for latency, host in slowest[:10]:
+            print(f"  {latency:8.3f} s/fetch  {host}")
+
+    if args.compression:
+        print()
+        print_compression_stats(args, store)
+
+
+def print_compression_stats(args, store):
+    codec = fetcher.Codec(args.cache_dir)
+    by_format = stats(store, codec, sample_keys(store, args.host, args.samples))
+    totals = [sum(column) for column in zip(*by_format.values())] or [0, 0, 0, 0.0]
+    for name, (count, stored, raw, seconds) in [
+        *((FORMAT_NAMES[f], by_format[f]) for f in FORMAT_NAMES if f in by_format),
+        ("total", totals),
+    ]:
+        if not count:
+            continue
+        print(f"{name}:")
+        print(f"       responses: {count:,}")
+        print(f"    stored bytes: {stored:,}")
+        print(f"       raw bytes: {raw:,}")
+        print(f"           ratio: {raw / max(stored, 1):.2f}x")
+        print(f"  decode µs/page: {seconds / count * 1e6:.1f}")
+
+
+def parse_size(size):
+    """Parse a size in bytes, like "500M" or "2G"."""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    if size[-1:].upper() in units:
+        return int(float(size[:-1]) * units[size[-1].upper()])
+    return int(size)
+
+
+def main_evict(args):
+    store = fetcher.open_store(args.cache_dir)
+    host_quotas = {}
+    for spec in args.host_quota:
+        host, size = spec.rsplit("=", 1)
+        host_quotas[host] = parse_size(size)
+    evicted = evict(
+        all_entries(store),
+        time.time(),
+        ttl_secs=args.ttl_days * 24 * 60 * 60 if args.ttl_days is not None else None,
+        host_quotas=host_quotas,
+        max_bytes=parse_size(args.max_bytes) if args.max_bytes else None,
+    )
+    by_host = collections.defaultdict(collections.Counter)
+    for (host, _), size, _ in evicted:
+        by_host[host]["entries"] += 1
+        by_host[host]["bytes"] += size
+    for host, counts in sorted(by_host.items()):
+        LOG.info(f"{host}: {counts['entries']:,} entries, {counts['bytes']:,} bytes")
+    if not args.dry_run and evicted:
+        for key, _, _ in evicted:
+            store.delete(key)
+        store.vacuum()
+    store.close()
+    LOG.info(
+        f"{'Would evict' if args.dry_run else 'Evicted'} {len(evicted):,} entries, "
+        f"{sum(size for _, size, _ in evicted):,} bytes."
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Maintain the fetcher's on-disk cache.")
+    parser.add_argument(
+        "--cache_dir", type=str, help="the cache directory", default="cache"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser(
+        "migrate", help="copy the cache from one backend to another"
+    )
+    migrate_parser.add_argument(
+        "--from_backend",
+        choices=sorted(fetcher.STORES),
+        help="the backend to copy from",
+        default="directory",
+    )
+    migrate_parser.add_argument(
+        "--to_backend",
+        choices=sorted(fetcher.STORES),
+        help="the backend to copy to",
+        default="sqlite",
+    )
+    migrate_parser.set_defaults(main=main_migrate)
+
+    train_parser = subparsers.add_parser(
+        "train", help="train a compression dictionary on a host's responses"
+    )
+    train_parser.add_argument(
+        "--host", type=str, help="the host whose responses to sample", required=True
+    )
+    train_parser.add_argument(
+        "--samples", type=int, help="the number of responses to sample", default=1000
+    )
+    train_parser.add_argument(
+        "--size",
+        type=int,
+        help="the maximum size of the dictionary, in bytes",
+        default=32 * 1024,
+    )
+    train_parser.set_defaults(main=main_train)
+
+    compress_parser = subparsers.add_parser(
+        "compress", help="re-compress every response in the cache"
+    )
+    compress_parser.set_defaults(main=main_compress)
+
+    stats_parser = subparsers.add_parser(
+        "stats", help="report size, hit ratio and latency per host"
+    )
+    stats_parser.add_argument(
+        "--compression",
+        action="store_true",
+        help="also report compression ratio and decode cost",
+    )
+    stats_parser.add_argument(
+        "--host",
+        type=str,
+        help="with --compression, only sample responses from this host",
+        default=None,
+    )
+    stats_parser.add_argument(
+        "--samples",
+        type=int,
+        help="with --compression, the number of responses to sample; all by default",
+        default=None,
+    )
+    stats_parser.set_defaults(main=main_stats)
+
+    evict_parser = subparsers.add_parser(
+        "evict", help="evict old or least recently used responses"
+    )
+    evict_parser.add_argument(
+        "--ttl_days",
+        type=float,
+        help="evict responses that haven't been read in this many days",
+        default=None,
+    )
+    evict_parser.add_argument(
+        "--host_quota",
+        action="append",
+        help="host=size (e.g. 500M), to cap a host's responses; repeatable",
+        default=[],
+    )
+    evict_parser.add_argument(
+        "--max_bytes",
+        type=str,
+        help="size (e.g. 10G) to cap the whole cache at",
+        default=None,
+    )
+    evict_parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="report what would be evicted, without evicting it",
+    )
+    evict_parser.set_defaults(main=main_evict)
+
+    args = parser.parse_args()
+
+    log_file = __file__ + ".log"
+    configure_logging(log_file)
+
+    args.main(args)
@@ -0,0 +1,156 @@
+"""Resumable crawls over a list of URLs.
+
+A `CrawlJob` fetches a list of URLs with a fetcher, recording each URL's state
+in a checkpoint file as it goes. The checkpoint file is a log of lines
+
+    done<TAB>url
+    failed<TAB>url
+    retry<TAB>url
+
+where the last line for an URL wins, and any URL that isn't in it is pending.
+Re-running the same job with the same checkpoint file picks up exactly where
+the last run stopped, without walking the cache for URLs it already has.
+
+"failed" is for permanent failures, like a 404, and "retry" is for transient
+ones (connection errors, 5xx responses and so on; see
+`fetcher.TRANSIENT_STATUSES`) that were still failing after the fetcher's own
+retries. URLs in the "retry" state are pending again on the next run.
+
+To split one list across several machines, give each a different shard, e.g.
+`--shard 0/3`, `--shard 1/3` and `--shard 2/3`. URLs are assigned to shards by
+a hash of the URL, so every machine gets the same split of the same list.
+"""
+
+import contextlib
+import logging
+import os
+import time
+from zlib import crc32
+
+import requests
+from fetcher import TRANSIENT_STATUSES, fetch_or_error
+from utils.files import truncate_partial_line
+
+LOG = logging.getLogger(__name__)
+
+DONE = "done"
+FAILED = "failed"
+RETRY = "retry"
+
+
+def parse_shard(spec):
+    """Parse "i/n" into (i, n), for the i-th of n shards, counting from 0."""
+    index, count = (int(part) for part in spec.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(f"Bad shard: {spec}")
+    return index, count
+
+
+def in_shard(url, shard):
+    index, count = shard
+    return crc32(url.encode("utf8")) % count == index
+
+
+def is_permanent_failure(error):
+    """Is this error from a fetch one that retrying won't fix?"""
+    return (
+        isinstance(error, requests.exceptions.HTTPError)
+        and error.response is not None
+        and error.response.status_code not in TRANSIENT_STATUSES
+    )
+
+
+def load_checkpoint(path):
+    """Return {url: state} from a checkpoint file, if there is one."""
+    states = {}
+    if os.path.exists(path):
+        for line in open(path):
+            if not line.endswith("\n"):
+                break  # a partial write, from a crash
+            state, url = line.rstrip("\n").split("\t", 1)
+            states[url] = state
+    return states
+
+
+class CrawlJob(object):
+    """Fetches a list of URLs, checkpointing as it goes.
+
+    `fetcher` is a `fetcher.Fetcher` or `fetcher.ConcurrentFetcher`. With no
+    `checkpoint_path`, nothing is recorded, but progress is still reported.
+    With a shard, (i, n), only the URLs in the i-th of n shards are fetched.
+    URLs that failed permanently are skipped on later runs unless
+    `retry_failed` is set; ones that failed with a transient error are tried
+    again. With `revalidate`, cached URLs are checked with the server.
+    """
+
+    def __init__(
+        self,
+        urls,
+        checkpoint_path,
+        fetcher,
+        shard=None,
+        retry_failed=False,
+        revalidate=False,
+        report_secs=30.0,
+    ):
+        self._fetcher = fetcher
+        self._revalidate = revalidate
+        self._checkpoint_path = checkpoint_path
+        self._report_secs = report_secs
+
+        urls = list(dict.fromkeys(urls))  # dedupe, keeping the order
+        if shard:
+            urls = [url for url in urls if in_shard(url, shard)]
+        states = load_checkpoint(checkpoint_path) if checkpoint_path else {}
+        skip = {DONE, FAILED} if not retry_failed else {DONE}
+        self.total = len(urls)
+        self.pending = [url for url in urls if states.get(url) not in skip]
+        self.counts = {DONE: 0, FAILED: 0}
+
+    def _results(self):
+        if hasattr(self._fetcher, "fetch_urls"):
+            return self._fetcher.fetch_urls(self.pending, self._revalidate)
+        return (
+            fetch_or_error(self._fetcher, url, self._revalidate) for url in self.pending
+        )
+
+    def run(self):
+        """Fetch the pending URLs, yielding (url, contents, error) for each
+        one, in the order they finish."""
+        LOG.info(
+            f"{self.total - len(self.pending):,} of {self.total:,} URLs already "
+            f"done; {len(self.pending):,} to go"
+        )
+        start = last_report = time.monotonic()
+        if self._checkpoint_path:
+            truncate_partial_line(self._checkpoint_path)
+            checkpoint = open(self._checkpoint_path, "a")
+        else:
+            checkpoint = contextlib.nullcontext()
+        with checkpoint:
+            for url, contents, error in self._results():
+                self.counts[FAILED if error else DONE] += 1
+                state = DONE
+                if error:
+                    state = FAILED if is_permanent_failure(error) else RETRY
+                if self._checkpoint_path:
+                    checkpoint.write(f"{state}\t{url}\n")
+                    checkpoint.flush()
+                yield url, contents, error
+
+                now = time.monotonic()
+                if now - last_report >= self._report_secs:
+                    self._report(now - start)
+                    last_report = now
+        self._report(time.monotonic() - start)
+
+    def _report(self, elapsed):
+        finished = self.counts[DONE] + self.counts[FAILED]
+        remaining = len(self.pending) - finished
+        rate = finished / elapsed if elapsed else 0.0
+        eta = f"{remaining / rate / 60:.1f} min" if rate else "unknown"
+        LOG.info(
+            f"{finished:,}/{len(self.pending):,} URLs "
+            f"({self.counts[FAILED]:,} failed), "
+            f"{rate:.2f} URLs/sec, ETA {eta}"
+        )
@@ -6,24 +6,94 @@ Usage:
     ./fetch_archive_records.py list-of-ids.txt
 
 These can then be parsed into an ndjson file with parse_records.py.
+
+Progress is checkpointed (see crawl.py), so an interrupted run picks up where
+it left off. To split the list across machines, give each one a --shard.
+
+This starts at one fetch every --throttle_secs, and speeds up or backs off
+between --min_rate and --max_rate depending on how the archives server is
+coping, with up to --connections_per_host fetches at once (see
+`fetcher.AdaptiveThrottle`).
 """
 
+import argparse
 import fileinput
 
 import fetcher
+from crawl import CrawlJob, parse_shard
+from logging_configuration import configure_logging
 from toronto_archives import url_for_unique_id
 
 if __name__ == "__main__":
-    f = fetcher.Fetcher(throttle_secs=2.0)
-    any_uncached_fetches = False
-    for i, line in enumerate(fileinput.input()):
+    parser = argparse.ArgumentParser(
+        "Retrieve records from the Toronto Archives into the cache."
+    )
+    parser.add_argument("files", nargs="*", help="files listing IDs, one per line")
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        help="file to record progress in",
+        default="fetch_archive_records.checkpoint",
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        help="i/n, to fetch only the i-th of n shards of the IDs (from 0)",
+        default=None,
+    )
+    parser.add_argument(
+        "--throttle_secs",
+        type=float,
+        help="seconds between fetches to start at",
+        default=2.0,
+    )
+    parser.add_argument(
+        "--connections_per_host",
+        type=int,
+        help="most fetches to have in progress at once",
+        default=4,
+    )
+    parser.add_argument(
+        "--min_rate",
+        type=float,
+        help="the slowest to back off to, in fetches per second; "
+        "defaults to a tenth of the --throttle_secs rate",
+        default=None,
+    )
+    parser.add_argument(
+        "--max_rate",
+        type=float,
+        help="the fastest to speed up to, in fetches per second; "
+        "defaults to four times the --throttle_secs rate",
+        default=None,
+    )
+    parser.add_argument(
+        "--retry_failed",
+        action="store_true",
+        help="try the IDs that the checkpoint has as failed permanently again",
+    )
+    args = parser.parse_args()
+
+    configure_logging(__file__ + ".log")
+    f = fetcher.ConcurrentFetcher(
+        throttle_secs=args.throttle_secs,
+        connections_per_host=args.connections_per_host,
+        adaptive=True,
+        min_rate=args.min_rate,
+        max_rate=args.max_rate,
+    )
+    ids = {}
+    for line in fileinput.input(args.files):
         id_ = line.strip()
-        url = url_for_unique_id(id_)
-        in_cache = f.is_url_in_cache(url)
-        if in_cache and not any_uncached_fetches:
-            # Skip leading cached fetches to reduce logging verbosity.
+        ids[url_for_unique_id(id_)] = id_
+
+    shard = parse_shard(args.shard) if args.shard else None
+    job = CrawlJob(ids, args.checkpoint, f, shard=shard, retry_failed=args.retry_failed)
+    for i, (url, content, error) in enumerate(job.run()):
+        if error:
+            print("%5d Failed to fetch %s: %s (%s)" % (i + 1, ids[url], url, error))
             continue
-        print("%5d Fetching %s: %s" % (i + 1, id_, url))
-        any_uncached_fetches = True
-        content = f.fetch_url(url)
-        print("  %d bytes%s" % (len(content), " (cached)" if in_cache else ""))
+        print("%5d Fetched %s: %s" % (i + 1, ids[url], url))
+        print("  %d bytes" % len(content))
+    f.stats.log_summary()
+    f.close()
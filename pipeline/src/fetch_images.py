@@ -2,20 +2,23 @@
 """Download all the images referenced from an images.ndjson file.
 
 Usage: ./fetch_images.py images.ndjson
+
+Images are streamed straight to disk (see `fetcher.ConcurrentFetcher.
+download_url`), a few at a time; --workers sets how many.
 """
 
+import argparse
 import fileinput
 import json
 import os
 
 import fetcher
-import requests
+from logging_configuration import configure_logging
 
-if __name__ == "__main__":
-    f = fetcher.Fetcher()
-    os.makedirs("images", exist_ok=True)
 
-    for i, line in enumerate(fileinput.input()):
+def image_downloads(lines):
+    """Yield (url, path) for each image that isn't in images/ yet."""
+    for line in lines:
         image = json.loads(line)
         url = image.get("imageLink")
         if not url:
@@ -23,13 +26,33 @@ if __name__ == "__main__":
         path = os.path.join("images", os.path.basename(url))
         if os.path.exists(path):
             continue
-        try:
-            content = f.fetch_url(url)
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 404:
-                continue  # sadly, some images are just missing
-            raise
-
-        open(path, "wb").write(content)
-        if i > 0 and i % 20 == 0:
-            print("Fetched %d images" % i)
+        yield url, path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Download the images in an images.ndjson file.")
+    parser.add_argument("files", nargs="*", help="images.ndjson files")
+    parser.add_argument("--workers", type=int, help="concurrent downloads", default=4)
+    args = parser.parse_args()
+
+    configure_logging(__file__ + ".log")
+    f = fetcher.ConcurrentFetcher(connections_per_host=args.workers)
+    os.makedirs("images", exist_ok=True)
+
+    downloads = image_downloads(fileinput.input(args.files))
+    fetched = 0
+    # Errors other than those from requests are raised by download_urls().
+    for url, path, error in f.download_urls(downloads):
+        if error:
+            # Sadly, some images are just missing. The fetcher remembers
+            # which, and they're listed in the summary below.
+            if url not in f.stats.failures:
+                print("Failed to fetch %s: %s" % (url, error))
+            continue
+        fetched += 1
+        if fetched % 20 == 0:
+            print("Fetched %d images" % fetched)
+    print("Fetched %d images" % fetched)
+
+    f.stats.log_summary()
+    f.close()
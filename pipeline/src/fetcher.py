@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 """Fetch a bunch of URLs and store them permanently on-disk.
 
-This does rate-throttling.
+This does rate-throttling. `Fetcher` fetches one URL at a time, sleeping
+between fetches; `ConcurrentFetcher` fetches several at once, with a pooled
+session and an independent rate limit for each host, so that different hosts
+can be crawled in parallel, each at its own politeness level.
 
 The cache key is the URL. URLs are stored in a directory correspoding with their
 hostname and under their MD5 hash to avoid issues with escaping URLs in file names.
@@ -14,25 +17,57 @@ The storage format on disk is
     www.google.com/MD53
     ...
 
+Alternatively, with the "sqlite" backend, every response is stored in a single
+file, cache/cache.sqlite, which is much quicker to work with once there are
+hundreds of thousands of them. To move an existing cache over, see
+`cache_tool.py migrate`.
+
+Either way, responses are stored zlib-compressed, behind a short header (see
+`Codec`). Anything without the header is an uncompressed response from before
+this, and is read as-is. A zlib dictionary trained on sample pages (see
+`cache_tool.py train`) shrinks the highly repetitive archive pages further.
+
 Usage:
     ./fetcher.py path-to-list-of.urls.txt
+    ./fetcher.py --workers 4 --host_throttle_secs example.com=1.0 urls.txt
+    ./fetcher.py --checkpoint urls.checkpoint --shard 0/2 urls.txt
+    ./fetcher.py --revalidate urls.txt
+
+See crawl.py for --checkpoint and --shard.
 """
 
+import argparse
+import atexit
+import collections
+import concurrent.futures
+import fcntl
 import fileinput
+import functools
 import hashlib
 import io
+import itertools
 import json
 import logging
 import os
+import random
+import shutil
+import sqlite3
 import sys
+import tempfile
+import threading
 import time
 import urllib
+import zlib
 
 import requests
 from logging_configuration import configure_logging
 
 LOG = logging.getLogger(__name__)
 
+# geocode.py replaces requests.Session with CacheSession (below), so hold on
+# to the real one for the fetchers.
+_Session = requests.Session
+
 
 class NotInCacheError(Exception):
     pass
@@ -58,10 +93,11 @@ class CacheSession(requests.Session):
         url = request.url
         assert request.method == "GET"
         resp = None
-        if self._cache.is_url_in_cache(url):
+        contents = self._cache.get_or_none(url)
+        if contents is not None:
             LOG.debug(f"cache hit for url: {url}")
             resp = Response()
-            resp.contents = self._cache.fetch_url_from_cache(url)
+            resp.contents = contents
         else:
             LOG.debug(f"cache miss for url: {url}")
             resp = super(CacheSession, self).send(request, **kwargs)
@@ -69,81 +105,1031 @@ class CacheSession(requests.Session):
         return resp
 
 
-class Cache(object):
-    """Store get request responses, keyed by their url."""
+def _hash(url):
+    """Compute SHA1 checksum for the URL."""
+    return hashlib.sha1(url.encode("utf8")).hexdigest()
 
-    def __init__(self, cache_dir="cache"):
-        super(Cache, self).__init__()
+
+def _is_hash(name):
+    """Is this file name a hash, as opposed to metadata or a temporary file?"""
+    return len(name) == 40 and not name.startswith("tmp") and "." not in name
+
+
+def _remove_api_key_query_param(qp):
+    parsed = urllib.parse.parse_qsl(qp)
+    return [(k, v) for k, v in parsed if k != "key"]
+
+
+@functools.lru_cache(maxsize=64 * 1024)
+def cache_key(url):
+    """Returns the (host, hash) key of an URL, regardless of whether it's in
+    the cache. This is memoized, since callers tend to ask about the same URL
+    a few times in a row."""
+    parsed_url = urllib.parse.urlparse(url)
+    query_minus_api_key = urllib.parse.urlencode(
+        _remove_api_key_query_param(parsed_url.query)
+    )
+    url_transformed = urllib.parse.urlunparse(
+        (
+            parsed_url.scheme,
+            parsed_url.netloc,
+            parsed_url.path,
+            parsed_url.params,
+            query_minus_api_key,
+            parsed_url.fragment,
+        )
+    )
+    return parsed_url.netloc, _hash(url_transformed)
+
+
+# mkstemp makes files that only their owner can read. Files in the cache (and
+# downloads) should get the usual permissions instead.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _temp_file(directory):
+    """Like tempfile.mkstemp, but with the permissions that open() would give."""
+    fd, temp_path = tempfile.mkstemp(dir=directory or ".")
+    os.fchmod(fd, 0o666 & ~_UMASK)
+    return fd, temp_path
+
+
+# Like the relatime mount option: a cached response's access time is only
+# updated when it's read if it's older than this, to save on writes.
+RELATIME_SECS = 24 * 60 * 60
+
+
+def _link_or_copy(source, destination):
+    """Hard link (or, failing that, copy) a file into place, atomically."""
+    directory = os.path.dirname(destination) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = _temp_file(directory)
+    os.close(fd)
+    os.unlink(temp_path)
+    try:
+        os.link(source, temp_path)
+    except OSError:  # e.g. they're on different filesystems
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, destination)
+
+
+class DirectoryStore(object):
+    """Stores each response as its own file, under cache_dir/host/hash.
+
+    This is the original layout. It also appends every URL that it stores to
+    cache_dir/urls.txt. Metadata, if any, goes in cache_dir/host/hash.meta.
+    Sizes and access times are the files'.
+    """
+
+    def __init__(self, cache_dir):
         self._cache_dir = cache_dir
-        os.makedirs(self._cache_dir, exist_ok=True)
         self._urls_file = os.path.join(self._cache_dir, "urls.txt")
+        self._urls_file_lock = threading.Lock()
+
+    def _path(self, key):
+        host, hash_ = key
+        return os.path.join(self._cache_dir, host, hash_)
+
+    def get(self, key, touch=True):
+        """Return the contents stored under a key, or None. With `touch`, this
+        counts as an access."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                contents = f.read()
+        except FileNotFoundError:
+            return None
+        # The filesystem may not keep access times (noatime), so keep them.
+        # (Or it may keep them when we don't want it to.)
+        now = time.time()
+        if not touch:
+            os.utime(path, (stat.st_atime, stat.st_mtime))
+        elif now - stat.st_atime > RELATIME_SECS:
+            os.utime(path, (now, stat.st_mtime))
+        return contents
+
+    def contains(self, key):
+        return os.path.exists(self._path(key))
+
+    def put(self, key, url, contents):
+        self.update(key, contents)
+        self._record_url(url)
+
+    def put_file(self, key, url, path):
+        """Store the contents of a file, by hard linking it into place."""
+        _link_or_copy(path, self._path(key))
+        self._record_url(url)
 
-    def _cache_path(self, url):
-        """Returns path to the cached version of an URL, regardless of whether
-        it exists."""
-        parsed_url = urllib.parse.urlparse(url)
-        dir_path = os.path.join(self._cache_dir, parsed_url.netloc)
-        query_minus_api_key = urllib.parse.urlencode(
-            self._remove_api_key_query_param(parsed_url.query)
+    def file_path(self, key):
+        """Return the path to the file that a key's contents are in, if any."""
+        path = self._path(key)
+        return path if os.path.exists(path) else None
+
+    def _record_url(self, url):
+        with self._urls_file_lock:
+            with open(self._urls_file, "a") as f:
+                f.write("%s\t%s\n" % (_hash(url), url))
+
+    def update(self, key, contents):
+        """Replace the contents stored under a key, without recording a URL."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and then move it into place, so that
+        # concurrent readers never see a partial file.
+        fd, temp_path = _temp_file(os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(contents)
+        os.replace(temp_path, path)
+
+    def set_atime(self, key, atime):
+        path = self._path(key)
+        os.utime(path, (atime, os.stat(path).st_mtime))
+
+    def get_meta(self, key):
+        try:
+            with open(self._path(key) + ".meta") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put_meta(self, key, meta):
+        """Store a dict of metadata about a key, or delete it if it's None."""
+        if meta is None:
+            try:
+                os.unlink(self._path(key) + ".meta")
+            except FileNotFoundError:
+                pass
+            return
+        path = self._path(key) + ".meta"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = _temp_file(os.path.dirname(path))
+        with os.fdopen(fd, "w") as f:
+            json.dump(meta, f)
+        os.replace(temp_path, path)
+
+    def delete(self, key):
+        # Note: we leave the URL in cache/urls.txt. It's harmless there.
+        for path in (self._path(key), self._path(key) + ".meta"):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def keys(self):
+        """Yield the key of every stored response."""
+        for host in os.scandir(self._cache_dir):
+            if not host.is_dir():
+                continue
+            for entry in os.scandir(host.path):
+                if entry.is_file() and _is_hash(entry.name):
+                    yield host.name, entry.name
+
+    def entries(self):
+        """Yield (key, size in bytes, access time) for every stored response."""
+        for host in os.scandir(self._cache_dir):
+            if not host.is_dir():
+                continue
+            for entry in os.scandir(host.path):
+                if entry.is_file() and _is_hash(entry.name):
+                    stat = entry.stat()
+                    yield (host.name, entry.name), stat.st_size, stat.st_atime
+
+    def meta_keys(self):
+        """Yield the key of everything with metadata, whether or not it has a
+        stored response (a failure doesn't)."""
+        for host in os.scandir(self._cache_dir):
+            if not host.is_dir():
+                continue
+            for entry in os.scandir(host.path):
+                name = entry.name
+                if name.endswith(".meta") and _is_hash(name[: -len(".meta")]):
+                    yield host.name, name[: -len(".meta")]
+
+    def meta_entries(self):
+        """Yield (key, size in bytes, time it was written) for everything with
+        metadata but no stored response, e.g. failures."""
+        for key in self.meta_keys():
+            if not self.contains(key):
+                stat = os.stat(self._path(key) + ".meta")
+                yield key, stat.st_size, stat.st_mtime
+
+    def key_set(self, hosts):
+        """Return the set of stored keys from these hosts."""
+        keys = set()
+        for host in hosts:
+            try:
+                entries = os.scandir(os.path.join(self._cache_dir, host))
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if _is_hash(entry.name):
+                        keys.add((host, entry.name))
+        return keys
+
+    def flush(self):
+        pass
+
+    def vacuum(self):
+        """Files are freed as soon as they're deleted."""
+
+    def close(self):
+        pass
+
+
+class SqliteStore(object):
+    """Stores every response in a single SQLite file, cache_dir/cache.sqlite.
+
+    Metadata goes in a separate table, and access times in their own column
+    (older files may not have them). Writes are committed in batches, every
+    `commit_every` stores or `commit_secs` seconds, whichever comes first, and
+    on `flush()` or `close()`. (Uncommitted writes are visible to this
+    process, just not to others.) It's safe to use from several threads.
+    """
+
+    FILENAME = "cache.sqlite"
+
+    def __init__(self, cache_dir, commit_every=100, commit_secs=5.0):
+        self._commit_every = commit_every
+        self._commit_secs = commit_secs
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(
+            os.path.join(cache_dir, self.FILENAME), check_same_thread=False
         )
-        url_transformed = urllib.parse.urlunparse(
-            (
-                parsed_url.scheme,
-                parsed_url.netloc,
-                parsed_url.path,
-                parsed_url.params,
-                query_minus_api_key,
-                parsed_url.fragment,
-            )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                host TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                url TEXT NOT NULL,
+                contents BLOB NOT NULL,
+                PRIMARY KEY (host, hash)
+            )"""
+        )
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(responses)")]
+        if "atime" not in columns:
+            self._db.execute("ALTER TABLE responses ADD COLUMN atime REAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS meta (
+                host TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                meta TEXT NOT NULL,
+                PRIMARY KEY (host, hash)
+            )"""
         )
-        return os.path.join(dir_path, self._hash(url_transformed))
+        self._db.commit()
+        atexit.register(self.close)
+
+    def get(self, key, touch=True):
+        """Return the contents stored under a key, or None. With `touch`, this
+        counts as an access."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT contents, atime FROM responses WHERE host = ? AND hash = ?",
+                key,
+            ).fetchone()
+            if not row:
+                return None
+            contents, atime = row
+            now = time.time()
+            if touch and now - (atime or 0) > RELATIME_SECS:
+                self._db.execute(
+                    "UPDATE responses SET atime = ? WHERE host = ? AND hash = ?",
+                    (now, *key),
+                )
+                self._wrote()
+        return contents
+
+    def contains(self, key):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM responses WHERE host = ? AND hash = ?", key
+            ).fetchone()
+        return row is not None
+
+    def put(self, key, url, contents):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (*key, url, contents, time.time()),
+            )
+            self._wrote()
 
-    def _hash(self, url):
-        """Compute SHA1 checksum for the URL."""
-        return hashlib.sha1(url.encode("utf8")).hexdigest()
+    def put_file(self, key, url, path):
+        """Store the contents of a file, a chunk at a time where SQLite allows
+        it (Python 3.11+)."""
+        if not hasattr(self._db, "blobopen"):
+            with open(path, "rb") as f:
+                self.put(key, url, f.read())
+            return
+        with self._lock:
+            rowid = self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, zeroblob(?), ?)",
+                (*key, url, os.path.getsize(path), time.time()),
+            ).lastrowid
+            with open(path, "rb") as f, self._db.blobopen(
+                "responses", "contents", rowid
+            ) as blob:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                    blob.write(chunk)
+            self._wrote()
 
-    def _remove_api_key_query_param(self, qp):
-        parsed = urllib.parse.parse_qsl(qp)
-        return [(k, v) for k, v in parsed if k != "key"]
+    def file_path(self, key):
+        """Contents aren't stored in their own files."""
+        return None
+
+    def update(self, key, contents):
+        """Replace the contents stored under a key, keeping its URL."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE responses SET contents = ? WHERE host = ? AND hash = ?",
+                (contents, *key),
+            )
+            self._wrote()
+
+    def set_atime(self, key, atime):
+        with self._lock:
+            self._db.execute(
+                "UPDATE responses SET atime = ? WHERE host = ? AND hash = ?",
+                (atime, *key),
+            )
+            self._wrote()
+
+    def get_meta(self, key):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT meta FROM meta WHERE host = ? AND hash = ?", key
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_meta(self, key, meta):
+        """Store a dict of metadata about a key, or delete it if it's None."""
+        with self._lock:
+            if meta is None:
+                self._db.execute("DELETE FROM meta WHERE host = ? AND hash = ?", key)
+            else:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?, ?)",
+                    (*key, json.dumps(meta)),
+                )
+            self._wrote()
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute("DELETE FROM responses WHERE host = ? AND hash = ?", key)
+            self._db.execute("DELETE FROM meta WHERE host = ? AND hash = ?", key)
+            self._wrote()
+
+    def keys(self):
+        """Yield the key of every stored response."""
+        with self._lock:
+            rows = self._db.execute("SELECT host, hash FROM responses").fetchall()
+        yield from rows
+
+    def entries(self):
+        """Yield (key, size in bytes, access time) for every stored response."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT host, hash, length(contents), atime FROM responses"
+            ).fetchall()
+        for host, hash_, size, atime in rows:
+            yield (host, hash_), size, atime or 0.0
+
+    def meta_keys(self):
+        """Yield the key of everything with metadata, whether or not it has a
+        stored response (a failure doesn't)."""
+        with self._lock:
+            rows = self._db.execute("SELECT host, hash FROM meta").fetchall()
+        yield from rows
+
+    def meta_entries(self):
+        """Yield (key, size in bytes, time it was written) for everything with
+        metadata but no stored response, e.g. failures."""
+        with self._lock:
+            rows = self._db.execute(
+                """SELECT host, hash, length(meta), meta FROM meta
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM responses
+                    WHERE responses.host = meta.host AND responses.hash = meta.hash
+                )"""
+            ).fetchall()
+        for host, hash_, size, meta in rows:
+            yield (host, hash_), size, json.loads(meta).get("timestamp", 0.0)
+
+    def key_set(self, hosts):
+        """Return the set of stored keys from these hosts."""
+        keys = set()
+        with self._lock:
+            for host in hosts:
+                rows = self._db.execute(
+                    "SELECT host, hash FROM responses WHERE host = ?", (host,)
+                )
+                keys.update(rows)
+        return keys
+
+    def _wrote(self):
+        self._uncommitted += 1
+        if (
+            self._uncommitted >= self._commit_every
+            or time.monotonic() - self._last_commit >= self._commit_secs
+        ):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._db is None:
+                return
+            self._db.commit()
+            self._uncommitted = 0
+            self._last_commit = time.monotonic()
+
+    def vacuum(self):
+        """Shrink the file after deleting from it. SQLite reuses the space
+        that deleted rows leave, but doesn't give it back on its own."""
+        with self._lock:
+            self.flush()
+            self._db.execute("VACUUM")
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        with self._lock:
+            if self._db is None:
+                return
+            self.flush()
+            self._db.close()
+            self._db = None
+        atexit.unregister(self.close)
+
+
+# The cache backends, by name.
+STORES = {
+    "directory": DirectoryStore,
+    "sqlite": SqliteStore,
+}
+
+
+def open_store(cache_dir, backend=None):
+    """Open the named backend in cache_dir.
+
+    With no backend, use SQLite if cache_dir has a SQLite file, and the
+    directory layout otherwise.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    if backend is None:
+        if os.path.exists(os.path.join(cache_dir, SqliteStore.FILENAME)):
+            backend = "sqlite"
+        else:
+            backend = "directory"
+    return STORES[backend](cache_dir)
+
+
+class Codec(object):
+    """Compresses and decompresses cached responses.
+
+    A compressed response is MAGIC, then a format byte, then (for ZLIB_DICT)
+    the 4-byte ID of the dictionary, then the zlib stream. Responses that
+    don't compress well, like JPEGs, are stored as RAW.
+
+    Dictionaries live in cache_dir/zdict.<ID>; the one named in
+    cache_dir/zdict.current is used for new responses. Old ones are kept so
+    that the responses compressed with them can still be read.
+    """
+
+    MAGIC = b"\x1fOTC"
+    RAW = 0
+    ZLIB = 1
+    ZLIB_DICT = 2
+
+    # Store a response compressed only if it's at most this much of its size.
+    MAX_RATIO = 0.9
+
+    def __init__(self, cache_dir, compress=True, level=6):
+        self._compress = compress
+        self._level = level
+        self._zdicts = {}
+        self._zdict_id = None
+        for entry in os.scandir(cache_dir):
+            if not entry.name.startswith("zdict."):
+                continue
+            name = entry.name[len("zdict.") :]
+            if name == "current":
+                self._zdict_id = bytes.fromhex(open(entry.path).read().strip())
+            else:
+                self._zdicts[bytes.fromhex(name)] = open(entry.path, "rb").read()
+
+    def encode(self, contents):
+        if not self._compress:
+            if contents.startswith(self.MAGIC):
+                return self.MAGIC + bytes([self.RAW]) + contents
+            return contents
+        if self._zdict_id:
+            compressor = zlib.compressobj(
+                self._level, zdict=self._zdicts[self._zdict_id]
+            )
+            header = self.MAGIC + bytes([self.ZLIB_DICT]) + self._zdict_id
+        else:
+            compressor = zlib.compressobj(self._level)
+            header = self.MAGIC + bytes([self.ZLIB])
+        data = compressor.compress(contents) + compressor.flush()
+        if len(header) + len(data) > len(contents) * self.MAX_RATIO:
+            return self.MAGIC + bytes([self.RAW]) + contents
+        return header + data
+
+    def decode(self, data):
+        if not data.startswith(self.MAGIC):
+            return data
+        format_ = data[len(self.MAGIC)]
+        data = memoryview(data)[len(self.MAGIC) + 1 :]
+        if format_ == self.RAW:
+            return bytes(data)
+        if format_ == self.ZLIB:
+            return zlib.decompress(data)
+        if format_ == self.ZLIB_DICT:
+            zdict_id = bytes(data[:4])
+            decompressor = zlib.decompressobj(zdict=self._zdicts[zdict_id])
+            return decompressor.decompress(data[4:]) + decompressor.flush()
+        raise ValueError(f"Unknown cache format: {format_}")
+
+
+def train_zdict(samples, size=32 * 1024):
+    """Build a zlib dictionary from sample responses.
+
+    zlib can only refer back 32 KiB, and a dictionary is just text that's
+    notionally in front of every response, so the best one is the text that
+    the most responses have in common, with the most common last (where it's
+    cheapest to refer to). This uses the lines that at least half of the
+    samples share.
+    """
+    counts = collections.Counter()
+    for sample in samples:
+        counts.update(set(sample.splitlines(keepends=True)))
+    common = [
+        line
+        for line, count in counts.most_common()
+        if count * 2 >= len(samples) and line.strip()
+    ]
+    zdict = b""
+    for line in common:
+        if len(zdict) + len(line) > size:
+            break
+        zdict = line + zdict
+    return zdict
+
+
+def save_zdict(cache_dir, zdict):
+    """Save a dictionary and use it to compress new responses. Returns its ID."""
+    zdict_id = zlib.crc32(zdict).to_bytes(4, "big")
+    open(os.path.join(cache_dir, f"zdict.{zdict_id.hex()}"), "wb").write(zdict)
+    open(os.path.join(cache_dir, "zdict.current"), "w").write(zdict_id.hex())
+    return zdict_id
+
+
+# The response validators that the cache keeps, by the headers they come from.
+VALIDATORS = {"etag": "ETag", "last_modified": "Last-Modified"}
+
+# ...and the conditional request headers they go in.
+CONDITIONAL_HEADERS = {"etag": "If-None-Match", "last_modified": "If-Modified-Since"}
+
+
+class HostStats(object):
+    """Per-host counts of cache hits and misses, and of fetches and how long
+    they took, kept in cache_dir/host_stats.json.
+
+    Counts are kept in memory, and added to the file by `save()`. Thread-safe,
+    and several processes can save to the same file.
+    """
+
+    FILENAME = "host_stats.json"
+
+    def __init__(self, cache_dir):
+        self._path = os.path.join(cache_dir, self.FILENAME)
+        self._counts = collections.defaultdict(collections.Counter)
+        self._lock = threading.Lock()
+
+    def count(self, host, name, n=1):
+        with self._lock:
+            self._counts[host][name] += n
+
+    def _read(self):
+        totals = collections.defaultdict(collections.Counter)
+        if os.path.exists(self._path):
+            for host, counts in json.load(open(self._path)).items():
+                totals[host].update(counts)
+        return totals
+
+    def load(self):
+        """Return {host: {"hits", "misses", "fetches", "fetch_secs"}} from the
+        file, plus whatever hasn't been saved yet."""
+        totals = self._read()
+        with self._lock:
+            for host, counts in self._counts.items():
+                totals[host].update(counts)
+        return totals
+
+    def save(self):
+        with self._lock:
+            counts = self._counts
+            self._counts = collections.defaultdict(collections.Counter)
+        if not counts:
+            return
+        # Hold a lock from reading the file to replacing it, so that another
+        # process's counts can't be lost in between.
+        with open(self._path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            totals = self._read()
+            for host, host_counts in counts.items():
+                totals[host].update(host_counts)
+            fd, temp_path = _temp_file(os.path.dirname(self._path))
+            with os.fdopen(fd, "w") as f:
+                json.dump(totals, f, indent=2, sort_keys=True)
+            os.replace(temp_path, self._path)
+
+
+class Cache(object):
+    """Store get request responses, keyed by their url.
+
+    The responses go in a backend store (see `STORES`); `backend` picks one by
+    name, or see `open_store` for the default. They're compressed unless
+    `compress` is False (see `Codec`).
+    """
+
+    def __init__(self, cache_dir="cache", backend=None, compress=True):
+        super(Cache, self).__init__()
+        self._cache_dir = cache_dir
+        self._store = open_store(cache_dir, backend)
+        self._codec = Codec(cache_dir, compress)
+        self.host_stats = HostStats(cache_dir)
+        atexit.register(self.host_stats.save)
 
     def fetch_url_from_cache(self, url):
-        path = self._cache_path(url)
-        if not os.path.exists(path):
+        contents = self.get_or_none(url)
+        if contents is None:
             raise NotInCacheError()
-        return open(path, "rb").read()
+        return contents
+
+    def get_or_none(self, url):
+        """Return the cached response for an URL, or None if there isn't one.
+
+        This is one read, rather than the two of `is_url_in_cache` and then
+        `fetch_url_from_cache`."""
+        key = cache_key(url)
+        data = self._store.get(key)
+        if data is None:
+            self.host_stats.count(key[0], "misses")
+            return None
+        self.host_stats.count(key[0], "hits")
+        return self._codec.decode(data)
+
+    def lookup_many(self, urls):
+        """Yield (url, cached response or None) for each of the URLs, in order.
+
+        This lists what's in the cache once, up front, so that URLs that aren't
+        in it cost nothing to look up."""
+        urls = list(urls)
+        keys = [cache_key(url) for url in urls]
+        stored = self._store.key_set({host for host, _ in keys})
+        for url, key in zip(urls, keys):
+            data = self._store.get(key) if key in stored else None
+            if data is None:
+                self.host_stats.count(key[0], "misses")
+                yield url, None
+                continue
+            self.host_stats.count(key[0], "hits")
+            yield url, self._codec.decode(data)
 
     def is_url_in_cache(self, url):
-        return os.path.exists(self._cache_path(url))
+        return self._store.contains(cache_key(url))
 
-    def store_url_in_cache(self, url, contents):
-        path = self._cache_path(url)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        open(path, "wb").write(contents)
-        open(self._urls_file, "a").write("%s\t%s\n" % (self._hash(url), url))
+    def store_url_in_cache(self, url, contents, validators=None):
+        """Store a response, along with its validators ({"etag",
+        "last_modified"}), if it had any."""
+        key = cache_key(url)
+        self._store.put(key, url, self._codec.encode(contents))
+        self._store_validators(key, validators)
+
+    def store_file_in_cache(self, url, path, validators=None):
+        """Store a response that's in a file, uncompressed. (With the directory
+        backend, the file is hard linked into the cache.)"""
+        with open(path, "rb") as f:
+            looks_encoded = f.read(len(Codec.MAGIC)) == Codec.MAGIC
+        key = cache_key(url)
+        if looks_encoded:
+            # This needs a header to be read back correctly; see `Codec`.
+            with open(path, "rb") as f:
+                contents = Codec.MAGIC + bytes([Codec.RAW]) + f.read()
+            self._store.put(key, url, contents)
+        else:
+            self._store.put_file(key, url, path)
+        self._store_validators(key, validators)
+
+    def _store_validators(self, key, validators):
+        if validators:
+            self._store.put_meta(key, {"timestamp": time.time(), **validators})
+        elif self._store.get_meta(key):
+            self._store.put_meta(key, None)
+
+    def export(self, url, path):
+        """Write the cached response for an URL to a file. Returns False if
+        there isn't one.
+
+        With the directory backend, an uncompressed response is hard linked
+        rather than copied."""
+        key = cache_key(url)
+        file_path = self._store.file_path(key)
+        if file_path:
+            with open(file_path, "rb") as f:
+                encoded = f.read(len(Codec.MAGIC)) == Codec.MAGIC
+            if not encoded:
+                _link_or_copy(file_path, path)
+                return True
+        contents = self.get_or_none(url)
+        if contents is None:
+            return False
+        fd, temp_path = _temp_file(os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(contents)
+        os.replace(temp_path, path)
+        return True
+
+    def get_validators(self, url):
+        """Return {"etag", "last_modified"} (either may be missing) for a
+        cached response, or None if it had no validators."""
+        meta = self._store.get_meta(cache_key(url)) or {}
+        validators = {k: meta[k] for k in VALIDATORS if k in meta}
+        return validators or None
+
+    def touch(self, url):
+        """Record that a cached response was found to be up-to-date."""
+        key = cache_key(url)
+        meta = self._store.get_meta(key) or {}
+        meta["timestamp"] = time.time()
+        meta.pop("attempts", None)
+        meta.pop("status", None)
+        self._store.put_meta(key, meta)
+
+    def get_failure(self, url):
+        """Return {"status", "timestamp", "attempts"} for an URL that failed to
+        fetch, or None if it hasn't."""
+        meta = self._store.get_meta(cache_key(url))
+        return meta if meta and "attempts" in meta else None
+
+    def record_failure(self, url, status):
+        """Record that fetching an URL failed, with this HTTP status (or 0 for
+        a connection error). Returns the updated failure record."""
+        key = cache_key(url)
+        failure = self._store.get_meta(key) or {}
+        failure.setdefault("attempts", 0)
+        failure["status"] = status
+        failure["timestamp"] = time.time()
+        failure["attempts"] += 1
+        self._store.put_meta(key, failure)
+        return failure
 
     def remove_url_from_cache(self, url):
-        # Note: we leave the URL in cache/urls.txt. It's harmless there.
-        path = self._cache_path(url)
-        if os.path.exists(path):
-            os.unlink(path)
+        self._store.delete(cache_key(url))
+
+    def record_fetch(self, url, secs):
+        """Record that fetching an URL took this long (to the response headers)."""
+        host = cache_key(url)[0]
+        self.host_stats.count(host, "fetches")
+        self.host_stats.count(host, "fetch_secs", secs)
+
+    def close(self):
+        self.host_stats.save()
+        atexit.unregister(self.host_stats.save)
+        self._store.close()
+
+
+# HTTP statuses that are worth retrying. Anything else is a permanent failure.
+TRANSIENT_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+# The size of each chunk when streaming a download to disk.
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# How long to wait before asking for an URL that failed permanently again.
+RECHECK_SECS = 30 * 24 * 60 * 60
+
+
+class CrawlStats(object):
+    """Counts what a fetcher did, for a summary at the end of a crawl.
+    Thread-safe."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.failures = {}  # url -> status, for permanent failures
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def failed(self, url, status):
+        with self._lock:
+            self.counts["failed"] += 1
+            self.failures[url] = status
+
+    def log_summary(self):
+        LOG.info(
+            "Crawl summary: "
+            + (
+                ", ".join(f"{n:,} {name}" for name, n in sorted(self.counts.items()))
+                or "nothing to do"
+            )
+        )
+        by_status = collections.Counter(self.failures.values())
+        for status, n in sorted(by_status.items()):
+            LOG.info(f"  {n:,} failed with status {status or 'connection error'}")
+        for url, status in sorted(self.failures.items()):
+            LOG.debug(f"  {status} {url}")
+
+
+class IncompleteDownloadError(requests.exceptions.ConnectionError):
+    """A response was shorter than its Content-Length said it would be."""
+
 
+def _validators(response):
+    """Return the validators (see `VALIDATORS`) that a response came with."""
+    return {
+        k: response.headers[header]
+        for k, header in VALIDATORS.items()
+        if header in response.headers
+    }
 
-class Fetcher(object):
-    """Provides throttling on top of the cache object."""
 
-    def __init__(self, throttle_secs=3.0, cache_dir="cache"):
-        self._cache = Cache(cache_dir)
+def _failure_error(url, status):
+    """An HTTPError for a failure that we're not going to retry."""
+    response = requests.Response()
+    response.status_code = status
+    response.url = url
+    return requests.exceptions.HTTPError(
+        f"{status} (known failure) for url: {url}", response=response
+    )
+
+
+class _Retrying(object):
+    """Fetching with negative caching and retries, for the fetchers below.
+
+    Subclasses implement `_get(url, headers, stream)`, which makes one
+    throttled request.
+
+    When a fetch fails with a transient error (a connection error or one of
+    TRANSIENT_STATUSES), it's retried up to `retries` times, with jittered
+    exponential backoff starting at `backoff_secs`. Failures that stick are
+    recorded in the cache. An URL that failed permanently isn't asked for
+    again until `recheck_secs` have passed (or ever, if that's None); asking
+    for it raises an HTTPError right away.
+
+    Revalidating a cached response sends a conditional request with its
+    validators, if it has any. A 304 Not Modified just updates its timestamp.
+    """
+
+    def _init_retrying(self, retries, backoff_secs, recheck_secs):
+        self._retries = retries
+        self._backoff_secs = backoff_secs
+        self._recheck_secs = recheck_secs
+        self.stats = CrawlStats()
+
+    def _is_known_failure(self, failure):
+        if failure["status"] in TRANSIENT_STATUSES or not failure["status"]:
+            return False
+        if self._recheck_secs is None:
+            return True
+        return time.time() - failure["timestamp"] < self._recheck_secs
+
+    def _with_retries(self, url, attempt):
+        """Call attempt(), which makes one request for the URL, retrying and
+        recording failures as described above. Returns what it returns."""
+        failure = self._cache.get_failure(url)
+        if failure and self._is_known_failure(failure):
+            self.stats.count("known failures")
+            raise _failure_error(url, failure["status"])
+
+        for n in range(self._retries + 1):
+            try:
+                return attempt()
+            except requests.exceptions.HTTPError as e:
+                error, status = e, e.response.status_code
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout,
+            ) as e:
+                error, status = e, 0
+
+            if status and status not in TRANSIENT_STATUSES:
+                break
+            if n < self._retries:
+                delay = self._backoff_secs * 2**n * random.uniform(0.5, 1.5)
+                LOG.warning(f"{error}; retrying in {delay:.1f} secs")
+                self.stats.count("retries")
+                time.sleep(delay)
+
+        self._cache.record_failure(url, status)
+        self.stats.failed(url, status)
+        raise error
+
+    def _fetch(self, url, cached=None):
+        """Fetch an URL. If `cached` is its cached response, revalidate it."""
+        headers = {}
+        if cached is not None:
+            validators = self._cache.get_validators(url) or {}
+            headers = {CONDITIONAL_HEADERS[k]: v for k, v in validators.items()}
+
+        def attempt():
+            response = self._get(url, headers)
+            response.raise_for_status()  # checks for status == 200 OK
+            if response.status_code == 304 and cached is not None:
+                self._cache.touch(url)
+                self.stats.count("not modified")
+                return cached
+            contents = response.content
+            self._cache.store_url_in_cache(url, contents, _validators(response))
+            self.stats.count("refetched" if cached is not None else "fetched")
+            return contents
+
+        return self._with_retries(url, attempt)
+
+    def download_url(self, url, path):
+        """Fetch an URL into a file, from the cache if possible.
+
+        Unlike `fetch_url`, this never holds the whole response in memory: it
+        streams it to a temporary file, checks that it got all of it, and then
+        moves that into place. With the directory backend, the file and the
+        cache share it (via a hard link), so it's only written once. This is
+        meant for large, incompressible responses, like images, so it doesn't
+        compress them in the cache.
+        """
+        if self._cache.export(url, path):
+            self.stats.count("cached")
+            return
+
+        def attempt():
+            with self._get(url, {}, stream=True) as response:
+                response.raise_for_status()  # checks for status == 200 OK
+                fd, temp_path = _temp_file(os.path.dirname(path))
+                try:
+                    size = 0
+                    with os.fdopen(fd, "wb") as f:
+                        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+                            size += len(chunk)
+                    expected = response.headers.get("Content-Length")
+                    if expected is not None and int(expected) != size:
+                        raise IncompleteDownloadError(
+                            f"Got {size:,} of {int(expected):,} bytes for url: {url}"
+                        )
+                    self._cache.store_file_in_cache(
+                        url, temp_path, _validators(response)
+                    )
+                    os.replace(temp_path, path)
+                finally:
+                    if os.path.exists(temp_path):
+                        os.unlink(temp_path)
+            self.stats.count("fetched")
+
+        self._with_retries(url, attempt)
+
+
+class Fetcher(_Retrying):
+    """Provides throttling, retries and negative caching on top of the cache
+    object. See `_Retrying` for the last two."""
+
+    def __init__(
+        self,
+        throttle_secs=3.0,
+        cache_dir="cache",
+        backend=None,
+        retries=3,
+        backoff_secs=5.0,
+        recheck_secs=RECHECK_SECS,
+    ):
+        self._cache = Cache(cache_dir, backend)
         self._throttle_secs = throttle_secs
         self._last_fetch = 0.0
+        self._session = _Session()
+        self._init_retrying(retries, backoff_secs, recheck_secs)
 
-    def fetch_url(self, url, force_refetch=False):
+    def fetch_url(self, url, force_refetch=False, revalidate=False):
+        """Fetch an URL, from the cache if possible.
+
+        With force_refetch, the cached response is thrown away first. With
+        revalidate, it's kept, but checked with the server (see `_Retrying`).
+        """
         if force_refetch:
             self._cache.remove_url_from_cache(url)
-        try:
-            return self._cache.fetch_url_from_cache(url)
-        except NotInCacheError:
-            pass
+        contents = self._cache.get_or_none(url)
+        if contents is not None and revalidate:
+            return self._fetch(url, contents)
+        if contents is not None:
+            self.stats.count("cached")
+            return contents
+        return self._fetch(url)
 
+    def _get(self, url, headers, stream=False):
         t = time.time()
         if t - self._last_fetch < self._throttle_secs:
             wait_s = self._throttle_secs - (t - self._last_fetch)
@@ -152,12 +1138,9 @@ class Fetcher(object):
 
         print("Fetching %s..." % url)
         self._last_fetch = time.time()
-        response = requests.get(url)
-        response.raise_for_status()  # checks for status == 200 OK
-
-        contents = response.content
-        self._cache.store_url_in_cache(url, contents)
-        return contents
+        response = self._session.get(url, headers=headers, stream=stream)
+        self._cache.record_fetch(url, time.time() - self._last_fetch)
+        return response
 
     def is_url_in_cache(self, url):
         return self._cache.is_url_in_cache(url)
@@ -165,25 +1148,505 @@ class Fetcher(object):
     def fetch_url_from_cache(self, url):
         return self._cache.fetch_url_from_cache(url)
 
+    def get_or_none(self, url):
+        return self._cache.get_or_none(url)
+
+    def lookup_many(self, urls):
+        return self._cache.lookup_many(urls)
+
     def remove_url_from_cache(self, url):
         # Note: we leave the URL in cache/urls.txt. It's harmless there.
         self._cache.remove_url_from_cache(url)
 
+    def close(self):
+        self._session.close()
+        self._cache.close()
+
+
+class TokenBucket(object):
+    """Allows `rate` acquisitions per second, on average, in bursts of up to
+    `capacity`. Thread-safe."""
+
+    def __init__(self, rate, capacity=1.0):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._capacity, self._tokens + (now - self._updated) * self._rate
+                )
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait_s = (1.0 - self._tokens) / self._rate
+            time.sleep(wait_s)
+
+    def release(self, secs, status):
+        """Nothing to do; this is for compatibility with AdaptiveThrottle."""
+
+
+class AdaptiveThrottle(object):
+    """A rate and concurrency limit for one host that adapts to how the host
+    is coping, AIMD-style, like TCP congestion control.
+
+    Every `window` requests in a row that come back OK within
+    `target_latency_secs` add `rate_step` to the rate and one to the
+    concurrency. A 429, a 5xx, a connection error or a response that takes
+    more than twice the target multiplies both by `decrease_factor`, at most
+    once every `cooldown_secs` (so that one burst of errors doesn't cut them
+    to the bone). Both stay within their bounds. Thread-safe.
+
+    Call `acquire()` before each request and `release()` after it.
+    """
+
+    def __init__(
+        self,
+        host,
+        rate,
+        min_rate,
+        max_rate,
+        max_concurrency,
+        target_latency_secs=1.0,
+        rate_step=0.1,
+        decrease_factor=0.5,
+        window=10,
+        cooldown_secs=5.0,
+    ):
+        self._host = host
+        self.rate = rate
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self.concurrency = 1
+        self._max_concurrency = max_concurrency
+        self._target_latency_secs = target_latency_secs
+        self._rate_step = rate_step
+        self._decrease_factor = decrease_factor
+        self._window = window
+        self._cooldown_secs = cooldown_secs
+
+        self._in_flight = 0
+        self._next_start = time.monotonic()
+        self._successes = 0
+        self._last_decrease = float("-inf")
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Block until a request can start without exceeding the rate or the
+        concurrency."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_flight < self.concurrency)
+            self._in_flight += 1
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + 1.0 / self.rate
+        time.sleep(start - now)
+
+    def release(self, secs, status):
+        """Record how a request went: how long it took and its HTTP status (0
+        for a connection error)."""
+        with self._condition:
+            self._in_flight -= 1
+            failed = not status or status == 429 or status >= 500
+            if failed or secs > 2 * self._target_latency_secs:
+                self._successes = 0
+                now = time.monotonic()
+                if now - self._last_decrease >= self._cooldown_secs:
+                    self._last_decrease = now
+                    self._set(
+                        self.rate * self._decrease_factor,
+                        int(self.concurrency * self._decrease_factor),
+                        f"status {status}, {secs:.2f} secs",
+                    )
+            elif secs <= self._target_latency_secs:
+                self._successes += 1
+                if self._successes >= self._window:
+                    self._successes = 0
+                    self._set(
+                        self.rate + self._rate_step,
+                        self.concurrency + 1,
+                        f"{self._window} fast responses",
+                    )
+            self._condition.notify_all()
+
+    def _set(self, rate, concurrency, reason):
+        rate = min(self._max_rate, max(self._min_rate, rate))
+        concurrency = min(self._max_concurrency, max(1, concurrency))
+        if (rate, concurrency) == (self.rate, self.concurrency):
+            return
+        LOG.info(
+            f"{self._host}: {reason}; rate {self.rate:.2f} -> {rate:.2f}/sec, "
+            f"concurrency {self.concurrency} -> {concurrency}"
+        )
+        self.rate = rate
+        self.concurrency = concurrency
+
+
+class ConcurrentFetcher(_Retrying):
+    """Fetches many URLs at once, on top of the cache object.
+
+    Each host gets its own pooled session, its own pool of up to
+    `connections_per_host` workers and its own rate limit: one fetch every
+    `throttle_secs` seconds, unless `host_throttle_secs` says otherwise for
+    that host. The cache is still the source of truth; cached URLs are never
+    fetched. Failures are retried and cached as for `Fetcher`.
+
+    With `adaptive`, each host's rate and concurrency adapt to how it's coping
+    instead (see `AdaptiveThrottle`). They start at that same rate and one
+    connection, and stay between `min_rate` and `max_rate` fetches per second
+    (by default, a tenth of and four times the starting rate) and at most
+    `connections_per_host` connections.
+
+    `fetch_urls` and `download_urls` take from their iterables as they go,
+    keeping at most `max_pending` fetches queued or running at once, so that
+    memory use doesn't grow with the number of URLs.
+    """
+
+    def __init__(
+        self,
+        throttle_secs=3.0,
+        cache_dir="cache",
+        connections_per_host=2,
+        host_throttle_secs=None,
+        backend=None,
+        retries=3,
+        backoff_secs=5.0,
+        recheck_secs=RECHECK_SECS,
+        adaptive=False,
+        min_rate=None,
+        max_rate=None,
+        target_latency_secs=1.0,
+        max_pending=100,
+    ):
+        self._cache = Cache(cache_dir, backend)
+        self._init_retrying(retries, backoff_secs, recheck_secs)
+        self._max_pending = max_pending
+        self._adaptive = adaptive
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._target_latency_secs = target_latency_secs
+        self._throttle_secs = throttle_secs
+        self._connections_per_host = connections_per_host
+        self._host_throttle_secs = host_throttle_secs or {}
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+
+    def _host(self, url):
+        """Return (session, throttle, executor) for the URL's host."""
+        host = urllib.parse.urlparse(url).netloc
+        with self._hosts_lock:
+            if host not in self._hosts:
+                session = _Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self._connections_per_host
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                throttle_secs = self._host_throttle_secs.get(host, self._throttle_secs)
+                rate = 1.0 / throttle_secs
+                if self._adaptive:
+                    throttle = AdaptiveThrottle(
+                        host,
+                        rate,
+                        min_rate=self._min_rate or rate / 10,
+                        max_rate=self._max_rate or rate * 4,
+                        max_concurrency=self._connections_per_host,
+                        target_latency_secs=self._target_latency_secs,
+                    )
+                else:
+                    throttle = TokenBucket(rate)
+                executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._connections_per_host,
+                    thread_name_prefix=host,
+                )
+                self._hosts[host] = (session, throttle, executor)
+            return self._hosts[host]
+
+    def fetch_url(self, url, revalidate=False):
+        """Fetch a single URL, from the cache if possible. Thread-safe.
+
+        With revalidate, a cached response is checked with the server (see
+        `_Retrying`)."""
+        contents = self._cache.get_or_none(url)
+        if contents is not None and revalidate:
+            return self._fetch(url, contents)
+        if contents is not None:
+            self.stats.count("cached")
+            return contents
+        return self._fetch(url)
+
+    def _get(self, url, headers, stream=False):
+        session, throttle, _ = self._host(url)
+        throttle.acquire()
+        LOG.info(f"Fetching {url}...")
+        start = time.monotonic()
+        try:
+            response = session.get(url, headers=headers, stream=stream)
+        except requests.exceptions.RequestException:
+            throttle.release(time.monotonic() - start, 0)
+            raise
+        secs = time.monotonic() - start
+        throttle.release(secs, response.status_code)
+        self._cache.record_fetch(url, secs)
+        return response
+
+    def fetch_urls(self, urls, revalidate=False):
+        """Fetch many URLs, concurrently across hosts.
+
+        Yields (url, contents, error) in the order that fetches finish, where
+        error is the `requests` exception that a fetch raised, or None. Any
+        other exception is raised, like `fetch_or_error` does.
+        """
+
+        def submit(url):
+            _, _, executor = self._host(url)
+            return executor.submit(self.fetch_url, url, revalidate)
+
+        return self._run_pending(urls, submit)
+
+    def download_urls(self, downloads):
+        """Download many (url, path) pairs with `download_url`, concurrently
+        across hosts.
+
+        Yields (url, path, error) in the order that downloads finish, where
+        error is the `requests` exception that a download raised, or None. Any
+        other exception is raised.
+        """
+
+        def submit(download):
+            _, _, executor = self._host(download[0])
+            return executor.submit(self.download_url, *download)
+
+        for (url, path), _, error in self._run_pending(downloads, submit):
+            yield url, path, error
+
+    def _run_pending(self, items, submit):
+        """Call `submit(item)`, which returns a future, for each item. At most
+        `max_pending` are submitted at a time; more are taken from `items` as
+        they finish.
+
+        Yields (item, result, error) in the order that they finish, raising any
+        error that isn't from `requests`. Finished futures aren't kept, so
+        neither are their results.
+        """
+        items = iter(items)
+        futures = {}
+
+        def fill():
+            for item in itertools.islice(items, self._max_pending - len(futures)):
+                futures[submit(item)] = item
+
+        fill()
+        while futures:
+            done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                item = futures.pop(future)
+                error = future.exception()
+                if error is not None and not isinstance(
+                    error, requests.exceptions.RequestException
+                ):
+                    raise error
+                result = None if error else future.result()
+                fill()
+                yield item, result, error
+
+    def close(self):
+        with self._hosts_lock:
+            for session, _, executor in self._hosts.values():
+                executor.shutdown(cancel_futures=True)
+                session.close()
+            self._hosts.clear()
+        self._cache.close()
+
+    def is_url_in_cache(self, url):
+        return self._cache.is_url_in_cache(url)
+
+    def fetch_url_from_cache(self, url):
+        return self._cache.fetch_url_from_cache(url)
+
+    def get_or_none(self, url):
+        return self._cache.get_or_none(url)
+
+    def lookup_many(self, urls):
+        return self._cache.lookup_many(urls)
+
+
+def fetch_or_error(f, url, revalidate=False):
+    """Fetch an URL, returning (url, contents, error) like `fetch_urls`."""
+    try:
+        return url, f.fetch_url(url, revalidate=revalidate), None
+    except requests.exceptions.RequestException as e:
+        return url, None, e
+
+
+def parse_host_throttle_secs(specs):
+    """Parse ["host=secs", ...] into a {host: secs} dict."""
+    host_throttle_secs = {}
+    for spec in specs:
+        host, secs = spec.rsplit("=", 1)
+        host_throttle_secs[host] = float(secs)
+    return host_throttle_secs
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Fetch a bunch of URLs into the cache.")
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="files listing URLs (or filename<TAB>URL) to fetch, one per line",
+    )
+    parser.add_argument(
+        "--throttle_secs",
+        type=float,
+        help="seconds between fetches from the same host",
+        default=3.0,
+    )
+    parser.add_argument(
+        "--host_throttle_secs",
+        action="append",
+        help="host=secs, to override --throttle_secs for a host; repeatable",
+        default=[],
+    )
+    parser.add_argument(
+        "--backend",
+        choices=sorted(STORES),
+        help="cache backend; defaults to whichever the cache directory uses",
+        default=None,
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        help="times to retry a fetch that fails with a transient error",
+        default=3,
+    )
+    parser.add_argument(
+        "--recheck_days",
+        type=float,
+        help="days before asking for an URL that failed permanently again",
+        default=RECHECK_SECS / (24 * 60 * 60),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="concurrent connections per host; 0 fetches one URL at a time",
+        default=0,
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="with --workers, adapt each host's rate and concurrency to how it's "
+        "coping, between --min_rate and --max_rate",
+    )
+    parser.add_argument(
+        "--min_rate",
+        type=float,
+        help="with --adaptive, the slowest to back off to, in fetches per second; "
+        "defaults to a tenth of the --throttle_secs rate",
+        default=None,
+    )
+    parser.add_argument(
+        "--max_rate",
+        type=float,
+        help="with --adaptive, the fastest to speed up to, in fetches per second; "
+        "defaults to four times the --throttle_secs rate",
+        default=None,
+    )
+    parser.add_argument(
+        "--target_latency_secs",
+        type=float,
+        help="with --adaptive, speed up while responses take less than this",
+        default=1.0,
+    )
+    parser.add_argument(
+        "--revalidate",
+        action="store_true",
+        help="check cached URLs with the server, and refetch any that changed",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        help="file to record progress in, so that an interrupted run can resume",
+        default=None,
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        help="i/n, to fetch only the i-th of n shards of the URLs (from 0)",
+        default=None,
+    )
+    parser.add_argument(
+        "--retry_failed",
+        action="store_true",
+        help="try the URLs that the checkpoint has as failed permanently again",
+    )
+    args = parser.parse_args()
+
+    import crawl
+
     log_file = __file__ + ".log"
     configure_logging(log_file)
-    f = Fetcher()
-    for i, line in enumerate(fileinput.input()):
+
+    filenames = {}
+    urls = []
+    for line in fileinput.input(args.files):
         line = line.strip()
         if "\t" in line:
             filename, url = line.split("\t")
         else:
             filename = None
             url = line
-
-        print("%5d Fetching %s" % (i + 1, url))
-        content = f.fetch_url(url)
+        if url not in filenames:
+            urls.append(url)
+            filenames[url] = []
         if filename:
+            filenames[url].append(filename)
+
+    if args.workers:
+        f = ConcurrentFetcher(
+            throttle_secs=args.throttle_secs,
+            connections_per_host=args.workers,
+            host_throttle_secs=parse_host_throttle_secs(args.host_throttle_secs),
+            backend=args.backend,
+            retries=args.retries,
+            recheck_secs=args.recheck_days * 24 * 60 * 60,
+            adaptive=args.adaptive,
+            min_rate=args.min_rate,
+            max_rate=args.max_rate,
+            target_latency_secs=args.target_latency_secs,
+        )
+    else:
+        f = Fetcher(
+            throttle_secs=args.throttle_secs,
+            backend=args.backend,
+            retries=args.retries,
+            recheck_secs=args.recheck_days * 24 * 60 * 60,
+        )
+
+    shard = crawl.parse_shard(args.shard) if args.shard else None
+    job = crawl.CrawlJob(
+        urls,
+        args.checkpoint,
+        f,
+        shard=shard,
+        retry_failed=args.retry_failed,
+        revalidate=args.revalidate,
+    )
+    for i, (url, content, error) in enumerate(job.run()):
+        if error:
+            print("%5d Failed to fetch %s: %s" % (i + 1, url, error))
+            continue
+        print("%5d Fetched %s" % (i + 1, url))
+        for filename in filenames[url]:
             open(filename, "wb").write(content)
         print("  %d bytes" % len(content))
+    f.stats.log_summary()
+    f.close()
@@ -0,0 +1,86 @@
+"""Fingerprints of geocoded records, for incremental geocoding.
+
+geocode.py tries its parsers on a title in order, and stops at the first one
+that matches. So a record's result depends only on its title, on the inputs
+of the parsers up to (and including) the one that matched, and on the code.
+A fingerprint is a hash of those. If a record's fingerprint is the same as it
+was on the last run, its result from that run can be used again.
+
+For example, if only the POI CSV changes, only the records that the POI
+parser matched, or that nothing matched, need geocoding again.
+
+The store is a JSON file of
+
+    {"output": hash of the output file it goes with,
+     "records": {uniqueID: [fingerprint, index of the matching parser]}}
+
+which is only used if the output file is still the one that was written with
+it.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+LOG = logging.getLogger(__name__)
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def fingerprint(title, parser_inputs, matched):
+    """Fingerprint a title that the `matched`-th parser matched (or that no
+    parser matched, if that's None). `parser_inputs` has a hash of each
+    parser's inputs."""
+    if matched is not None:
+        parser_inputs = parser_inputs[: matched + 1]
+    key = json.dumps([title, parser_inputs])
+    return hashlib.sha1(key.encode("utf8")).hexdigest()
+
+
+class FingerprintStore(object):
+    def __init__(self, path, output_file):
+        self._path = path
+        self._records = {}
+        self.new_records = {}
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            store = json.load(f)
+        if os.path.exists(output_file) and store["output"] == file_hash(output_file):
+            self._records = store["records"]
+        else:
+            LOG.warning(f"{output_file} has changed since {path} was written")
+
+    def is_unchanged(self, id_, title, parser_inputs):
+        """Is this record's fingerprint the same as on the last run?"""
+        if id_ not in self._records:
+            return False
+        old_fingerprint, matched = self._records[id_]
+        return old_fingerprint == fingerprint(title, parser_inputs, matched)
+
+    def reuse(self, id_):
+        """Keep this record's fingerprint from the last run, and return it."""
+        return self.keep(id_, self._records[id_])
+
+    def record(self, id_, title, parser_inputs, matched):
+        """Record this record's fingerprint, and return it."""
+        return self.keep(id_, [fingerprint(title, parser_inputs, matched), matched])
+
+    def keep(self, id_, record):
+        """Keep a fingerprint returned by `reuse()` or `record()`, e.g. in a run
+        that was interrupted before it could save them."""
+        self.new_records[id_] = record
+        return record
+
+    def save(self, output_file):
+        """Save the fingerprints of this run's records, to go with the output
+        file that was just written."""
+        store = {"output": file_hash(output_file), "records": self.new_records}
+        temp_path = f"{self._path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(store, f)
+        os.replace(temp_path, self._path)
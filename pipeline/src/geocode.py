@@ -3,23 +3,39 @@
 location for photos.
 """
 import argparse
+import collections
+import concurrent.futures
 import csv
 import functools
+import gc
 import json
 import logging
+import multiprocessing
 import os
+import pickle
 import re
 import sys
+import time
 
 import googlemaps
 import tqdm
 from dotenv import load_dotenv
 from extract_noun_phrases import noun_pat
-from fetcher import CacheSession
+from fetcher import CacheSession, TokenBucket
+from fingerprints import FingerprintStore, file_hash
 from logging_configuration import configure_logging
+from matchers import (
+    ExactAddressMatcher,
+    PlaceNameMatcher,
+    StandaloneStreetMatcher,
+    fold_case,
+)
+from parser_stats import ParserStats
+from result_stream import ResultStream, compact
+from search_term_cache import SearchTermCache
 from utils import generators
 from utils.id_sample import should_sample
-from utils.timeout import timeout
+from utils.timeout import call_with_timeout
 
 googlemaps.client.requests.Session = (
     googlemaps.client.requests.sessions.Session
@@ -30,6 +46,12 @@ EXACT = "exact"
 
 LOG = logging.getLogger(__name__)
 
+# The code that parsing titles depends on; see fingerprints.py.
+_PARSER_SOURCES = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+    for name in ("geocode.py", "matchers.py", "extract_noun_phrases.py")
+]
+
 
 def get_title(row):
     title = row.get("title", "").strip()
@@ -63,6 +85,26 @@ def are_streets_same(street1, street2):
     return a == b
 
 
+# Like _NORM_REPLACEMENTS, but only replacing whole words (so that "Eastern"
+# stays "Eastern"), and keeping the numbers and punctuation that can tell one
+# search term from another, e.g. "235.5 Yonge St" from "2355 Yonge St".
+_SEARCH_TERM_REPLACEMENTS = [
+    (re.compile(rf"\b{pat.pattern}\b", re.I), repl)
+    for pat, repl in _NORM_REPLACEMENTS[:-1]
+] + [
+    (re.compile(r"(?<=[a-z])\.", re.I), ""),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def normalize_search_term(search_term):
+    """Normalize a search term, so that ones that differ only in case,
+    whitespace or St. vs. Street, etc. are the same."""
+    for pat, repl in _SEARCH_TERM_REPLACEMENTS:
+        search_term = re.sub(pat, repl, search_term)
+    return search_term.strip().lower()
+
+
 def unique_streets(street_list):
     """Return a sublist with the unique streets, according to are_streets_same."""
     if len(street_list) > 10:  # avoid accidental N^2 with large inputs.
@@ -104,7 +146,9 @@ def standalone_street_regex(street_re_str):
     return re.compile(rf"(?:^|[^a-z])({street_re_str})(?:[^a-z]|$)", re.I)
 
 
-def build_place_name_regex(csv_file):
+def read_place_names(csv_file):
+    """Return the names to match from a POI CSV file, and a map from each
+    (lowercase) name to its row."""
     name_to_place = {}
     with open(csv_file) as f:
         reader = csv.DictReader(f)
@@ -114,16 +158,55 @@ def build_place_name_regex(csv_file):
             name_to_place[name] = row
 
     safe_names = [
-        name.replace(".", r"\.")
+        name
         for name in name_to_place.keys()
         if (len(name) >= 5 or name == "cne") and re.match(r"^[-A-Za-z .]+$", name)
     ]
     LOG.debug("Found %d safe names" % len(safe_names))
-    regex = r"(?:^|[^a-z])(%s)(?:[^a-z]|$)" % "|".join(safe_names)
+    return safe_names, name_to_place
+
+
+def build_place_name_regex(csv_file):
+    safe_names, name_to_place = read_place_names(csv_file)
+    regex = r"(?:^|[^a-z])(%s)(?:[^a-z]|$)" % "|".join(
+        name.replace(".", r"\.") for name in safe_names
+    )
     LOG.debug("POI regex: %s" % regex)
     return (re.compile(regex, flags=re.I), name_to_place)
 
 
+def build_place_name_matcher(csv_file, cache_file=None):
+    """Like build_place_name_regex(), but with a matchers.PlaceNameMatcher.
+
+    With a cache_file, the matcher is pickled there, and that's used instead
+    of building it again, for as long as the CSV file and the code that reads
+    it and builds the matcher are the same.
+    """
+    key = (
+        PlaceNameMatcher.VERSION,
+        file_hash(csv_file),
+        [file_hash(path) for path in _PARSER_SOURCES],
+    )
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file, "rb") as f:
+                cached_key, matcher = pickle.load(f)
+        except Exception as e:
+            LOG.warning(f"Ignoring unreadable POI cache {cache_file}: {e}")
+        else:
+            if cached_key == key:
+                LOG.debug(f"Using POI matcher from {cache_file}")
+                return matcher, matcher.name_to_place
+
+    matcher = PlaceNameMatcher(*read_place_names(csv_file))
+    if cache_file:
+        temp_file = f"{cache_file}.tmp"
+        with open(temp_file, "wb") as f:
+            pickle.dump((key, matcher), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, cache_file)
+    return matcher, matcher.name_to_place
+
+
 CAPITALIZED_TOKEN = r"(?:[A-Z][A-Za-z.']*\s?)"
 CAPITALIZED_TOKENS = rf"{CAPITALIZED_TOKEN}+"
 CARDINAL_DIRECTIONS = r"(?:east|west|north|south)"
@@ -282,6 +365,10 @@ def parse_direction_from(title):
 
 
 def parse_exact_address(regex, title):
+    """Extract an address, e.g. "161 Beatrice Street", from a title.
+
+    `regex` is from exact_address_regex(), or is a matchers.ExactAddressMatcher.
+    """
     m = regex.match(title.lower())
     if m:
         search_term = f"{m.group(1)} {m.group(2)}, toronto, ontario, canada"
@@ -311,6 +398,9 @@ def parse_streets_joined_by_and(title):
 def parse_two_streets(standalone_street_re, title):
     """Extract two street names if two are found in a title
 
+    `standalone_street_re` is from standalone_street_regex(), or is a
+    matchers.StandaloneStreetMatcher.
+
     Returns:
         Either a search term for the geocoder or None.
     """
@@ -333,7 +423,9 @@ def parse_place_name(regex, place_map, title):
     matches = regex.findall(title)
     if not matches:
         return None
-    name = max(matches, key=lambda name: place_map[name.lower()]["score"]).lower()
+    # A match can differ from its name in more than case, e.g. "ſ" for "s".
+    names = [fold_case(match) for match in matches]
+    name = max(names, key=lambda name: place_map[name]["score"])
     row = place_map[name]
     osmid = row["osmid"]
     latlng = (row["lat"], row["lng"])
@@ -341,21 +433,59 @@ def parse_place_name(regex, place_map, title):
     return (EXACT, name, latlng, "")
 
 
-def get_search_term_from_title(parsers, title):
-    return functools.reduce(
-        lambda acc, curr: acc if acc else curr(title), parsers, None
-    )
+def parse_title(parsers, title, stats=None):
+    """Try each parser on a title in order, returning (the index of the first
+    that matched, its outcome), or (None, None). With a
+    parser_stats.ParserStats, each parser's time and outcome are recorded
+    there."""
+    for i, parser in enumerate(parsers):
+        start = time.perf_counter()
+        outcome = parser(title)
+        if stats is not None:
+            stats.parsed(i, time.perf_counter() - start, bool(outcome))
+        if outcome:
+            return i, outcome
+    return None, None
 
 
-def call_geocoding_api(maps_client, search_string, expected_types):
+def call_geocoding_api(
+    maps_client, search_string, expected_types, cache=None, on_discard=None
+):
+    """Geocode a search string, returning the result if it's one of the
+    expected types, and None if it isn't (or there isn't one, or the query
+    failed). If the query timed out, this raises the error.
+
+    With a search_term_cache.SearchTermCache, results are looked up there
+    first, and stored there after. If the API's result isn't one of the
+    expected types, on_discard() is called.
+    """
     if maps_client is None:
         return fake_geocode(search_string)
+    if cache is not None:
+        term = normalize_search_term(search_string)
+        hit, result = cache.get(term, expected_types)
+        if hit:
+            return dict(result, search_term=search_string) if result else None
     try:
         geocode_results = maps_client.geocode(search_string)
+    except (TimeoutError, googlemaps.exceptions.Timeout):
+        # The caller decides what to do about these; see main().
+        raise
     except Exception as e:
         LOG.error(f"call_geocoding_api|search_term:{search_string}|error:{e}")
         LOG.exception(e)
         return None
+    result = _decode_geocode_results(
+        search_string, geocode_results, expected_types, on_discard
+    )
+    if cache is not None:
+        cache.put(term, expected_types, result)
+    return result
+
+
+def _decode_geocode_results(
+    search_string, geocode_results, expected_types, on_discard=None
+):
     if geocode_results:
         if len(geocode_results) > 1:
             LOG.debug(f"Multiple geocode results for f{search_string}")
@@ -367,6 +497,8 @@ def call_geocoding_api(maps_client, search_string, expected_types):
                 f'Discarding "{search_string}"; expected one of {expected_types}, '
                 f"got {types}"
             )
+            if on_discard:
+                on_discard()
             return None
 
         return {
@@ -382,6 +514,35 @@ def call_geocoding_api(maps_client, search_string, expected_types):
     return None
 
 
+class ThrottledMapsClient(object):
+    """Wraps a Google Maps client so that its geocode() calls stay under
+    `queries_per_sec`, on average, across all the threads that make them."""
+
+    def __init__(self, maps_client, queries_per_sec):
+        self._maps_client = maps_client
+        self._bucket = TokenBucket(queries_per_sec)
+
+    def geocode(self, search_term):
+        self._bucket.acquire()
+        return self._maps_client.geocode(search_term)
+
+
+class _InlineExecutor(object):
+    """Runs each call as soon as it's submitted, in the calling thread. This
+    stands in for a ThreadPoolExecutor when there's only one worker."""
+
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, _wait=True):
+        pass
+
+
 def fake_geocode(search_string):
     return {
         "lat": 43.647178,
@@ -399,13 +560,66 @@ def write_result_to_file(filename, result):
         f.write(json.dumps(result))
 
 
-def geocode_title(parsers, maps_client, title, *, strict):
-    outcome = get_search_term_from_title(parsers, title)
-    if not outcome:
-        return None
+# The parsers, in a process started by parse_titles_in_processes().
+_process_parsers = None
+
+
+def _init_parser_process(parsers):
+    global _process_parsers
+    _process_parsers = parsers
+
+
+def _parse_titles_in_process(titles, timeout_secs, names):
+    stats = ParserStats(names)
+    parsed = []
+    for title in titles:
+        try:
+            parsed.append(
+                call_with_timeout(
+                    timeout_secs, parse_title, _process_parsers, title, stats
+                )
+            )
+        except TimeoutError:
+            parsed.append(None)
+    return parsed, stats
+
+
+def parse_titles_in_processes(
+    parsers, titles, procs, timeout_secs, stats, chunk_size=500
+):
+    """Parse titles with `procs` processes, returning {title: parse_title()'s
+    result, or None if it timed out}, and adding the parsers' statistics to
+    `stats`.
+
+    The processes are forked, so they share the parsers, and the matchers
+    that they use, with this process (copy-on-write), instead of building
+    their own. Each one parses a chunk of titles at a time.
+    """
+    chunks = [titles[i : i + chunk_size] for i in range(0, len(titles), chunk_size)]
+    # Keep the garbage collector from touching (and so copying) every object
+    # that the processes inherit. See the docs for gc.freeze().
+    gc.freeze()
+    context = multiprocessing.get_context("fork")
+    parse = functools.partial(
+        _parse_titles_in_process, timeout_secs=timeout_secs, names=stats.names
+    )
+    parsed = {}
+    try:
+        with context.Pool(procs, _init_parser_process, (parsers,)) as pool:
+            for chunk, (results, chunk_stats) in zip(chunks, pool.imap(parse, chunks)):
+                parsed.update(zip(chunk, results))
+                stats.merge(chunk_stats)
+    finally:
+        gc.unfreeze()
+    LOG.info(f"Parsed {len(titles):,} titles with {procs} processes")
+    return parsed
+
+
+def outcome_to_result(title, outcome, api_result, *, strict):
+    """Turn a parser's outcome for a title, and the geocoding API's result for
+    it (for GOOGLE outcomes), into the result for the title, or None."""
     technique, search_term, additional, expected_type = outcome
     if technique == GOOGLE:
-        api_result = call_geocoding_api(maps_client, search_term, expected_type)
         if api_result is not None:
             if not strict or api_result["accuracy"] == "ROOFTOP":
                 return dict(
@@ -424,17 +638,6 @@ def geocode_title(parsers, maps_client, title, *, strict):
     return None
 
 
-def row_to_result(parsers, maps_client, row, *, strict):
-    title = get_title(row)
-    if title is None:
-        return None
-    geocode_result = geocode_title(parsers, maps_client, title, strict=strict)
-    if geocode_result:
-        return row["uniqueID"], geocode_result
-    else:
-        return None
-
-
 def main(
     input_file,
     street_names_file,
@@ -444,13 +647,24 @@ def main(
     ids,
     maps_client,
     strict,
+    pois_cache=None,
+    workers=1,
+    queries_per_sec=None,
+    max_queries=None,
+    search_term_cache=None,
+    fingerprints_file=None,
+    stream_file=None,
+    parse_timeout_secs=30.0,
+    retry_file=None,
+    procs=1,
+    parser_stats_file=None,
 ):
     street_names = open(street_names_file).read().split("\n")
-    toronto_street_re_str = build_is_a_toronto_street_regex_str(street_names)
-    LOG.debug(f"Toronto street regex: {toronto_street_re_str}")
-    exact_address_re = exact_address_regex(toronto_street_re_str)
-    standalone_street_re = standalone_street_regex(toronto_street_re_str)
-    place_name_re, place_map = build_place_name_regex(pois_file)
+    # These match the same streets as exact_address_regex() and
+    # standalone_street_regex() would, but much faster; see matchers.py.
+    exact_address_re = ExactAddressMatcher(street_names)
+    standalone_street_re = StandaloneStreetMatcher(street_names)
+    place_name_re, place_map = build_place_name_matcher(pois_file, pois_cache)
 
     parsers = [
         lambda x: parse_exact_address(exact_address_re, x),
@@ -460,29 +674,255 @@ def main(
         lambda x: parse_streets_joined_by_and(x),
         lambda x: parse_place_name(place_name_re, place_map, x),
     ]
+    stats = ParserStats(
+        [
+            "exact_address",
+            "corner",
+            "direction_from",
+            "two_streets",
+            "streets_joined_by_and",
+            "place_name",
+        ]
+    )
+
+    store = None
+    if fingerprints_file:
+        store = FingerprintStore(fingerprints_file, output_file)
+        previous_results = {}
+        if os.path.exists(output_file):
+            with open(output_file) as f:
+                previous_results = json.load(f)
+        # What each parser depends on, besides the title. The first one's
+        # inputs include those of the whole run, since every title gets that far.
+        streets_hash = file_hash(street_names_file)
+        code_hashes = [file_hash(path) for path in _PARSER_SOURCES]
+        parser_inputs = [
+            [code_hashes, strict, maps_client is None, streets_hash],
+            None,
+            None,
+            streets_hash,
+            None,
+            file_hash(pois_file),
+        ]
+
+    cache = None
+    if search_term_cache and maps_client is not None:
+        cache = SearchTermCache(search_term_cache)
+    if maps_client is not None and queries_per_sec:
+        maps_client = ThrottledMapsClient(maps_client, queries_per_sec)
+    if workers > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(workers)
+    else:
+        executor = _InlineExecutor()
 
+    stream = ResultStream(stream_file) if stream_file else None
     results = {}
-    # note: we convert to a list to get a nicer progress bar.
-    for row in tqdm.tqdm(list(generators.read_ndjson_file(input_file))):
+    reused = recomputed = 0
+    # The input rows of records that timed out, to try again later.
+    retry_rows = []
+    # The titles that --strict rejected a result for.
+    strict_rejected = set()
+
+    def finish(row, title, reuse):
+        """Get the result for a record, waiting on its API call if need be."""
+        nonlocal reused, recomputed
         id_ = row["uniqueID"]
-        if ids is not None and id_ not in ids:
-            continue
+        fingerprint = None
+        if reuse:
+            geocode_result = previous_results.get(id_)
+            fingerprint = store.reuse(id_)
+            reused += 1
+        else:
+            matched, outcome, api_result = by_title[title]
+            try:
+                api_result = api_result.result() if api_result else None
+            except (TimeoutError, googlemaps.exceptions.Timeout):
+                LOG.warning(f"Timed out geocoding {id_}: {title}")
+                retry_rows.append(row)
+                return
+            geocode_result = None
+            if outcome:
+                geocode_result = outcome_to_result(
+                    title, outcome, api_result, strict=strict
+                )
+                if (
+                    strict
+                    and geocode_result is None
+                    and title not in strict_rejected
+                    and outcome_to_result(title, outcome, api_result, strict=False)
+                ):
+                    strict_rejected.add(title)
+                    stats.strict_rejected(matched)
+            # A GOOGLE outcome with no API result may have been a failed
+            # query, so try it again next time. (The search term cache will
+            # answer it if it wasn't.)
+            if store and not (outcome and outcome[0] == GOOGLE and not api_result):
+                fingerprint = store.record(id_, title, parser_inputs, matched)
+            recomputed += 1
+        if stream:
+            stream.write(id_, geocode_result, fingerprint)
+        elif geocode_result is not None:
+            results[id_] = geocode_result
+        LOG.debug(f"{id_}: {geocode_result}")
+
+    def selected_rows(progress):
+        """Yield (row, title) for each record to geocode in this run."""
+        with open(input_file) as f:
+            total = sum(1 for _ in f)
+        rows = generators.read_ndjson_file(input_file)
+        for row in tqdm.tqdm(rows, total=total, disable=not progress):
+            id_ = row["uniqueID"]
+            if ids is not None and id_ not in ids:
+                continue
+
+            if not should_sample(id_, sampling_rate):
+                LOG.debug(f"Skipping {id_} due to sampling rate")
+                continue
+
+            if stream and id_ in stream.done:
+                # It was done in a run that stopped before it could save its
+                # fingerprints, so keep them from the stream instead.
+                if store and id_ in stream.fingerprints:
+                    store.keep(id_, stream.fingerprints[id_])
+                continue
+
+            title = get_title(row)
+            if title is None:
+                LOG.debug(f"{id_}: None")
+                continue
+            yield row, title
+
+    # With several processes, parse all the titles up front. Otherwise, parse
+    # each one as it comes.
+    parsed = None
+    if procs > 1:
+        titles = dict.fromkeys(
+            title
+            for row, title in selected_rows(progress=False)
+            if not (store and store.is_unchanged(row["uniqueID"], title, parser_inputs))
+        )
+        parsed = parse_titles_in_processes(
+            parsers, list(titles), procs, parse_timeout_secs, stats
+        )
 
-        if not should_sample(id_, sampling_rate):
-            LOG.debug(f"Skipping {id_} due to sampling rate")
+    def parse(title):
+        if parsed is None:
+            return call_with_timeout(
+                parse_timeout_secs, parse_title, parsers, title, stats
+            )
+        if parsed[title] is None:
+            raise TimeoutError(f"Timed out parsing {title}")
+        return parsed[title]
+
+    # Each distinct title is parsed once, in order, and each distinct search
+    # term is queried once, by the executor. by_title maps each title to (the
+    # index of the parser that matched, its outcome, future API result), and
+    # by_search maps each (search term, expected types) to its future API
+    # result. pending has (row, title, whether to reuse the last run's result)
+    # for the records that are waiting on an API call, in order. Enough of
+    # them wait at once to keep the workers busy.
+    by_title = {}
+    by_search = {}
+    pending = collections.deque()
+    max_pending = 4 * workers if workers > 1 else 0
+    timed_out = set()
+    distinct_titles = set()
+    records = queries = over_quota = 0
+    start = time.monotonic()
+    for row, title in selected_rows(progress=True):
+        id_ = row["uniqueID"]
+        records += 1
+        distinct_titles.add(title)
+        if store and store.is_unchanged(id_, title, parser_inputs):
+            pending.append((row, title, True))
+        elif title in timed_out:
+            LOG.warning(f"Timed out geocoding {id_}: {title}")
+            retry_rows.append(row)
             continue
-
-        try:
-            with timeout(seconds=30):
-                geocode_result = row_to_result(parsers, maps_client, row, strict=strict)
-                if geocode_result is not None:
-                    uid, result = geocode_result
-                    results[uid] = result
-                LOG.debug(f"{id_}: {geocode_result}")
-        except TimeoutError:
-            LOG.warn(f"Timed out geocoding {id_}: {get_title(row)}")
-            pass
-    write_result_to_file(output_file, results)
+        elif title in by_title:
+            pending.append((row, title, False))
+        else:
+            try:
+                matched, outcome = parse(title)
+            except TimeoutError:
+                LOG.warning(f"Timed out geocoding {id_}: {title}")
+                timed_out.add(title)
+                retry_rows.append(row)
+                continue
+            api_result = None
+            if outcome and outcome[0] == GOOGLE:
+                _, search_term, _, expected_type = outcome
+                search = (search_term, frozenset(expected_type))
+                api_result = by_search.get(search)
+            if outcome and outcome[0] == GOOGLE and api_result is None:
+                # Only queries that the cache can't answer count.
+                if not (
+                    cache is not None
+                    and cache.contains(
+                        normalize_search_term(search_term), expected_type
+                    )
+                ):
+                    if max_queries is not None and queries >= max_queries:
+                        over_quota += 1
+                        continue
+                    queries += 1
+                api_result = by_search[search] = executor.submit(
+                    call_geocoding_api,
+                    maps_client,
+                    search_term,
+                    expected_type,
+                    cache,
+                    functools.partial(stats.discarded, matched),
+                )
+            by_title[title] = (matched, outcome, api_result)
+            pending.append((row, title, False))
+
+        while len(pending) > max_pending:
+            finish(*pending.popleft())
+    while pending:
+        finish(*pending.popleft())
+    executor.shutdown()
+
+    if cache is not None:
+        cache.log_stats()
+        cache.close()
+    distinct = len(distinct_titles)
+    if distinct:
+        elapsed = time.monotonic() - start
+        LOG.info(
+            f"{records:,} records had {distinct:,} distinct titles; geocoding "
+            f"each title once saved about "
+            f"{elapsed * (records - distinct) / distinct:.1f} secs"
+        )
+    LOG.info(f"Made {queries:,} geocoding API queries")
+    if over_quota:
+        LOG.warning(
+            f"Skipped {over_quota:,} titles after reaching {max_queries:,} queries"
+        )
+    if retry_file:
+        with open(retry_file, "w") as f:
+            for row in retry_rows:
+                f.write(json.dumps(row) + "\n")
+    if retry_rows:
+        LOG.warning(
+            f"{len(retry_rows):,} records timed out"
+            + ("" if retry_file else "; use --retry_file to save them for a retry")
+        )
+    if parser_stats_file:
+        stats.write(parser_stats_file)
+    else:
+        stats.log_summary()
+    if stream:
+        stream.close()
+        compact(stream_file, output_file)
+    else:
+        write_result_to_file(output_file, results)
+    if store:
+        store.save(output_file)
+        LOG.info(
+            f"Reused {reused:,} results from the last run; "
+            f"recomputed {recomputed:,}"
+        )
 
 
 if __name__ == "__main__":
@@ -505,6 +945,13 @@ if __name__ == "__main__":
         help="csv containing pois extracted from osm",
         default="pipeline/dist/toronto-pois.osm.csv",
     )
+    parser.add_argument(
+        "--pois_cache",
+        type=str,
+        help="file to keep the matcher for the pois in, so that it's only built "
+        "again when the pois file or the code that builds it changes",
+        default=None,
+    )
     parser.add_argument(
         "--output",
         type=str,
@@ -534,6 +981,81 @@ if __name__ == "__main__":
         help="Process a deterministic sample of images. 1=100%%, 0.1=10%%, etc.",
         default=1.0,
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of geocoding API queries to make at once",
+        default=1,
+    )
+    parser.add_argument(
+        "--procs",
+        type=int,
+        help="number of processes to parse titles with",
+        default=1,
+    )
+    parser.add_argument(
+        "--queries_per_sec",
+        type=float,
+        help="most geocoding API queries to make per second, across all workers",
+        default=50.0,
+    )
+    parser.add_argument(
+        "--max_queries",
+        type=int,
+        help="most geocoding API queries to make in this run; titles that would "
+        "need more are skipped",
+        default=None,
+    )
+    parser.add_argument(
+        "--search_term_cache",
+        type=str,
+        help="sqlite file to cache geocoding results in, by search term",
+        default="cache/search_terms.sqlite",
+    )
+    parser.add_argument(
+        "--fingerprints",
+        type=str,
+        help="json file of fingerprints of the records in --output. If set, only "
+        "records whose title or parser inputs have changed since the last run "
+        "are geocoded again, and the rest are copied from --output",
+        default=None,
+    )
+    parser.add_argument(
+        "--stream",
+        type=str,
+        help="ndjson file to append each record's result to as soon as it's "
+        "geocoded. If it's there already, e.g. from a run that crashed, the "
+        "records in it are skipped. At the end, --output is written from it, "
+        "and it's removed",
+        default=None,
+    )
+    parser.add_argument(
+        "--parse_timeout_secs",
+        type=float,
+        help="seconds to spend parsing a title before giving up on it",
+        default=30.0,
+    )
+    parser.add_argument(
+        "--api_timeout_secs",
+        type=float,
+        help="seconds to spend on a geocoding API query, including retries, "
+        "before giving up on it",
+        default=30.0,
+    )
+    parser.add_argument(
+        "--retry_file",
+        type=str,
+        help="ndjson file to write the records that timed out to, to use as "
+        "--input for another try",
+        default=None,
+    )
+    parser.add_argument(
+        "--parser_stats",
+        type=str,
+        help="file to write statistics about each parser to, as JSON, instead "
+        "of logging a summary of them",
+        default=None,
+    )
     parser.add_argument(
         "--ids",
         type=str,
@@ -551,7 +1073,11 @@ if __name__ == "__main__":
         gmaps_client = None
     else:
         load_dotenv()
-        gmaps_client = googlemaps.Client(key=os.environ["GOOGLE_MAPS_API_KEY"])
+        gmaps_client = googlemaps.Client(
+            key=os.environ["GOOGLE_MAPS_API_KEY"],
+            timeout=args.api_timeout_secs,
+            retry_timeout=args.api_timeout_secs,
+        )
     main(
         args.input,
         args.street_names,
@@ -561,4 +1087,15 @@ if __name__ == "__main__":
         ids,
         gmaps_client,
         args.strict,
+        pois_cache=args.pois_cache,
+        workers=args.workers,
+        queries_per_sec=args.queries_per_sec,
+        max_queries=args.max_queries,
+        search_term_cache=args.search_term_cache,
+        fingerprints_file=args.fingerprints,
+        stream_file=args.stream,
+        parse_timeout_secs=args.parse_timeout_secs,
+        retry_file=args.retry_file,
+        procs=args.procs,
+        parser_stats_file=args.parser_stats,
     )
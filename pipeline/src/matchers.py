@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""Fast matchers for the street and place names in geocode.py.
+
+geocode.py used to find street names and places (POIs) with regexes built
+from one alternation of every known name, a few thousand of them for streets.
+Python's regex engine tries each alternative in turn at every position it
+looks at, so matching those was most of the time spent parsing titles. These
+matchers find the same matches by walking a trie of the names instead.
+
+They're drop-in replacements for the regexes: `ExactAddressMatcher.match()`
+returns a match with the same groups as `geocode.exact_address_regex()`, and
+`StandaloneStreetMatcher.findall()` and `PlaceNameMatcher.findall()` return
+the same lists as `geocode.standalone_street_regex()` and
+`geocode.build_place_name_regex()`. That includes the regexes' quirks, e.g.
+a street is the first name in longest-first order that matches, not the
+longest match in the title.
+
+The matchers can be pickled, so that geocode.py can build the POI matcher
+once per POI file; see `geocode.build_place_name_matcher()`.
+
+Usage:
+
+    ./matchers.py --street_names pipeline/dist/streets.txt \\
+        --pois pipeline/dist/toronto-pois.osm.csv \\
+        --input pipeline/dist/images.ndjson
+
+This checks the matchers against the regexes on every title in the input,
+and reports how many titles per second each of them gets through.
+"""
+
+import argparse
+import re
+import string
+import time
+
+from utils import generators
+
+_LETTERS = frozenset(string.ascii_lowercase)
+
+# Everything in an exact address up to the street: a house number (maybe
+# with a half), then whitespace. See `geocode.exact_address_regex()`.
+_NUMBER_RE = re.compile(r"(\d+(?:\.5)?)\s+")
+_HALF_RE = re.compile(r"1/2\s")
+# The `[^a-z]` that has to come before a standalone name.
+_BOUNDARY_RE = re.compile(r"[^a-z]")
+
+
+# The characters that `re.I` matches with ASCII letters, besides their own
+# uppercase: "İ" and "ı" match "i", and "ſ" matches "s". (The Kelvin sign
+# lowercases to "k", so it needs nothing special.)
+_RE_I_FOLDS = {"\u0130": "i", "\u0131": "i", "\u017f": "s"}
+
+
+def fold_case(text):
+    """Lowercase text the way `re.I` compares it, without changing the position
+    of any character."""
+    if text.isascii():
+        return text.lower()
+    return "".join(
+        _RE_I_FOLDS.get(c) or (c.lower() if len(c.lower()) == 1 else c) for c in text
+    )
+
+
+def street_names_in_order(street_list):
+    """Clean up street names as `geocode.build_is_a_toronto_street_regex_str()`
+    does, and put them in the same order."""
+    ordered = sorted(street_list, key=lambda street: -len(street))
+    return [street.strip().lower() for street in ordered if street]
+
+
+def build_trie(names):
+    """Build a trie of lowercase names, as nested dicts keyed by character.
+
+    Each name's node maps None to its rank, its position in `names`. That's
+    its position in the equivalent regex's alternation, so that the matchers
+    can pick the same name the regex would.
+    """
+    trie = {}
+    for rank, name in enumerate(names):
+        node = trie
+        for c in name:
+            node = node.setdefault(c, {})
+        node.setdefault(None, rank)
+    return trie
+
+
+def _prefixes(trie, text, start):
+    """Yield (rank, end) for each name in the trie that is at text[start:end]."""
+    node = trie
+    for end in range(start, len(text) + 1):
+        if None in node:
+            yield node[None], end
+        if end == len(text):
+            return
+        node = node.get(text[end])
+        if node is None:
+            return
+
+
+class Match(object):
+    """The parts of an `re.Match` that geocode.py uses."""
+
+    def __init__(self, string, *spans):
+        self.string = string
+        self._spans = spans
+
+    def span(self, group=0):
+        return self._spans[group]
+
+    def group(self, group=0):
+        start, end = self._spans[group]
+        return self.string[start:end]
+
+    def groups(self):
+        return tuple(self.group(i) for i in range(1, len(self._spans)))
+
+
+class ExactAddressMatcher(object):
+    """Matches like `geocode.exact_address_regex()`, e.g. "161 beatrice street".
+
+    Like that regex, this is case-sensitive, and expects lowercase text.
+    """
+
+    def __init__(self, street_list):
+        self._trie = build_trie(street_names_in_order(street_list))
+
+    def _street_at(self, text, start):
+        best = min(_prefixes(self._trie, text, start), default=None)
+        return best[1] if best else None
+
+    def match(self, text):
+        """Return a `Match` for the first address in the text, or None.
+
+        Group 1 is the number, and group 2 is the street.
+        """
+        # The regex's `.*?` doesn't match newlines, so the number has to be
+        # on the first line (though the street needn't be).
+        last = text.find("\n")
+        if last == -1:
+            last = len(text)
+        pos = 0
+        while True:
+            m = _NUMBER_RE.search(text, pos)
+            if not m or m.start() > last:
+                return None
+            # The regex tries skipping "1/2 " before it tries not skipping it.
+            half = _HALF_RE.match(text, m.end())
+            for start in ([half.end()] if half else []) + [m.end()]:
+                end = self._street_at(text, start)
+                if end is not None:
+                    return Match(text, (0, end), m.span(1), (start, end))
+            pos = m.start() + 1
+
+
+class WordMatcher(object):
+    """Finds names in text, like the regex `(?:^|[^a-z])(names)(?:[^a-z]|$)`
+    with `re.I`, where `names` is an alternation of the names, in order.
+
+    That is, matching is case-insensitive, and a name has to have a non-letter
+    (or the start or end of the text) on either side of it.
+    """
+
+    def __init__(self, names):
+        self._trie = build_trie([fold_case(name) for name in names])
+
+    def _name_at(self, text, start):
+        best = None
+        for rank, end in _prefixes(self._trie, text, start):
+            if end < len(text) and text[end] in _LETTERS:
+                continue
+            if best is None or rank < best[0]:
+                best = rank, end
+        return best[1] if best else None
+
+    def finditer(self, text):
+        """Yield (start, end) for each name in the text, in one pass."""
+        folded = fold_case(text)
+        start = 0
+        while True:
+            end = self._name_at(folded, start)
+            if end is None:
+                pos = start
+            else:
+                yield start, end
+                # The regex uses up the non-letter after a name, so it can't
+                # start the next one.
+                pos = end + 1
+            m = _BOUNDARY_RE.search(folded, pos)
+            if not m:
+                return
+            start = m.end()
+
+    def findall(self, text):
+        """Return a list of the names in the text, as they appear in it."""
+        return [text[start:end] for start, end in self.finditer(text)]
+
+
+class StandaloneStreetMatcher(WordMatcher):
+    """Matches like `geocode.standalone_street_regex()`, e.g. "Yonge Street"."""
+
+    def __init__(self, street_list):
+        super().__init__(street_names_in_order(street_list))
+
+
+class PlaceNameMatcher(WordMatcher):
+    """Matches like the regex from `geocode.build_place_name_regex()`.
+
+    `names` are the lowercase POI names that the regex would have, in the
+    same order, and `name_to_place` maps each of them to its row in the CSV.
+    """
+
+    # Bump this to invalidate pickled matchers when this class changes.
+    VERSION = 2
+
+    def __init__(self, names, name_to_place):
+        super().__init__(names)
+        self.name_to_place = name_to_place
+
+
+def _time(f, titles):
+    start = time.perf_counter()
+    results = [f(title) for title in titles]
+    return results, time.perf_counter() - start
+
+
+def main(street_names_file, pois_file, input_file):
+    import geocode
+
+    street_names = open(street_names_file).read().split("\n")
+    street_re_str = geocode.build_is_a_toronto_street_regex_str(street_names)
+    exact_address_re = geocode.exact_address_regex(street_re_str)
+    standalone_street_re = geocode.standalone_street_regex(street_re_str)
+    exact_address_matcher = ExactAddressMatcher(street_names)
+    standalone_street_matcher = StandaloneStreetMatcher(street_names)
+    place_name_re, _ = geocode.build_place_name_regex(pois_file)
+    place_name_matcher, _ = geocode.build_place_name_matcher(pois_file)
+
+    titles = [
+        title
+        for title in (
+            geocode.get_title(row) for row in generators.read_ndjson_file(input_file)
+        )
+        if title
+    ]
+    lowered = [title.lower() for title in titles]
+
+    def groups(m):
+        return m.groups() if m else None
+
+    comparisons = [
+        (
+            "exact address",
+            lowered,
+            lambda title: groups(exact_address_re.match(title)),
+            lambda title: groups(exact_address_matcher.match(title)),
+        ),
+        (
+            "standalone street",
+            titles,
+            standalone_street_re.findall,
+            standalone_street_matcher.findall,
+        ),
+        ("place name", titles, place_name_re.findall, place_name_matcher.findall),
+    ]
+    for name, texts, regex, matcher in comparisons:
+        expected, regex_secs = _time(regex, texts)
+        actual, matcher_secs = _time(matcher, texts)
+        differences = [
+            (text, a, b) for text, a, b in zip(texts, expected, actual) if a != b
+        ]
+        print(f"{name}: {len(texts):,} titles")
+        print(f"  regex:   {len(texts) / regex_secs:12,.0f} titles/sec")
+        print(f"  matcher: {len(texts) / matcher_secs:12,.0f} titles/sec")
+        print(f"  {len(differences):,} differences")
+        for text, a, b in differences[:10]:
+            print(f"    {text!r}: {a!r} != {b!r}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "Check the street and place matchers against the regexes, and time them."
+    )
+    parser.add_argument(
+        "--street_names",
+        type=str,
+        help="text file containing street names",
+        default="pipeline/dist/streets.txt",
+    )
+    parser.add_argument(
+        "--pois",
+        type=str,
+        help="csv containing pois extracted from osm",
+        default="pipeline/dist/toronto-pois.osm.csv",
+    )
+    parser.add_argument(
+        "--input",
+        type=str,
+        help="ndjson formatted file containing titles to match",
+        default="pipeline/dist/images.ndjson",
+    )
+    args = parser.parse_args()
+    main(args.street_names, args.pois, args.input)
@@ -65,13 +65,12 @@ if __name__ == "__main__":
     f = fetcher.Fetcher()
     out = open(ndjson_output, "w")
     ids = set()
-    for num, url in enumerate(open(urls_file_input)):
-        url = url.strip()
-
-        if not f.is_url_in_cache(url):
+    urls = (url.strip() for url in open(urls_file_input))
+    for num, (url, content) in enumerate(f.lookup_many(urls)):
+        if content is None:
             continue
 
-        xml = f.fetch_url_from_cache(url).decode("utf8")
+        xml = content.decode("utf8")
         records = parse_library_results_xml(xml)
         for record in records:
             id_ = record["uniqueID"]
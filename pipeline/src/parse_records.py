@@ -110,14 +110,13 @@ if __name__ == "__main__":
     (urls_file_input, ndjson_output) = sys.argv[1:]
     f = fetcher.Fetcher()
     out = open(ndjson_output, "w")
-    for num, id_ in enumerate(open(urls_file_input)):
-        id_ = id_.strip()
-
-        url = url_for_unique_id(id_)
-        if not f.is_url_in_cache(url):
+    ids = [id_.strip() for id_ in open(urls_file_input)]
+    contents = f.lookup_many(url_for_unique_id(id_) for id_ in ids)
+    for num, (id_, (_, content)) in enumerate(zip(ids, contents)):
+        if content is None:
             continue
 
-        html = f.fetch_url_from_cache(url).decode("utf8")
+        html = content.decode("utf8")
         tags = parse_html(html)
         tags["uniqueID"] = id_
         out.write(json.dumps(tags))
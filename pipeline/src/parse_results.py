@@ -46,13 +46,13 @@ if __name__ == "__main__":
 
     out = open("pipeline/dist/images.ndjson", "w")
 
-    for url in open("results.txt"):
-        url = url.strip()
+    urls = (url.strip() for url in open("results.txt"))
+    for url, content in f.lookup_many(urls):
         print(url)
-        if not f.is_url_in_cache(url):
+        if content is None:
             continue
 
-        html = f.fetch_url_from_cache(url).decode("utf8")
+        html = content.decode("utf8")
         lines = lines_from_html(html)
         for line in lines:
             tags = extract_from_line(line)
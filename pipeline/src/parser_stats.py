@@ -0,0 +1,114 @@
+"""Statistics about geocode.py's parsers, for tuning them.
+
+geocode.py tries its parsers on each title in order, and stops at the first
+one that matches. For each parser, this records
+
+    tried            how many titles it was tried on
+    matched          how many of them it matched
+    total_secs       how long it took on all of them
+    p99_secs         the 99th percentile of how long it took on one
+    discarded        how many of its geocoding API results were discarded,
+                     for not being one of the types it expected
+    strict_rejected  how many of its matches --strict rejected
+
+The counts are of distinct titles, and don't include the records that were
+reused from the last run (see fingerprints.py). A discarded result is only
+counted when it comes from the API, not from the search term cache.
+
+At the end of a run, geocode.py logs a summary of these, or with
+--parser_stats, writes them to a JSON file:
+
+    {"titles": 4040, "unmatched": 1234,
+     "parsers": [{"name": "exact_address", "tried": 4040, ...}, ...]}
+"""
+
+import json
+import logging
+import math
+import threading
+
+LOG = logging.getLogger(__name__)
+
+
+class ParserStats(object):
+    def __init__(self, names):
+        self.names = list(names)
+        # The time each parser took on each title it was tried on.
+        self._times = [[] for _ in self.names]
+        self._matched = [0] * len(self.names)
+        self._discarded = [0] * len(self.names)
+        self._strict_rejected = [0] * len(self.names)
+        # Discards are recorded by the threads that make the API queries.
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def parsed(self, index, secs, matched):
+        self._times[index].append(secs)
+        if matched:
+            self._matched[index] += 1
+
+    def discarded(self, index):
+        with self._lock:
+            self._discarded[index] += 1
+
+    def strict_rejected(self, index):
+        self._strict_rejected[index] += 1
+
+    def merge(self, other):
+        """Add the parse times and matches that another ParserStats (from
+        another process) recorded."""
+        for times, other_times in zip(self._times, other._times):
+            times.extend(other_times)
+        self._matched = [a + b for a, b in zip(self._matched, other._matched)]
+
+    def report(self):
+        parsers = []
+        for i, name in enumerate(self.names):
+            times = sorted(self._times[i])
+            p99 = times[math.ceil(0.99 * len(times)) - 1] if times else 0.0
+            parsers.append(
+                {
+                    "name": name,
+                    "tried": len(times),
+                    "matched": self._matched[i],
+                    "total_secs": round(sum(times), 6),
+                    "p99_secs": round(p99, 6),
+                    "discarded": self._discarded[i],
+                    "strict_rejected": self._strict_rejected[i],
+                }
+            )
+        # Every title is tried on the first parser.
+        titles = parsers[0]["tried"] if parsers else 0
+        return {
+            "titles": titles,
+            "unmatched": titles - sum(self._matched),
+            "parsers": parsers,
+        }
+
+    def log_summary(self):
+        report = self.report()
+        LOG.info(
+            f"Parsed {report['titles']:,} titles; "
+            f"{report['unmatched']:,} matched no parser"
+        )
+        for parser in report["parsers"]:
+            LOG.info(
+                f"  {parser['name']}: matched {parser['matched']:,} of "
+                f"{parser['tried']:,} in {parser['total_secs']:.2f} secs "
+                f"(p99 {parser['p99_secs'] * 1000:.1f} ms), "
+                f"{parser['discarded']:,} discarded, "
+                f"{parser['strict_rejected']:,} rejected by --strict"
+            )
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        LOG.info(f"Wrote parser stats to {path}")
@@ -0,0 +1,80 @@
+"""Streaming, resumable output for geocode.py.
+
+Instead of holding every result until the end of a run, geocode.py can
+append each record's result to an NDJSON file as soon as it has it:
+
+    {"uniqueID": "100001", "result": {...}}
+    {"uniqueID": "100022", "result": null}
+
+A record with no result gets a line too, so that it's clear that it's done.
+With --fingerprints, each line also has the record's fingerprint (see
+fingerprints.py), so that a resumed run can keep it:
+
+    {"uniqueID": "100001", "result": {...}, "fingerprint": [...]}
+
+The file is flushed after every line and fsync'd every `checkpoint_secs`. If
+a run stops part way through, the next run with the same file skips the
+records that are already in it.
+
+At the end of a run, `compact()` turns the file into the usual
+geocode_results.json, a JSON object of {uniqueID: result}.
+"""
+
+import json
+import logging
+import os
+import time
+
+from utils import generators
+from utils.files import truncate_partial_line
+
+LOG = logging.getLogger(__name__)
+
+
+class ResultStream(object):
+    def __init__(self, path, checkpoint_secs=10.0):
+        self._path = path
+        self._checkpoint_secs = checkpoint_secs
+        truncate_partial_line(path)
+        self.done = set()
+        # The fingerprints of the records that are done, for those that have
+        # them.
+        self.fingerprints = {}
+        if os.path.exists(path):
+            for row in generators.read_ndjson_file(path):
+                self.done.add(row["uniqueID"])
+                if row.get("fingerprint") is not None:
+                    self.fingerprints[row["uniqueID"]] = row["fingerprint"]
+            LOG.info(f"Resuming; {len(self.done):,} records are already done")
+        self._f = open(path, "a")
+        self._last_checkpoint = time.monotonic()
+
+    def write(self, id_, result, fingerprint=None):
+        row = {"uniqueID": id_, "result": result}
+        if fingerprint is not None:
+            row["fingerprint"] = fingerprint
+        self._f.write(json.dumps(row) + "\n")
+        self._f.flush()
+        now = time.monotonic()
+        if now - self._last_checkpoint >= self._checkpoint_secs:
+            os.fsync(self._f.fileno())
+            self._last_checkpoint = now
+
+    def close(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+
+
+def compact(path, output_file):
+    """Write the results in a stream file to output_file as JSON, and remove
+    the stream file."""
+    results = {}
+    for row in generators.read_ndjson_file(path):
+        if row["result"] is not None:
+            results[row["uniqueID"]] = row["result"]
+    temp_file = f"{output_file}.tmp"
+    with open(temp_file, "w") as f:
+        f.write(json.dumps(results))
+    os.replace(temp_file, output_file)
+    os.remove(path)
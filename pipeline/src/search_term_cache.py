@@ -0,0 +1,84 @@
+"""A persistent cache of geocoding results, by search term.
+
+The HTTP cache (see fetcher.py) only caches geocoding API responses by URL,
+so "Yonge St. and Queen Street" and "yonge street and queen st" are separate
+requests, and every hit still has to be decoded and checked again. This
+caches the results of `geocode.call_geocoding_api()` themselves, by a
+normalized search term and the types of result that were expected. A result
+of None (no results, or none of the expected type) is cached too, but a
+failed query is not.
+
+The cache is a SQLite database, which is safe to use from several threads.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+LOG = logging.getLogger(__name__)
+
+
+class SearchTermCache(object):
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(term TEXT, types TEXT, result TEXT, PRIMARY KEY (term, types))"
+        )
+        self._db.commit()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def _types(expected_types):
+        return ",".join(sorted(expected_types))
+
+    def get(self, term, expected_types):
+        """Return (True, result) if there's a result for this term, and
+        (False, None) if there isn't."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT result FROM results WHERE term = ? AND types = ?",
+                (term, self._types(expected_types)),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            return True, json.loads(row[0])
+
+    def contains(self, term, expected_types):
+        """Is there a result for this term? This doesn't count as a hit or a
+        miss."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM results WHERE term = ? AND types = ?",
+                (term, self._types(expected_types)),
+            ).fetchone()
+        return row is not None
+
+    def put(self, term, expected_types, result):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                (term, self._types(expected_types), json.dumps(result)),
+            )
+            self._db.commit()
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        if lookups:
+            LOG.info(
+                f"Search term cache: {self.hits:,} hits, {self.misses:,} misses "
+                f"({self.hits / lookups:.1%} hit rate)"
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
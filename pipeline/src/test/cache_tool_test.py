@@ -0,0 +1,207 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from nose.tools import eq_, ok_
+from parameterized import parameterized
+
+sys.path.append("pipeline/src")
+import cache_tool  # noqa: E402
+import fetcher  # noqa: E402
+
+
+def test_migrate():
+    cache_dir = tempfile.mkdtemp()
+    cache = fetcher.Cache(cache_dir, "directory")
+    urls = ["http://a.com/1", "http://a.com/2?key=secret", "http://b.com/3"]
+    for url in urls:
+        cache.store_url_in_cache(url, url.encode())
+
+    source = fetcher.open_store(cache_dir, "directory")
+    destination = fetcher.open_store(cache_dir, "sqlite")
+    eq_(3, cache_tool.migrate(source, destination, cache_tool.known_urls(cache_dir)))
+    destination.close()
+
+    # Now that there's a SQLite file, that's the default.
+    cache = fetcher.Cache(cache_dir)
+    for url in urls:
+        eq_(url.encode(), cache.fetch_url_from_cache(url))
+    eq_(
+        ["http://a.com/1", "http://a.com/2?key=secret", "http://b.com/3"],
+        sorted(url for (url,) in cache._store._db.execute("SELECT url FROM responses")),
+    )
+    cache.close()
+
+
+@parameterized([("directory", "sqlite"), ("sqlite", "directory")])
+def test_migrate_metadata(from_backend, to_backend):
+    cache_dir = tempfile.mkdtemp()
+    cache = fetcher.Cache(cache_dir, from_backend)
+    cache.store_url_in_cache("http://a.com/1", b"one", {"etag": '"1"'})
+    cache.record_failure("http://a.com/missing", 404)
+    key = fetcher.cache_key("http://a.com/1")
+    cache._store.set_atime(key, 1000.0)
+    cache.close()
+
+    source = fetcher.open_store(cache_dir, from_backend)
+    destination = fetcher.open_store(cache_dir, to_backend)
+    eq_(1, cache_tool.migrate(source, destination, {}))
+    source.close()
+
+    cache = fetcher.Cache(cache_dir, to_backend)
+    eq_({"etag": '"1"'}, cache.get_validators("http://a.com/1"))
+    eq_(404, cache.get_failure("http://a.com/missing")["status"])
+    eq_([(key, 1000.0)], [(k, atime) for k, _, atime in destination.entries()])
+    # Migrating didn't count as reading the response.
+    eq_([1000.0], [atime for _, _, atime in source_entries(cache_dir, from_backend)])
+    cache.close()
+    destination.close()
+
+
+def source_entries(cache_dir, backend):
+    store = fetcher.open_store(cache_dir, backend)
+    entries = list(store.entries())
+    store.close()
+    return entries
+
+
+def test_compress_and_stats():
+    cache_dir = tempfile.mkdtemp()
+    cache = fetcher.Cache(cache_dir, compress=False)
+    page = b"<p>boilerplate</p>\n" * 50
+    cache.store_url_in_cache("http://a.com/1", page)
+
+    store = fetcher.open_store(cache_dir)
+    codec = fetcher.Codec(cache_dir)
+    keys = cache_tool.sample_keys(store)
+    eq_(
+        {None: (1, len(page), len(page))},
+        strip_time(cache_tool.stats(store, codec, keys)),
+    )
+
+    eq_(1, cache_tool.compress(store, codec))
+    eq_(0, cache_tool.compress(store, codec))
+    by_format = strip_time(cache_tool.stats(store, codec, keys))
+    eq_([fetcher.Codec.ZLIB], list(by_format))
+    eq_(len(page), by_format[fetcher.Codec.ZLIB][2])
+    eq_(page, fetcher.Cache(cache_dir).fetch_url_from_cache("http://a.com/1"))
+
+
+def test_compress_keeps_downloads_shared():
+    cache_dir = tempfile.mkdtemp()
+    cache = fetcher.Cache(cache_dir, "directory")
+    download = os.path.join(tempfile.mkdtemp(), "1.jpg")
+    with open(download, "wb") as f:
+        f.write(os.urandom(1000))
+    cache.store_file_in_cache("http://a.com/1.jpg", download)
+    eq_(2, os.stat(download).st_nlink)
+
+    store = fetcher.open_store(cache_dir)
+    eq_(0, cache_tool.compress(store, fetcher.Codec(cache_dir)))
+    eq_(2, os.stat(download).st_nlink)
+    eq_(open(download, "rb").read(), cache.fetch_url_from_cache("http://a.com/1.jpg"))
+
+
+def strip_time(by_format):
+    return {format_: total[:3] for format_, total in by_format.items()}
+
+
+def test_evict():
+    day = 24 * 60 * 60
+    entries = [
+        (("a.com", "1"), 100, 1 * day),
+        (("a.com", "2"), 100, 5 * day),
+        (("a.com", "3"), 100, 9 * day),
+        (("b.com", "4"), 100, 2 * day),
+        (("b.com", "5"), 100, 8 * day),
+    ]
+    now = 10 * day
+
+    def evicted_keys(**kwargs):
+        return [key for key, _, _ in cache_tool.evict(entries, now, **kwargs)]
+
+    eq_([], evicted_keys())
+    eq_([("a.com", "1"), ("b.com", "4")], evicted_keys(ttl_secs=7 * day))
+    eq_([("a.com", "1"), ("a.com", "2")], evicted_keys(host_quotas={"a.com": 100}))
+    eq_(
+        [("a.com", "1"), ("b.com", "4"), ("a.com", "2")],
+        evicted_keys(max_bytes=250),
+    )
+    # TTL first, then quotas, then the overall limit.
+    eq_(
+        [("a.com", "1"), ("b.com", "4"), ("a.com", "2"), ("b.com", "5")],
+        evicted_keys(ttl_secs=8.5 * day, host_quotas={"a.com": 100}, max_bytes=100),
+    )
+
+
+def test_host_report():
+    cache_dir = tempfile.mkdtemp()
+    cache = fetcher.Cache(cache_dir, compress=False)
+    cache.store_url_in_cache("http://a.com/1", b"x" * 10)
+    cache.store_url_in_cache("http://a.com/2", b"y" * 10)
+    cache.get_or_none("http://a.com/1")
+    cache.get_or_none("http://a.com/3")
+    list(cache.lookup_many(["http://a.com/2", "http://b.com/1"]))
+    cache.record_fetch("http://b.com/1", 0.5)
+    cache.close()
+
+    report = cache_tool.host_report(
+        fetcher.open_store(cache_dir), fetcher.HostStats(cache_dir)
+    )
+    eq_(
+        {"entries": 2, "bytes": 20, "hits": 2, "misses": 1},
+        dict(report["a.com"]),
+    )
+    eq_({"misses": 1, "fetches": 1, "fetch_secs": 0.5}, dict(report["b.com"]))
+
+
+@parameterized([("directory",), ("sqlite",)])
+def test_evict_failures(backend):
+    cache_dir = tempfile.mkdtemp()
+    cache = fetcher.Cache(cache_dir, backend)
+    cache.store_url_in_cache("http://a.com/1", b"one")
+    cache.record_failure("http://a.com/2", 503)
+    cache.close()
+
+    store = fetcher.open_store(cache_dir, backend)
+    report = cache_tool.host_report(store, fetcher.HostStats(cache_dir))
+    eq_(2, report["a.com"]["entries"])
+    # The response was just read, but the failure is 100 seconds old.
+    now = time.time() + 100
+    store.set_atime(fetcher.cache_key("http://a.com/1"), now)
+    evicted = cache_tool.evict(cache_tool.all_entries(store), now, ttl_secs=50)
+    eq_([fetcher.cache_key("http://a.com/2")], [key for key, _, _ in evicted])
+    store.close()
+
+
+def test_evict_shrinks_sqlite():
+    cache_dir = tempfile.mkdtemp()
+    cache = fetcher.Cache(cache_dir, "sqlite", compress=False)
+    for i in range(100):
+        cache.store_url_in_cache(f"http://a.com/{i}", os.urandom(10000))
+    cache.close()
+    db_path = os.path.join(cache_dir, fetcher.SqliteStore.FILENAME)
+    size_before = os.path.getsize(db_path)
+
+    cache_tool.main_evict(
+        argparse.Namespace(
+            cache_dir=cache_dir,
+            host_quota=[],
+            ttl_days=None,
+            max_bytes="100k",
+            dry_run=False,
+        )
+    )
+    ok_(os.path.getsize(db_path) < size_before / 5)
+    cache = fetcher.Cache(cache_dir)
+    eq_(None, cache.get_or_none("http://a.com/0"))
+    ok_(cache.get_or_none("http://a.com/99"))
+    cache.close()
+
+
+def test_parse_size():
+    eq_(100, cache_tool.parse_size("100"))
+    eq_(1536, cache_tool.parse_size("1.5k"))
+    eq_(2 * 1024**3, cache_tool.parse_size("2G"))
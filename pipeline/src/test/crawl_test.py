@@ -0,0 +1,81 @@
+import sys
+import tempfile
+
+import requests
+from nose.tools import eq_, ok_
+
+sys.path.append("pipeline/src")
+import crawl  # noqa: E402
+
+
+class FetcherMock(object):
+    """Fetches everything but URLs ending in "bad" (a connection error) or
+    "gone" (a 404); records what it fetched."""
+
+    def __init__(self):
+        self.fetched = []
+
+    def fetch_url(self, url, revalidate=False):
+        self.fetched.append(url)
+        if url.endswith("bad"):
+            raise requests.exceptions.ConnectionError(url)
+        if url.endswith("gone"):
+            response = requests.Response()
+            response.status_code = 404
+            raise requests.exceptions.HTTPError(url, response=response)
+        return url.encode()
+
+
+def test_resume():
+    checkpoint = tempfile.mktemp()
+    urls = ["http://a/1", "http://a/bad", "http://a/gone", "http://a/2", "http://a/3"]
+
+    f = FetcherMock()
+    job = crawl.CrawlJob(urls, checkpoint, f)
+    results = job.run()
+    eq_(("http://a/1", b"http://a/1", None), next(results))
+    url, contents, error = next(results)
+    eq_(("http://a/bad", None), (url, contents))
+    ok_(isinstance(error, requests.exceptions.ConnectionError))
+    url, contents, error = next(results)
+    eq_(("http://a/gone", None), (url, contents))
+    results.close()  # stop part-way through
+
+    # Simulate a crash in the middle of writing a line.
+    with open(checkpoint, "a") as f:
+        f.write("done\thttp://a/")
+
+    f = FetcherMock()
+    job = crawl.CrawlJob(urls, checkpoint, f)
+    eq_(5, job.total)
+    # The transient failure is tried again, but not the permanent one.
+    eq_(
+        ["http://a/bad", "http://a/2", "http://a/3"],
+        [url for url, _, _ in job.run()],
+    )
+    eq_(
+        {
+            "http://a/1": "done",
+            "http://a/bad": "retry",
+            "http://a/gone": "failed",
+            "http://a/2": "done",
+            "http://a/3": "done",
+        },
+        crawl.load_checkpoint(checkpoint),
+    )
+    eq_({"done": 2, "failed": 1}, job.counts)
+
+    f = FetcherMock()
+    job = crawl.CrawlJob(urls, checkpoint, f, retry_failed=True)
+    eq_(["http://a/bad", "http://a/gone"], job.pending)
+
+
+def test_shards():
+    urls = [f"http://a/{i}" for i in range(100)]
+    shards = [
+        crawl.CrawlJob(urls, None, FetcherMock(), shard=(i, 3)).pending
+        for i in range(3)
+    ]
+    eq_(sorted(urls), sorted(sum(shards, [])))
+    ok_(all(shard for shard in shards))
+    eq_((1, 3), crawl.parse_shard("1/3"))
@@ -0,0 +1,419 @@
+import collections
+import http.server
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from operator import itemgetter
+
+import requests
+from nose.tools import assert_raises, eq_, ok_
+from parameterized import parameterized
+
+sys.path.append("pipeline/src")
+import fetcher  # noqa: E402
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # path -> number of requests for it
+    requests = collections.Counter()
+    version = 1
+
+    def do_GET(self):
+        self.requests[self.path] += 1
+        if self.path.startswith("/missing"):
+            self.send_error(404)
+            return
+        # /flaky/N fails with a 503 the first N times it's asked for.
+        if self.path.startswith("/flaky/"):
+            if self.requests[self.path] <= int(self.path.split("/")[-1]):
+                self.send_error(503)
+                return
+        # /etag/... has an ETag, which is the version of it that's current.
+        etag = f'"{Handler.version}"'
+        if self.path.startswith("/etag/"):
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+        body = f"contents of {self.path}".encode()
+        if self.path.startswith("/etag/"):
+            body += f" v{Handler.version}".encode()
+        self.send_response(200)
+        if self.path.startswith("/etag/"):
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+@parameterized([("directory",), ("sqlite",)])
+def test_cache_round_trip(backend):
+    cache = fetcher.Cache(tempfile.mkdtemp(), backend)
+    url = "https://example.com/a?key=secret&b=1"
+    ok_(not cache.is_url_in_cache(url))
+    cache.store_url_in_cache(url, b"hello")
+    ok_(cache.is_url_in_cache(url))
+    eq_(b"hello", cache.fetch_url_from_cache(url))
+    # The API key isn't part of the cache key.
+    eq_(b"hello", cache.fetch_url_from_cache("https://example.com/a?b=1&key=other"))
+    cache.remove_url_from_cache(url)
+    ok_(not cache.is_url_in_cache(url))
+    cache.close()
+
+
+def test_default_backend():
+    cache_dir = tempfile.mkdtemp()
+    ok_(isinstance(fetcher.open_store(cache_dir), fetcher.DirectoryStore))
+    fetcher.open_store(cache_dir, "sqlite").close()
+    ok_(isinstance(fetcher.open_store(cache_dir), fetcher.SqliteStore))
+
+
+def test_sqlite_batched_commits():
+    cache_dir = tempfile.mkdtemp()
+    writer = fetcher.SqliteStore(cache_dir, commit_every=2, commit_secs=60.0)
+    reader = fetcher.SqliteStore(cache_dir)
+    writer.put(("a", "1"), "http://a/1", b"one")
+    ok_(writer.contains(("a", "1")))
+    ok_(not reader.contains(("a", "1")))
+    writer.put(("a", "2"), "http://a/2", b"two")
+    eq_(b"one", reader.get(("a", "1")))
+    writer.close()
+    reader.close()
+
+
+def test_token_bucket():
+    bucket = fetcher.TokenBucket(rate=50.0)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    # The first token is free; the other five take 1/50 s each.
+    ok_(time.monotonic() - start >= 0.09)
+
+
+def test_concurrent_fetcher():
+    server, base_url = start_server()
+    cache_dir = tempfile.mkdtemp()
+    f = fetcher.ConcurrentFetcher(throttle_secs=0.01, cache_dir=cache_dir)
+    urls = [f"{base_url}/{i}" for i in range(5)] + [f"{base_url}/missing"]
+    results = {url: (contents, error) for url, contents, error in f.fetch_urls(urls)}
+    f.close()
+    server.shutdown()
+
+    eq_(set(urls), set(results))
+    eq_((b"contents of /3", None), results[f"{base_url}/3"])
+    contents, error = results[f"{base_url}/missing"]
+    eq_(None, contents)
+    eq_(404, error.response.status_code)
+
+    # Everything that was fetched is now in the cache.
+    cache = fetcher.Cache(cache_dir)
+    eq_(b"contents of /0", cache.fetch_url_from_cache(f"{base_url}/0"))
+    ok_(not cache.is_url_in_cache(f"{base_url}/missing"))
+
+
+def test_concurrent_fetcher_raises_other_errors():
+    f = fetcher.ConcurrentFetcher(throttle_secs=0.01, cache_dir=tempfile.mkdtemp())
+
+    def fetch_url(url, revalidate=False):
+        raise ValueError(url)
+
+    # Only errors from requests are yielded, like fetch_or_error() does.
+    f.fetch_url = fetch_url
+    assert_raises(ValueError, list, f.fetch_urls(["http://a/1"]))
+
+    def download_url(url, path):
+        raise OSError(path)
+
+    f.download_url = download_url
+    assert_raises(OSError, list, f.download_urls([("http://a/1", "/tmp/1")]))
+    f.close()
+
+
+def test_concurrent_fetcher_max_pending():
+    f = fetcher.ConcurrentFetcher(cache_dir=tempfile.mkdtemp(), max_pending=3)
+    f.fetch_url = lambda url, revalidate=False: url.encode()
+    taken = []
+
+    def urls():
+        for i in range(20):
+            taken.append(i)
+            yield f"http://a/{i}"
+
+    results = f.fetch_urls(urls())
+    next(results)
+    # Three were submitted, and one more when the first finished.
+    eq_(4, len(taken))
+    eq_(19, len(list(results)))
+    eq_(20, len(taken))
+    f.close()
+
+
+def test_concurrent_fetcher_download_max_pending():
+    f = fetcher.ConcurrentFetcher(cache_dir=tempfile.mkdtemp(), max_pending=3)
+    f.download_url = lambda url, path: None
+    taken = []
+
+    def downloads():
+        for i in range(20):
+            taken.append(i)
+            yield f"http://a/{i}.jpg", f"/tmp/{i}.jpg"
+
+    results = f.download_urls(downloads())
+    next(results)
+    eq_(4, len(taken))
+    eq_(19, len(list(results)))
+    f.close()
+
+
+PAGE = b"<html><head><title>Record %d</title></head>\n" + b"<p>boilerplate</p>\n" * 50
+
+
+def test_codec():
+    cache_dir = tempfile.mkdtemp()
+    codec = fetcher.Codec(cache_dir)
+    page = PAGE % 1
+    encoded = codec.encode(page)
+    ok_(encoded.startswith(fetcher.Codec.MAGIC + bytes([fetcher.Codec.ZLIB])))
+    ok_(len(encoded) < len(page))
+    eq_(page, codec.decode(encoded))
+
+    # Old, uncompressed responses are read as-is.
+    eq_(page, codec.decode(page))
+
+    # Incompressible responses are stored raw.
+    noise = bytes(range(256))
+    eq_(fetcher.Codec.MAGIC + bytes([fetcher.Codec.RAW]) + noise, codec.encode(noise))
+    eq_(noise, codec.decode(codec.encode(noise)))
+
+    # Even with compression off, a response that looks like it has a header
+    # has to get one.
+    codec = fetcher.Codec(cache_dir, compress=False)
+    eq_(page, codec.encode(page))
+    tricky = fetcher.Codec.MAGIC + b"\x01not really"
+    eq_(tricky, codec.decode(codec.encode(tricky)))
+
+
+def test_zdict():
+    cache_dir = tempfile.mkdtemp()
+    plain = fetcher.Codec(cache_dir).encode(PAGE % 1)
+
+    zdict = fetcher.train_zdict([PAGE % i for i in range(10)])
+    ok_(b"<p>boilerplate</p>\n" in zdict)
+    zdict_id = fetcher.save_zdict(cache_dir, zdict)
+
+    codec = fetcher.Codec(cache_dir)
+    encoded = codec.encode(PAGE % 1)
+    ok_(encoded.startswith(fetcher.Codec.MAGIC + b"\x02" + zdict_id))
+    ok_(len(encoded) < len(plain))
+    eq_(PAGE % 1, codec.decode(encoded))
+    # Responses compressed before the dictionary can still be read.
+    eq_(PAGE % 1, codec.decode(plain))
+
+
+@parameterized([("directory",), ("sqlite",)])
+def test_lookup_many(backend):
+    cache = fetcher.Cache(tempfile.mkdtemp(), backend)
+    cache.store_url_in_cache("http://a.com/1", b"one")
+    cache.store_url_in_cache("http://b.com/2", b"two")
+    urls = ["http://a.com/1", "http://a.com/9", "http://c.com/3", "http://b.com/2"]
+    eq_(
+        [
+            ("http://a.com/1", b"one"),
+            ("http://a.com/9", None),
+            ("http://c.com/3", None),
+            ("http://b.com/2", b"two"),
+        ],
+        list(cache.lookup_many(urls)),
+    )
+    eq_(b"two", cache.get_or_none("http://b.com/2"))
+    eq_(None, cache.get_or_none("http://b.com/9"))
+    cache.close()
+
+
+def test_retries_and_negative_caching():
+    server, base_url = start_server()
+    f = fetcher.Fetcher(
+        throttle_secs=0, cache_dir=tempfile.mkdtemp(), backoff_secs=0.01
+    )
+
+    # Transient errors are retried.
+    eq_(b"contents of /flaky/2", f.fetch_url(f"{base_url}/flaky/2"))
+    eq_(3, Handler.requests["/flaky/2"])
+    eq_(None, f._cache.get_failure(f"{base_url}/flaky/2"))
+
+    # ...but not forever.
+    url = f"{base_url}/flaky/10"
+    assert_raises(requests.exceptions.HTTPError, f.fetch_url, url)
+    eq_(4, Handler.requests["/flaky/10"])
+    eq_((503, 1), itemgetter("status", "attempts")(f._cache.get_failure(url)))
+
+    # Permanent errors aren't retried, and aren't asked for again.
+    url = f"{base_url}/missing/1"
+    for _ in range(2):
+        with assert_raises(requests.exceptions.HTTPError) as e:
+            f.fetch_url(url)
+        eq_(404, e.exception.response.status_code)
+    eq_(1, Handler.requests["/missing/1"])
+    server.shutdown()
+
+    eq_({url: 404, f"{base_url}/flaky/10": 503}, f.stats.failures)
+    eq_(1, f.stats.counts["known failures"])
+    eq_(5, f.stats.counts["retries"])
+
+    # Unless they're old enough to be worth checking again.
+    f = fetcher.Fetcher(cache_dir=f._cache._cache_dir, recheck_secs=0)
+    ok_(not f._is_known_failure(f._cache.get_failure(url)))
+
+
+def test_revalidation():
+    server, base_url = start_server()
+    f = fetcher.Fetcher(throttle_secs=0, cache_dir=tempfile.mkdtemp())
+    url = f"{base_url}/etag/1"
+    eq_(b"contents of /etag/1 v1", f.fetch_url(url))
+    eq_({"etag": '"1"'}, f._cache.get_validators(url))
+    timestamp = f._cache._store.get_meta(fetcher.cache_key(url))["timestamp"]
+
+    # Not modified: the cached response is kept, and its timestamp updated.
+    eq_(b"contents of /etag/1 v1", f.fetch_url(url, revalidate=True))
+    eq_(2, Handler.requests["/etag/1"])
+    ok_(f._cache._store.get_meta(fetcher.cache_key(url))["timestamp"] > timestamp)
+    eq_(1, f.stats.counts["not modified"])
+
+    # Modified: it's refetched.
+    Handler.version = 2
+    eq_(b"contents of /etag/1 v2", f.fetch_url(url, revalidate=True))
+    eq_(b"contents of /etag/1 v2", f.fetch_url_from_cache(url))
+    eq_({"etag": '"2"'}, f._cache.get_validators(url))
+    server.shutdown()
+
+
+@parameterized([("directory",), ("sqlite",)])
+def test_download(backend):
+    server, base_url = start_server()
+    cache_dir = tempfile.mkdtemp()
+    out_dir = tempfile.mkdtemp()
+    f = fetcher.ConcurrentFetcher(
+        throttle_secs=0.01, cache_dir=cache_dir, backend=backend
+    )
+    downloads = [(f"{base_url}/{i}.jpg", f"{out_dir}/{i}.jpg") for i in range(3)]
+    downloads.append((f"{base_url}/missing.jpg", f"{out_dir}/missing.jpg"))
+    results = {url: error for url, _, error in f.download_urls(downloads)}
+    server.shutdown()
+
+    eq_(None, results[f"{base_url}/1.jpg"])
+    eq_(404, results[f"{base_url}/missing.jpg"].response.status_code)
+    eq_(b"contents of /1.jpg", open(f"{out_dir}/1.jpg", "rb").read())
+    ok_(not os.path.exists(f"{out_dir}/missing.jpg"))
+    eq_(["0.jpg", "1.jpg", "2.jpg"], sorted(os.listdir(out_dir)))
+    eq_(b"contents of /2.jpg", f.fetch_url_from_cache(f"{base_url}/2.jpg"))
+    if backend == "directory":
+        # The download and the cache share a file.
+        eq_(2, os.stat(f"{out_dir}/0.jpg").st_nlink)
+
+    # Now it comes from the cache.
+    f.download_url(f"{base_url}/0.jpg", f"{out_dir}/copy.jpg")
+    eq_(b"contents of /0.jpg", open(f"{out_dir}/copy.jpg", "rb").read())
+    eq_(1, f.stats.counts["cached"])
+    f.close()
+
+
+def test_incomplete_download():
+    class ShortHandler(Handler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "100")
+            self.end_headers()
+            self.wfile.write(b"too short")
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ShortHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/short.jpg"
+    out_dir = tempfile.mkdtemp()
+    f = fetcher.Fetcher(
+        throttle_secs=0, cache_dir=tempfile.mkdtemp(), retries=1, backoff_secs=0.01
+    )
+    assert_raises(
+        requests.exceptions.RequestException,
+        f.download_url,
+        url,
+        f"{out_dir}/short.jpg",
+    )
+    server.shutdown()
+    eq_([], os.listdir(out_dir))
+    ok_(not f.is_url_in_cache(url))
+    eq_(1, f.stats.counts["retries"])
+
+
+def test_adaptive_throttle():
+    throttle = fetcher.AdaptiveThrottle(
+        "a.com",
+        100.0,
+        min_rate=20.0,
+        max_rate=115.0,
+        max_concurrency=2,
+        rate_step=10.0,
+        window=2,
+        cooldown_secs=0.0,
+    )
+
+    def request(secs, status):
+        throttle.acquire()
+        throttle.release(secs, status)
+        return round(throttle.rate, 2), throttle.concurrency
+
+    # Additive increase after every `window` fast responses...
+    eq_((100.0, 1), request(0.1, 200))
+    eq_((110.0, 2), request(0.1, 200))
+    # ...but slow-ish ones don't count...
+    eq_((110.0, 2), request(1.5, 200))
+    eq_((110.0, 2), request(0.1, 200))
+    # ...and it stays within bounds.
+    eq_((115.0, 2), request(0.1, 200))
+    request(0.1, 200)
+    eq_((115.0, 2), request(0.1, 200))
+
+    # Multiplicative decrease on errors and latency spikes.
+    eq_((57.5, 1), request(0.1, 503))
+    eq_((28.75, 1), request(5.0, 200))
+    eq_((20.0, 1), request(0.1, 0))
+    eq_((20.0, 1), request(0.1, 429))
+    # A 404 is the client's problem, not the server's.
+    eq_((20.0, 1), request(0.1, 404))
+
+
+def save_host_stats(cache_dir, host):
+    for _ in range(20):
+        host_stats = fetcher.HostStats(cache_dir)
+        host_stats.count(host, "hits")
+        host_stats.save()
+
+
+def test_host_stats_concurrent_saves():
+    cache_dir = tempfile.mkdtemp()
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=save_host_stats, args=(cache_dir, host))
+        for host in ["a.com", "b.com", "a.com", "c.com"]
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    totals = fetcher.HostStats(cache_dir).load()
+    eq_(
+        {"a.com": 40, "b.com": 20, "c.com": 20},
+        {host: counts["hits"] for host, counts in totals.items()},
+    )
@@ -1,12 +1,16 @@
 import json
+import os
 import sys
 import tempfile
+import time
 
-from nose.tools import eq_, ok_
+import googlemaps
+from nose.tools import assert_raises, eq_, ok_
 from parameterized import parameterized
 
 sys.path.append("pipeline/src")
 import geocode  # noqa: E402
+from search_term_cache import SearchTermCache  # noqa: E402
 
 
 class MapsClientMock(object):
@@ -516,7 +520,7 @@ def create_street_names_file():
     return street_names_file
 
 
-def create_pois_file():
+def create_pois_file(pois=pois):
     pois_file = tempfile.NamedTemporaryFile()
     pois_file.write(bytes("\n".join(pois), "utf8"))
     pois_file.flush()
@@ -577,3 +581,468 @@ def geocode_pipeline_test():
         False,
     )
     check_output_file(output_file)
+
+
+def geocode_pipeline_workers_test():
+    images_ndjson = create_images_ndjson(images)
+    street_names_file = create_street_names_file()
+    pois_file = create_pois_file()
+    serial_file = tempfile.NamedTemporaryFile()
+    parallel_file = tempfile.NamedTemporaryFile()
+    for output_file, workers in ((serial_file, 1), (parallel_file, 4)):
+        geocode.main(
+            images_ndjson.name,
+            street_names_file.name,
+            pois_file.name,
+            output_file.name,
+            1.0,
+            None,
+            MapsClientMock(),
+            False,
+            workers=workers,
+            queries_per_sec=1000.0,
+        )
+    check_output_file(parallel_file)
+    # Not just the same results, but in the same order.
+    eq_(open(serial_file.name).read(), open(parallel_file.name).read())
+
+
+def geocode_pipeline_max_queries_test():
+    images_ndjson = create_images_ndjson(images)
+    street_names_file = create_street_names_file()
+    pois_file = create_pois_file()
+    output_file = tempfile.NamedTemporaryFile()
+    geocode.main(
+        images_ndjson.name,
+        street_names_file.name,
+        pois_file.name,
+        output_file.name,
+        1.0,
+        None,
+        MapsClientMock(),
+        False,
+        workers=2,
+        max_queries=1,
+    )
+    as_json = json.load(output_file)
+    # Only the first title that needs a query gets one; the POIs don't need any.
+    eq_(["100001", "100023", "100024"], list(as_json))
+
+
+@parameterized(
+    [
+        ("Yonge St. and Queen Street", "yonge  street and queen st", True),
+        ("King Street East", "king st e", True),
+        ("203 Church Street", "205 Church Street", False),
+        ("235.5 Yonge Street", "2355 Yonge Street", False),
+        ("Yonge and Queen", "Yonge and King", False),
+        ("Eastern Ave", "Eern Ave", False),
+        ("Westwood Ave", "Wwood Ave", False),
+        ("Avenue Rd and Westmoreland Ave", "Av Rd and Westmoreland Av", True),
+    ]
+)
+def normalize_search_term_test(term1, term2, same):
+    eq_(
+        same,
+        geocode.normalize_search_term(term1) == geocode.normalize_search_term(term2),
+    )
+
+
+class CountingMapsClient(MapsClientMock):
+    def __init__(self, error=None):
+        self.search_terms = []
+        self.error = error
+
+    def geocode(self, search_term):
+        self.search_terms.append(search_term)
+        if self.error:
+            raise self.error
+        return super().geocode(search_term)
+
+
+def call_geocoding_api_cache_test():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = SearchTermCache(os.path.join(cache_dir, "search_terms.sqlite"))
+        maps_client = CountingMapsClient()
+        term = "203 church street, toronto, ontario, canada"
+        result = geocode.call_geocoding_api(
+            maps_client, term, geocode.ADDRESS_TYPE, cache
+        )
+        eq_(43.6558684, result["lat"])
+
+        # A different spelling of the same term comes from the cache.
+        other_term = "203 Church St., Toronto, Ontario, Canada"
+        eq_(
+            dict(result, search_term=other_term),
+            geocode.call_geocoding_api(
+                maps_client, other_term, geocode.ADDRESS_TYPE, cache
+            ),
+        )
+        eq_([term], maps_client.search_terms)
+        eq_((1, 1), (cache.hits, cache.misses))
+
+        # But not if it expects different types.
+        eq_(
+            None,
+            geocode.call_geocoding_api(
+                maps_client, term, geocode.INTERSECTION_TYPE, cache
+            ),
+        )
+        eq_(2, len(maps_client.search_terms))
+
+        # Terms with no results are cached too...
+        missing = "nowhere, toronto, ontario, canada"
+        for _ in range(2):
+            geocode.call_geocoding_api(
+                maps_client, missing, geocode.ADDRESS_TYPE, cache
+            )
+        eq_(3, len(maps_client.search_terms))
+
+        # ...but failures aren't.
+        failing_client = CountingMapsClient(error=RuntimeError("Over quota"))
+        failing = "1 yonge street, toronto, ontario, canada"
+        for _ in range(2):
+            eq_(
+                None,
+                geocode.call_geocoding_api(
+                    failing_client, failing, geocode.ADDRESS_TYPE, cache
+                ),
+            )
+        eq_(2, len(failing_client.search_terms))
+        ok_(not cache.contains(geocode.normalize_search_term(failing), ()))
+        cache.close()
+
+
+def geocode_pipeline_search_term_cache_test():
+    images_ndjson = create_images_ndjson(images)
+    street_names_file = create_street_names_file()
+    pois_file = create_pois_file()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_file = os.path.join(cache_dir, "search_terms.sqlite")
+        for expected_queries in (3, 0):
+            output_file = tempfile.NamedTemporaryFile()
+            maps_client = CountingMapsClient()
+            geocode.main(
+                images_ndjson.name,
+                street_names_file.name,
+                pois_file.name,
+                output_file.name,
+                1.0,
+                None,
+                maps_client,
+                False,
+                search_term_cache=cache_file,
+            )
+            check_output_file(output_file)
+            eq_(expected_queries, len(maps_client.search_terms))
+
+
+def geocode_pipeline_duplicate_titles_test():
+    # Each of these titles appears twice, under different IDs.
+    duplicates = [
+        dict(image, uniqueID=str(int(image["uniqueID"]) + 1000)) for image in images
+    ]
+    images_ndjson = create_images_ndjson(images + duplicates)
+    street_names_file = create_street_names_file()
+    pois_file = create_pois_file()
+    output_file = tempfile.NamedTemporaryFile()
+    maps_client = CountingMapsClient()
+    geocode.main(
+        images_ndjson.name,
+        street_names_file.name,
+        pois_file.name,
+        output_file.name,
+        1.0,
+        None,
+        maps_client,
+        False,
+    )
+    check_output_file(output_file)
+    eq_(3, len(maps_client.search_terms))
+    output_file.seek(0)
+    as_json = json.load(output_file)
+    for image in images:
+        id_ = image["uniqueID"]
+        eq_(as_json.get(id_), as_json.get(str(int(id_) + 1000)))
+
+
+def geocode_pipeline_fingerprints_test():
+    street_names_file = create_street_names_file()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_file = os.path.join(tmp_dir, "geocode_results.json")
+        fingerprints_file = os.path.join(tmp_dir, "fingerprints.json")
+
+        def run(images, pois_file):
+            images_ndjson = create_images_ndjson(images)
+            maps_client = CountingMapsClient()
+            geocode.main(
+                images_ndjson.name,
+                street_names_file.name,
+                pois_file.name,
+                output_file,
+                1.0,
+                None,
+                maps_client,
+                False,
+                fingerprints_file=fingerprints_file,
+            )
+            with open(output_file) as f:
+                return json.load(f), len(maps_client.search_terms)
+
+        pois_file = create_pois_file()
+        results, queries = run(images, pois_file)
+        eq_(3, queries)
+
+        # Nothing has changed, so nothing needs geocoding again.
+        eq_((results, 0), run(images, pois_file))
+
+        # Only the records that got as far as the POI parser depend on it.
+        moved_pois = create_pois_file(
+            [line.replace("43.6462345", "43.5") for line in pois]
+        )
+        moved_results, queries = run(images, moved_pois)
+        eq_(0, queries)
+        eq_(43.5, moved_results["100024"]["lat"])
+        eq_(results["100001"], moved_results["100001"])
+
+        # A record whose title has changed is geocoded again.
+        changed = [dict(image) for image in images]
+        changed[1]["title"] = "161 Beatrice Street, rear"
+        changed_results, queries = run(changed, moved_pois)
+        eq_(1, queries)
+        eq_("161 Beatrice Street, rear", changed_results["100004"]["original_title"])
+
+        # If the output changes behind its back, the fingerprints are ignored.
+        with open(output_file, "w") as f:
+            f.write("{}")
+        eq_(3, run(changed, moved_pois)[1])
+
+
+def geocode_pipeline_stream_test():
+    images_ndjson = create_images_ndjson(images)
+    street_names_file = create_street_names_file()
+    pois_file = create_pois_file()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_file = os.path.join(tmp_dir, "geocode_results.json")
+        stream_file = os.path.join(tmp_dir, "geocode_results.ndjson")
+
+        # A run that stopped after the first record, part way through a line.
+        done = {"original_title": "Rear of 203 Church Street leaning wall"}
+        with open(stream_file, "w") as f:
+            f.write(json.dumps({"uniqueID": "100001", "result": done}) + "\n")
+            f.write('{"uniqueID": "100004", "res')
+
+        maps_client = CountingMapsClient()
+        geocode.main(
+            images_ndjson.name,
+            street_names_file.name,
+            pois_file.name,
+            output_file,
+            1.0,
+            None,
+            maps_client,
+            False,
+            workers=2,
+            stream_file=stream_file,
+        )
+        eq_(
+            [
+                "161 beatrice street, toronto, ontario, canada",
+                "Davenport Road and Uxbridge Avenue, toronto, ontario, canada",
+            ],
+            maps_client.search_terms,
+        )
+        ok_(not os.path.exists(stream_file))
+        with open(output_file) as f:
+            as_json = json.load(f)
+        eq_(done, as_json["100001"])
+        eq_(["100001", "100004", "100007", "100023", "100024"], list(as_json))
+
+
+class InterruptingMapsClient(CountingMapsClient):
+    """Stops the run, like a ^C, at its `n`-th query."""
+
+    def __init__(self, n):
+        super().__init__()
+        self.n = n
+
+    def geocode(self, search_term):
+        if len(self.search_terms) + 1 == self.n:
+            raise KeyboardInterrupt()
+        return super().geocode(search_term)
+
+
+def geocode_pipeline_stream_fingerprints_test():
+    street_names_file = create_street_names_file()
+    pois_file = create_pois_file()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_file = os.path.join(tmp_dir, "geocode_results.json")
+        stream_file = os.path.join(tmp_dir, "geocode_results.ndjson")
+        fingerprints_file = os.path.join(tmp_dir, "fingerprints.json")
+
+        def run(images, maps_client, stream_file=None):
+            images_ndjson = create_images_ndjson(images)
+            geocode.main(
+                images_ndjson.name,
+                street_names_file.name,
+                pois_file.name,
+                output_file,
+                1.0,
+                None,
+                maps_client,
+                False,
+                fingerprints_file=fingerprints_file,
+                stream_file=stream_file,
+            )
+            return len(maps_client.search_terms)
+
+        eq_(3, run(images, CountingMapsClient()))
+
+        # Two titles change, and the run that geocodes them is interrupted
+        # after the first, and then resumed.
+        changed = [dict(image) for image in images]
+        changed[1]["title"] = "161 Beatrice Street, rear"
+        changed[2]["title"] += ", rear"
+        assert_raises(
+            KeyboardInterrupt, run, changed, InterruptingMapsClient(2), stream_file
+        )
+        eq_(1, run(changed, CountingMapsClient(), stream_file))
+
+        # The records that were done before the interruption kept their
+        # fingerprints, so nothing needs geocoding again.
+        eq_(0, run(changed, CountingMapsClient()))
+
+
+def geocode_pipeline_timeouts_test():
+    images_ndjson = create_images_ndjson(images)
+    street_names_file = create_street_names_file()
+    pois_file = create_pois_file()
+    output_file = tempfile.NamedTemporaryFile()
+    retry_file = tempfile.NamedTemporaryFile()
+    parse_title = geocode.parse_title
+
+    def slow_parse_title(parsers, title, stats=None):
+        if title == "High Park benches":
+            time.sleep(5)
+        return parse_title(parsers, title, stats)
+
+    geocode.parse_title = slow_parse_title
+    try:
+        geocode.main(
+            images_ndjson.name,
+            street_names_file.name,
+            pois_file.name,
+            output_file.name,
+            1.0,
+            None,
+            CountingMapsClient(error=googlemaps.exceptions.Timeout()),
+            False,
+            workers=2,
+            parse_timeout_secs=0.2,
+            retry_file=retry_file.name,
+        )
+    finally:
+        geocode.parse_title = parse_title
+
+    # The records that needed the API, and the one that was slow to parse.
+    retry_ids = sorted(json.loads(line)["uniqueID"] for line in retry_file)
+    eq_(["100001", "100004", "100007", "100024"], retry_ids)
+    eq_(["100023"], list(json.load(output_file)))
+
+
+def geocode_pipeline_procs_test():
+    images_ndjson = create_images_ndjson(images)
+    street_names_file = create_street_names_file()
+    pois_file = create_pois_file()
+    serial_file = tempfile.NamedTemporaryFile()
+    procs_file = tempfile.NamedTemporaryFile()
+    for output_file, procs in ((serial_file, 1), (procs_file, 2)):
+        geocode.main(
+            images_ndjson.name,
+            street_names_file.name,
+            pois_file.name,
+            output_file.name,
+            1.0,
+            None,
+            MapsClientMock(),
+            False,
+            procs=procs,
+        )
+    check_output_file(procs_file)
+    eq_(open(serial_file.name).read(), open(procs_file.name).read())
+
+
+def geocode_pipeline_shared_search_term_test():
+    # Different titles, but the same search term.
+    extra = [
+        {"uniqueID": "100101", "title": "161 Beatrice Street, rear"},
+        {"uniqueID": "100102", "title": "161 Beatrice Street - side view"},
+    ]
+    images_ndjson = create_images_ndjson(images + extra)
+    street_names_file = create_street_names_file()
+    pois_file = create_pois_file()
+    output_file = tempfile.NamedTemporaryFile()
+    maps_client = CountingMapsClient()
+    geocode.main(
+        images_ndjson.name,
+        street_names_file.name,
+        pois_file.name,
+        output_file.name,
+        1.0,
+        None,
+        maps_client,
+        False,
+        workers=2,
+    )
+    check_output_file(output_file)
+    eq_(3, len(maps_client.search_terms))
+    output_file.seek(0)
+    as_json = json.load(output_file)
+    eq_(as_json["100004"]["lat"], as_json["100101"]["lat"])
+    eq_(as_json["100004"]["lat"], as_json["100102"]["lat"])
+
+
+class WrongTypeMapsClient(MapsClientMock):
+    def geocode(self, search_term):
+        return [dict(r, types=["route"]) for r in super().geocode(search_term)]
+
+
+@parameterized(
+    [
+        (MapsClientMock(), False, 1, [0, 0, 0, 0, 0, 0], [0, 0, 0, 0, 0, 0]),
+        (MapsClientMock(), True, 1, [0, 0, 0, 0, 0, 0], [1, 1, 0, 0, 0, 2]),
+        (MapsClientMock(), True, 2, [0, 0, 0, 0, 0, 0], [1, 1, 0, 0, 0, 2]),
+        (WrongTypeMapsClient(), False, 1, [2, 1, 0, 0, 0, 0], [0, 0, 0, 0, 0, 0]),
+    ]
+)
+def geocode_pipeline_parser_stats_test(
+    maps_client, strict, procs, discarded, strict_rejected
+):
+    images_ndjson = create_images_ndjson(images)
+    street_names_file = create_street_names_file()
+    pois_file = create_pois_file()
+    output_file = tempfile.NamedTemporaryFile()
+    parser_stats_file = tempfile.NamedTemporaryFile()
+    geocode.main(
+        images_ndjson.name,
+        street_names_file.name,
+        pois_file.name,
+        output_file.name,
+        1.0,
+        None,
+        maps_client,
+        strict,
+        procs=procs,
+        parser_stats_file=parser_stats_file.name,
+    )
+    report = json.load(parser_stats_file)
+    eq_(6, report["titles"])
+    eq_(1, report["unmatched"])
+    parsers = report["parsers"]
+    eq_("exact_address", parsers[0]["name"])
+    eq_([6, 4, 3, 3, 3, 3], [p["tried"] for p in parsers])
+    eq_([2, 1, 0, 0, 0, 2], [p["matched"] for p in parsers])
+    eq_(discarded, [p["discarded"] for p in parsers])
+    eq_(strict_rejected, [p["strict_rejected"] for p in parsers])
+    for p in parsers:
+        ok_(0 <= p["p99_secs"] <= p["total_secs"])
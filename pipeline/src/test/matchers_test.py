@@ -0,0 +1,256 @@
+import os
+import random
+import sys
+import tempfile
+
+from nose.tools import eq_, ok_
+from parameterized import parameterized
+
+sys.path.append("pipeline/src")
+import geocode  # noqa: E402
+import matchers  # noqa: E402
+
+street_names = [
+    "Bathurst Street",
+    "Bathurst St.",
+    "Beatrice Street",
+    "Beech Avenue",
+    "Bloor Street",
+    "Carlaw Street",
+    "church street",
+    "clinton street",
+    "davenport road",
+    "King Street",
+    "King Street West",
+    "King St",
+    "lake shore",
+    "marjory avenue",
+    "McLean Avenue",
+    "myrtle avenue",
+    "Queen Street East",
+    "Queen St. E.",
+    "Queen's Park",
+    "Richmond St",
+    "Richmond St E.",
+    "richmond street west",
+    "spadina avenue",
+    "uxbridge avenue",
+    "Victoria St",
+    "yonge street",
+    "",
+]
+
+street_re_str = geocode.build_is_a_toronto_street_regex_str(street_names)
+exact_address_re = geocode.exact_address_regex(street_re_str)
+standalone_street_re = geocode.standalone_street_regex(street_re_str)
+exact_address_matcher = matchers.ExactAddressMatcher(street_names)
+standalone_street_matcher = matchers.StandaloneStreetMatcher(street_names)
+
+titles = [
+    "161 Beatrice Street",
+    "Rear of 203 Church Street leaning wall",
+    "28-30 Marjory Avenue",
+    "176 Lake Shore, Island",
+    "Rear 9-15 1/2 Myrtle Avenue — Barn",
+    "Victory Building, 78-82 Richmond Street West — Supports",
+    "127 Bathurst St.",
+    "127 Bathurst Sts",
+    "345, 347, 349, 351 Beech Avenue",
+    "305 1/2 Clinton Street",
+    "717  1/2 Queen St. E. - plumbing",
+    "North side 235.5 Yonge Street 1954",
+    "12.55 Yonge Street",
+    "1 2 3 Yonge Street",
+    "10 King Street Westerly",
+    "10 King Streets",
+    "Queen Street East",
+    "Queen Street Easter",
+    "Richmond St E., view is west across Victoria St",
+    "Yonge Street south from Bloor Street",
+    "Yonge Street Bloor Street",
+    "Yonge Street, Bloor Street",
+    "yonge streetbloor street",
+    "YONGE STREET AND BLOOR STREET",
+    "Queen's Park and King St",
+    "Northwest corner Davenport Road and Uxbridge Avenue — Defective building",
+    "Café King Street",
+    "King Street West-King Street-King St",
+    "Kings Street",
+    "",
+    "No streets here",
+    "\n 161 Beatrice Street",
+    "Rear\n203 Church Street",
+    "161\nBeatrice Street",
+    "12 Yonge\n161 Beatrice Street",
+    # Characters that re.I matches with ASCII letters.
+    "Yonge \u017ftreet",
+    "\u212aing Street West",
+    "R\u0130CHMOND ST and R\u0131chmond St",
+    "King Street\u017f",
+]
+
+
+@parameterized([(title,) for title in titles])
+def exact_address_test(title):
+    expected = exact_address_re.match(title.lower())
+    actual = exact_address_matcher.match(title.lower())
+    eq_(expected and expected.groups(), actual and actual.groups())
+    if expected:
+        eq_(expected.group(), actual.group())
+
+
+@parameterized([(title,) for title in titles])
+def standalone_street_test(title):
+    eq_(standalone_street_re.findall(title), standalone_street_matcher.findall(title))
+
+
+def random_titles_test():
+    # Titles made of street names, numbers and separators, to catch anything
+    # the hand-written ones miss.
+    rng = random.Random(0)
+    pieces = [name for name in street_names if name] + [
+        "1",
+        "22",
+        "33.5",
+        ".5",
+        "1/2",
+        "s",
+        "West",
+        "-",
+        ",",
+        " ",
+        "  ",
+        "and",
+        "\n",
+    ]
+    for _ in range(2000):
+        title = "".join(
+            rng.choice(pieces) + rng.choice(["", " ", ", ", "-"])
+            for _ in range(rng.randint(1, 8))
+        )
+        title = "".join(c.upper() if rng.random() < 0.2 else c for c in title)
+        expected = exact_address_re.match(title.lower())
+        actual = exact_address_matcher.match(title.lower())
+        eq_(expected and expected.groups(), actual and actual.groups(), title)
+        eq_(
+            standalone_street_re.findall(title),
+            standalone_street_matcher.findall(title),
+            title,
+        )
+
+
+def parse_with_matchers_test():
+    eq_(
+        geocode.parse_exact_address(exact_address_matcher, "305 1/2 Clinton Street"),
+        geocode.parse_exact_address(exact_address_re, "305 1/2 Clinton Street"),
+    )
+    title = "Yonge Street south from Bloor Street"
+    eq_(
+        geocode.parse_two_streets(standalone_street_matcher, title),
+        geocode.parse_two_streets(standalone_street_re, title),
+    )
+
+
+pois = [
+    "name,osmid,lat,lng,score,type",
+    "C. N. E.,1,43.633751,-79.4192546,2,tourism:theme_park",
+    "CNE,1,43.633751,-79.4192546,2,tourism:theme_park",
+    "High Park,2,43.6462345,-79.4627137,1,leisure:park",
+    "High Park Zoo,3,43.6462345,-79.4627137,3,zoo",
+    "Park,4,43.6,-79.4,9,too short",
+    "Casa Loma,5,43.678,-79.409,5,castle",
+    "St. Lawrence Market,6,43.648,-79.371,4,market",
+    "Lawrence Market,7,43.648,-79.371,1,market",
+]
+
+
+def create_pois_file(lines):
+    pois_file = tempfile.NamedTemporaryFile()
+    pois_file.write(bytes("\n".join(lines), "utf8"))
+    pois_file.flush()
+    return pois_file
+
+
+@parameterized(
+    [
+        ("High Park benches, C. N. E.",),
+        ("high park zoo",),
+        ("High Park Zoological",),
+        ("CNE-High Park",),
+        ("Casa Loma,CNE",),
+        ("St. Lawrence Market",),
+        ("casa lomas",),
+        ("Ca\u017fa Loma",),
+        ("HIGH PAR\u212a",),
+        ("",),
+    ]
+)
+def place_name_test(title):
+    pois_file = create_pois_file(pois)
+    regex, place_map = geocode.build_place_name_regex(pois_file.name)
+    matcher, matcher_place_map = geocode.build_place_name_matcher(pois_file.name)
+    eq_(place_map, matcher_place_map)
+    eq_(regex.findall(title), matcher.findall(title))
+    eq_(
+        geocode.parse_place_name(regex, place_map, title),
+        geocode.parse_place_name(matcher, place_map, title),
+    )
+
+
+def place_name_finditer_test():
+    pois_file = create_pois_file(pois)
+    matcher, _ = geocode.build_place_name_matcher(pois_file.name)
+    eq_([(0, 9), (19, 27)], list(matcher.finditer("High Park benches, C. N. E.")))
+
+
+def place_name_matcher_cache_test():
+    pois_file = create_pois_file(pois)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_file = os.path.join(cache_dir, "pois.pickle")
+        matcher, _ = geocode.build_place_name_matcher(pois_file.name, cache_file)
+        ok_(os.path.exists(cache_file))
+        cached, _ = geocode.build_place_name_matcher(pois_file.name, cache_file)
+        eq_(matcher.findall("Casa Loma"), cached.findall("Casa Loma"))
+
+        # A different file gets a new matcher, rather than the cached one.
+        other_file = create_pois_file(pois[:3])
+        other, _ = geocode.build_place_name_matcher(other_file.name, cache_file)
+        eq_([], other.findall("Casa Loma"))
+
+        # And so does an unreadable cache.
+        with open(cache_file, "wb") as f:
+            f.write(b"garbage")
+        matcher, _ = geocode.build_place_name_matcher(pois_file.name, cache_file)
+        eq_(["Casa Loma"], matcher.findall("Casa Loma"))
+
+
+def place_name_matcher_cache_code_test():
+    pois_file = create_pois_file(pois)
+    read_place_names = geocode.read_place_names
+    parser_sources = geocode._PARSER_SOURCES
+    calls = []
+
+    def counting_read_place_names(csv_file):
+        calls.append(csv_file)
+        return read_place_names(csv_file)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_file = os.path.join(cache_dir, "pois.pickle")
+        source = os.path.join(cache_dir, "geocode.py")
+        with open(source, "w") as f:
+            f.write("v1")
+        geocode.read_place_names = counting_read_place_names
+        geocode._PARSER_SOURCES = [source]
+        try:
+            geocode.build_place_name_matcher(pois_file.name, cache_file)
+            geocode.build_place_name_matcher(pois_file.name, cache_file)
+            eq_(1, len(calls))
+
+            # A change to the code means a new matcher.
+            with open(source, "w") as f:
+                f.write("v2")
+            geocode.build_place_name_matcher(pois_file.name, cache_file)
+            eq_(2, len(calls))
+        finally:
+            geocode.read_place_names = read_place_names
+            geocode._PARSER_SOURCES = parser_sources
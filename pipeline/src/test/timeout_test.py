@@ -0,0 +1,68 @@
+import sys
+import threading
+import time
+
+from nose.tools import assert_raises, eq_, ok_
+
+sys.path.append("pipeline/src")
+from utils.timeout import call_with_timeout, timeout  # noqa: E402
+
+
+def _sleep(secs):
+    time.sleep(secs)
+    return secs
+
+
+def _fail():
+    raise ValueError("Bad title")
+
+
+def _in_thread(fn):
+    """Run fn on another thread, returning what it returned or raised."""
+    outcome = []
+
+    def run():
+        try:
+            outcome.append(fn())
+        except Exception as e:
+            outcome.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    return outcome[0]
+
+
+def timeout_test():
+    start = time.monotonic()
+    with assert_raises(TimeoutError):
+        with timeout(seconds=0.1):
+            time.sleep(5)
+    ok_(time.monotonic() - start < 1)
+
+    with timeout(seconds=1):
+        pass
+
+
+def timeout_off_main_thread_test():
+    def run():
+        with timeout(seconds=0.05):
+            time.sleep(0.1)
+
+    ok_(isinstance(_in_thread(run), TimeoutError))
+
+
+def call_with_timeout_test():
+    eq_(0.01, call_with_timeout(1, _sleep, 0.01))
+    with assert_raises(TimeoutError):
+        call_with_timeout(0.1, _sleep, 5)
+    with assert_raises(ValueError):
+        call_with_timeout(1, _fail)
+
+
+def call_with_timeout_off_main_thread_test():
+    # It won't fork a child process to interrupt fn, from a process that has
+    # other threads.
+    ok_(
+        isinstance(_in_thread(lambda: call_with_timeout(1, _sleep, 0.01)), RuntimeError)
+    )
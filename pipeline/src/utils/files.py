@@ -0,0 +1,10 @@
+import os
+
+
+def truncate_partial_line(path):
+    """Remove any partial line left at the end of a file by a crash."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        end = f.read().rfind(b"\n") + 1
+        f.truncate(end)
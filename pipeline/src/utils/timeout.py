@@ -1,9 +1,19 @@
 import signal
+import threading
+import time
+
+
+def _on_main_thread():
+    return threading.current_thread() is threading.main_thread()
 
 
 class timeout:
     """Run a code block with a timeout.
 
+    This uses SIGALRM, so it can only interrupt the block on a process's main
+    thread (which includes the workers of a process pool). Anywhere else, the
+    block runs to the end, and then raises TimeoutError if it took too long.
+
     See https://stackoverflow.com/a/22348885/388951
     """
 
@@ -15,8 +25,32 @@ class timeout:
         raise TimeoutError(self.error_message)
 
     def __enter__(self):
-        signal.signal(signal.SIGALRM, self.handle_timeout)
-        signal.alarm(self.seconds)
+        self._deadline = time.monotonic() + self.seconds
+        self._uses_signal = _on_main_thread()
+        if self._uses_signal:
+            self._previous_handler = signal.signal(signal.SIGALRM, self.handle_timeout)
+            signal.setitimer(signal.ITIMER_REAL, self.seconds)
 
     def __exit__(self, _type, _value, _traceback):
-        signal.alarm(0)
+        if self._uses_signal:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self._previous_handler)
+        elif _type is None and time.monotonic() > self._deadline:
+            raise TimeoutError(self.error_message)
+
+
+def call_with_timeout(seconds, fn, *args):
+    """Return fn(*args), or raise TimeoutError if it takes longer than this.
+
+    This uses `timeout`, so it has to be called on a process's main thread
+    (which includes the workers of a process pool); anywhere else, it raises
+    RuntimeError. (Running fn in a child process instead would mean forking a
+    multithreaded process, which can deadlock on locks that other threads
+    hold, e.g. logging's.)
+    """
+    if not _on_main_thread():
+        raise RuntimeError(
+            "call_with_timeout() can only interrupt a function on the main thread"
+        )
+    with timeout(seconds=seconds):
+        return fn(*args)